@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+
+"""A benchmark of the event loop latency while parsing JSON documents in
+a coroutine, by calling parse() in the coroutine, and by awaiting
+parse_async() with the default thread pool executor and with a
+process pool executor. The latency is how late a task sleeping one
+millisecond at a time wakes up.
+
+Example execution on a machine with one CPU:
+
+$ env PYTHONPATH=. python3 examples/benchmarks/async_latency.py
+Parsed 'examples/benchmarks/json/data.json' 20 times:
+
+PARSE                      SECONDS  MAX LATENCY MS  MEAN LATENCY MS
+parse()                       1.36          1358.7           1358.7
+parse_async() threads         1.93            18.5              5.6
+parse_async() processes       2.46            12.3              0.2
+$
+
+"""
+
+import asyncio
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(SCRIPT_DIR, 'json'))
+
+from parsers.textparser_json import Parser
+
+
+DATA_JSON = os.path.relpath(os.path.join(SCRIPT_DIR, 'json', 'data.json'))
+ITERATIONS = 20
+TICK = 0.001
+
+
+async def measure_latency(latencies, done):
+    while not done.is_set():
+        start_time = time.perf_counter()
+        await asyncio.sleep(TICK)
+        latencies.append(time.perf_counter() - start_time - TICK)
+
+
+async def parse_inline(parser, text):
+    for _ in range(ITERATIONS):
+        parser.parse(text)
+
+
+async def parse_async(parser, text):
+    for _ in range(ITERATIONS):
+        await parser.parse_async(text)
+
+
+async def measure(parse, parser, text):
+    """Returns the time it took to parse, and the maximum and mean event
+    loop latencies.
+
+    """
+
+    latencies = []
+    done = asyncio.Event()
+    ticker = asyncio.ensure_future(measure_latency(latencies, done))
+    await asyncio.sleep(0.05)
+    del latencies[:]
+    start_time = time.perf_counter()
+    await parse(parser, text)
+    end_time = time.perf_counter()
+    done.set()
+    await ticker
+
+    return (end_time - start_time,
+            max(latencies),
+            sum(latencies) / len(latencies))
+
+
+async def main():
+    with open(DATA_JSON, 'r') as fin:
+        text = fin.read()
+
+    parser = Parser()
+    parser.parse(text)
+    results = [
+        ('parse()', await measure(parse_inline, parser, text)),
+        ('parse_async() threads', await measure(parse_async, parser, text))
+    ]
+
+    with ProcessPoolExecutor(1) as executor:
+        parser.async_executor = executor
+        await parser.parse_async(text)
+        results.append(('parse_async() processes',
+                        await measure(parse_async, parser, text)))
+
+    print("Parsed '{}' {} times:".format(DATA_JSON, ITERATIONS))
+    print()
+    print('PARSE                      SECONDS  MAX LATENCY MS  MEAN LATENCY MS')
+
+    for name, (seconds, maximum, mean) in results:
+        print('{:25s}  {:7.02f}  {:14.01f}  {:15.01f}'.format(name,
+                                                              seconds,
+                                                              1000 * maximum,
+                                                              1000 * mean))
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+
+"""A benchmark comparing the time it takes to parse an arithmetic
+expression with the Expression pattern and with the equivalent
+grammar of one pattern level per precedence tier. The text is
+tokenized once before parsing.
+
+Example execution:
+
+$ env PYTHONPATH=. python3 examples/benchmarks/expression.py
+Parsed an expression of 20000 operands 10 times:
+
+GRAMMAR                SECONDS   RATIO
+expression                0.64    100%
+expression (compiled)     0.48     75%
+layered                   1.38    218%
+layered (compiled)        0.67    105%
+$
+
+"""
+
+from __future__ import print_function
+
+import random
+import timeit
+
+import textparser
+from textparser import Grammar
+from textparser import Token
+from textparser import Forward
+from textparser import Sequence
+from textparser import ZeroOrMore
+from textparser import Optional
+from textparser import Expression
+from textparser import choice
+
+
+OPERANDS = 20000
+ITERATIONS = 10
+
+
+class Parser(textparser.Parser):
+
+    def token_specs(self):
+        return [
+            ('SKIP',          r'[ \r\n\t]+'),
+            ('NUMBER',        r'\d+'),
+            ('PLUS',     '+', r'\+'),
+            ('MINUS',    '-', r'-'),
+            ('TIMES',    '*', r'\*'),
+            ('DIVIDE',   '/', r'/'),
+            ('POWER',    '^', r'\^'),
+            ('LPAREN',   '(', r'\('),
+            ('RPAREN',   ')', r'\)'),
+            ('MISMATCH',      r'.')
+        ]
+
+
+def expression_grammar():
+    expr = Forward()
+    atom = choice('NUMBER', Sequence('(', expr, ')'))
+    expr <<= Expression(atom,
+                        [('^', 'right', 2),
+                         ('-', 'right', 1),
+                         (['*', '/'], 'left', 2),
+                         (['+', '-'], 'left', 2)])
+
+    return Grammar(expr)
+
+
+def layered_grammar():
+    expr = Forward()
+    factor = Forward()
+    atom = choice('NUMBER', Sequence('(', expr, ')'))
+    power = Sequence(atom, Optional(Sequence('^', factor)))
+    factor <<= choice(Sequence('-', factor), power)
+    term = Sequence(factor, ZeroOrMore(Sequence(choice('*', '/'), factor)))
+    expr <<= Sequence(term, ZeroOrMore(Sequence(choice('+', '-'), term)))
+
+    return Grammar(expr)
+
+
+def create_text():
+    random.seed(0)
+    operands = []
+
+    for _ in range(OPERANDS):
+        operand = str(random.randint(0, 1000))
+
+        if random.random() < 0.1:
+            operand = '-' + operand
+
+        if random.random() < 0.1:
+            operand = '({} + 1)'.format(operand)
+
+        operands.append(operand)
+        operands.append(random.choice('+-*/^'))
+
+    return ' '.join(operands[:-1])
+
+
+def parse_time(grammar, tokens):
+    def parse():
+        grammar.parse(tokens)
+
+    return timeit.timeit(parse, number=ITERATIONS)
+
+
+text = create_text()
+tokens = Parser().tokenizer().tokenize_array(text)
+del tokens[0]
+tokens.append(Token('__EOF__', '__EOF__', len(text)))
+results = [
+    ('expression', parse_time(expression_grammar(), tokens)),
+    ('expression (compiled)',
+     parse_time(expression_grammar().compile(), tokens)),
+    ('layered', parse_time(layered_grammar(), tokens)),
+    ('layered (compiled)', parse_time(layered_grammar().compile(), tokens))
+]
+
+print('Parsed an expression of {} operands {} times:'.format(OPERANDS,
+                                                             ITERATIONS))
+print()
+print('GRAMMAR                SECONDS   RATIO')
+
+for name, seconds in results:
+    print('{:21s}  {:7.02f}  {:5}%'.format(
+        name,
+        seconds,
+        int(round(100 * seconds / results[0][1], 0))))
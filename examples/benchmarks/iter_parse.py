@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+
+"""A benchmark comparing the peak memory used when parsing a growing
+number of records with parse() and iter_parse() of a string, and
+iter_parse() of a file. The string itself is not included, while the
+file is read in chunks while parsing.
+
+Example execution:
+
+$ env PYTHONPATH=. python3 examples/benchmarks/iter_parse.py
+Parsed records 'name = 12345;':
+
+RECORDS   PARSE KBYTES  ITER_PARSE KBYTES  FILE KBYTES
+  10000           6573                 38          392
+ 100000          65317                 38          487
+$
+
+"""
+
+from __future__ import print_function
+
+import os
+import tempfile
+import tracemalloc
+
+import textparser
+from textparser import Sequence
+from textparser import ZeroOrMore
+
+
+RECORD = 'name = 12345;\n'
+
+
+class Parser(textparser.Parser):
+
+    def token_specs(self):
+        return [
+            ('SKIP',             r'[ \r\n\t]+'),
+            ('NUMBER',           r'\d+'),
+            ('WORD',             r'[a-z]+'),
+            ('EQ',          '=', r'='),
+            ('SEMICOLON',   ';', r';'),
+            ('MISMATCH',         r'.')
+        ]
+
+    def grammar(self):
+        return ZeroOrMore(Sequence('WORD', '=', 'NUMBER', ';'))
+
+
+def parse(parser, text):
+    parser.parse(text)
+
+
+def iter_parse(parser, text):
+    for _ in parser.iter_parse(text):
+        pass
+
+
+def iter_parse_file(parser, path):
+    with open(path, 'r') as fin:
+        for _ in parser.iter_parse(fin):
+            pass
+
+
+def measure(function, text):
+    """Returns the peak memory in bytes used when calling given function.
+
+    """
+
+    parser = Parser()
+    parser.parse(RECORD)
+    tracemalloc.start()
+    function(parser, text)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return peak
+
+
+print("Parsed records '{}':".format(RECORD.strip()))
+print()
+print('RECORDS   PARSE KBYTES  ITER_PARSE KBYTES  FILE KBYTES')
+
+for records in [10000, 100000]:
+    text = records * RECORD
+    fd, path = tempfile.mkstemp()
+
+    with os.fdopen(fd, 'w') as fout:
+        fout.write(text)
+
+    print('{:7}   {:12}  {:17}  {:11}'.format(
+        records,
+        measure(parse, text) // 1024,
+        measure(iter_parse, text) // 1024,
+        measure(iter_parse_file, path) // 1024))
+    os.remove(path)
@@ -45,8 +45,13 @@ class Parser(textparser.Parser):
         return value
 
 
-def parse_time(json_string, iterations):
-    parser = Parser()
+class CompiledParser(Parser):
+
+    compile_grammar = True
+
+
+def parse_time(json_string, iterations, parser_class=Parser):
+    parser = parser_class()
 
     def _parse():
         parser.parse(json_string)
@@ -54,6 +59,10 @@ def parse_time(json_string, iterations):
     return timeit.timeit(_parse, number=iterations)
 
 
+def parse_time_compiled(json_string, iterations):
+    return parse_time(json_string, iterations, CompiledParser)
+
+
 def parse(json_string):
     return Parser().parse(json_string)
 
@@ -85,6 +85,8 @@ with open(DATA_JSON, 'r') as fin:
     JSON_STRING = fin.read()
 
 textparser_time = textparser_json.parse_time(JSON_STRING, ITERATIONS)
+textparser_compiled_time = textparser_json.parse_time_compiled(JSON_STRING,
+                                                               ITERATIONS)
 lark_lalr_time = lark_json.parse_time_lalr(JSON_STRING, ITERATIONS)
 lark_earley_time = lark_json.parse_time_earley(JSON_STRING, ITERATIONS)
 pyparsing_time = pyparsing_json.parse_time(JSON_STRING, ITERATIONS)
@@ -98,6 +100,9 @@ textx_time = textx_json.parse_time(JSON_STRING, ITERATIONS)
 # Parse comparison output.
 measurements = [
     ('textparser', textparser_time, textparser_json.version()),
+    ('textparser (compiled)',
+     textparser_compiled_time,
+     textparser_json.version()),
     ('lark (LALR)', lark_lalr_time, lark_json.version()),
     ('lark (Earley)', lark_earley_time, lark_json.version()),
     ('pyparsing', pyparsing_time, pyparsing_json.version()),
@@ -114,7 +119,7 @@ measurements = sorted(measurements, key=lambda m: m[1])
 print()
 print("Parsed '{}' {} time(s) in:".format(DATA_JSON, ITERATIONS))
 print()
-print('PACKAGE         SECONDS   RATIO  VERSION')
+print('PACKAGE                SECONDS   RATIO  VERSION')
 
 for package, seconds, version in measurements:
     try:
@@ -123,7 +128,7 @@ for package, seconds, version in measurements:
     except OverflowError:
         ratio = '  inf'
 
-    print('{:14s}  {:7.02f}  {}%  {}'.format(package,
+    print('{:21s}  {:7.02f}  {}%  {}'.format(package,
                                              seconds,
                                              ratio,
                                              version))
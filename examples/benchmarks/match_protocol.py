@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+
+"""A benchmark of the match protocols. Built-in patterns pass the
+token position to :func:`~textparser.Pattern.match_pos()` and return
+the position after the match. Patterns implementing only
+:func:`~textparser.Pattern.match()` keep the position in the tokens
+object instead, and backtrack by saving and restoring it, as all
+built-in patterns did before positions were passed.
+
+A JSON document barely backtracks, while a choice of statements
+starting with the same token kind backtracks in most statements. The
+texts are tokenized once before parsing.
+
+Example execution:
+
+$ env PYTHONPATH=. python3 examples/benchmarks/match_protocol.py
+Parsed each text 10 times, fastest of 50 rounds:
+
+GRAMMAR                SECONDS   RATIO
+json (position)           0.12    100%
+json (tokens)             0.13    107%
+statements (position)     0.19    100%
+statements (tokens)       0.20    104%
+$
+
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import timeit
+
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(SCRIPT_DIR, 'json'))
+
+import textparser
+from textparser import Grammar
+from textparser import Token
+from textparser import Forward
+from textparser import Sequence
+from textparser import Choice
+from textparser import ChoiceDict
+from textparser import ZeroOrMore
+from textparser import DelimitedList
+from textparser import Optional
+from textparser import MISMATCH
+from parsers import textparser_json
+
+
+DATA_JSON = os.path.join(SCRIPT_DIR, 'json', 'data.json')
+ITERATIONS = 10
+ROUNDS = 50
+STATEMENTS = 'a = 1; f(); b; c = 2;\n' * 2000
+
+
+class StatementsParser(textparser.Parser):
+
+    def token_specs(self):
+        return [
+            ('SKIP',             r'[ \r\n\t]+'),
+            ('NUMBER',           r'\d+'),
+            ('WORD',             r'[a-z]+'),
+            ('LPAREN',      '(', r'\('),
+            ('RPAREN',      ')', r'\)'),
+            ('SEMICOLON',   ';', r';'),
+            ('EQUAL',       '=', r'='),
+            ('MISMATCH',         r'.')
+        ]
+
+
+class TokensSequence(Sequence):
+
+    def match(self, tokens):
+        matched = []
+
+        for pattern in self.patterns:
+            mo = pattern.match(tokens)
+
+            if mo is MISMATCH:
+                return MISMATCH
+
+            matched.append(mo)
+
+        return matched
+
+
+class TokensChoice(Choice):
+
+    def match(self, tokens):
+        tokens.save()
+
+        for pattern in self._patterns:
+            tokens.mark_max_load()
+            mo = pattern.match(tokens)
+
+            if mo is not MISMATCH:
+                tokens.drop()
+
+                return mo
+
+        tokens.restore()
+
+        return MISMATCH
+
+
+class TokensChoiceDict(ChoiceDict):
+
+    def match(self, tokens):
+        try:
+            pattern = self._patterns_table[tokens.peek_kind_id()]
+        except LookupError:
+            return MISMATCH
+
+        if pattern is None:
+            return MISMATCH
+
+        return pattern.match(tokens)
+
+
+class TokensZeroOrMore(ZeroOrMore):
+
+    def match(self, tokens):
+        matched = []
+        tokens.save()
+
+        while True:
+            mo = self._pattern.match(tokens)
+
+            if mo is MISMATCH:
+                tokens.mark_max_restore()
+                break
+
+            matched.append(mo)
+            tokens.update()
+
+        return matched
+
+
+class TokensDelimitedList(DelimitedList):
+
+    def match(self, tokens):
+        mo = self._pattern.match(tokens)
+
+        if mo is MISMATCH:
+            return MISMATCH
+
+        matched = [mo]
+        tokens.save()
+
+        while True:
+            mo = self._delim.match(tokens)
+
+            if mo is MISMATCH:
+                break
+
+            mo = self._pattern.match(tokens)
+
+            if mo is MISMATCH:
+                break
+
+            matched.append(mo)
+            tokens.update()
+
+        tokens.restore()
+
+        return matched
+
+
+class TokensOptional(Optional):
+
+    def match(self, tokens):
+        tokens.save()
+        mo = self._pattern.match(tokens)
+
+        if mo is MISMATCH:
+            tokens.mark_max_restore()
+
+            return []
+        else:
+            tokens.drop()
+
+            return [mo]
+
+
+class TokensForward(Forward):
+
+    def match(self, tokens):
+        return self._pattern.match(tokens)
+
+
+def json_grammar(forward, sequence, choice, delimited_list, optional):
+    """Returns the grammar of the JSON benchmark parser created from
+    given pattern classes.
+
+    """
+
+    value = forward()
+    list_ = sequence('[', optional(delimited_list(value)), ']')
+    pair = sequence('ESCAPED_STRING', ':', value)
+    dict_ = sequence('{', optional(delimited_list(pair)), '}')
+    value <<= choice(list_,
+                     dict_,
+                     'ESCAPED_STRING',
+                     'NUMBER',
+                     'TRUE',
+                     'FALSE',
+                     'NULL')
+
+    return Grammar(value)
+
+
+def statements_grammar(zero_or_more, sequence, choice):
+    """Returns a grammar of statements created from given pattern
+    classes. All statements start with a word.
+
+    """
+
+    return Grammar(zero_or_more(choice(sequence('WORD', '=', 'NUMBER', ';'),
+                                       sequence('WORD', '(', ')', ';'),
+                                       sequence('WORD', ';'))))
+
+
+def tokenize(parser, text):
+    tokens = parser.tokenize(text)
+    del tokens[0]
+    tokens.append(Token('__EOF__', '__EOF__', len(text)))
+
+    return tokens
+
+
+def main():
+    with open(DATA_JSON, 'r') as fin:
+        json_tokens = tokenize(textparser_json.Parser(), fin.read())
+
+    statements_tokens = tokenize(StatementsParser(), STATEMENTS)
+    grammars = [
+        ('json (position)',
+         json_grammar(Forward,
+                      Sequence,
+                      ChoiceDict,
+                      DelimitedList,
+                      Optional),
+         json_tokens),
+        ('json (tokens)',
+         json_grammar(TokensForward,
+                      TokensSequence,
+                      TokensChoiceDict,
+                      TokensDelimitedList,
+                      TokensOptional),
+         json_tokens),
+        ('statements (position)',
+         statements_grammar(ZeroOrMore, Sequence, Choice),
+         statements_tokens),
+        ('statements (tokens)',
+         statements_grammar(TokensZeroOrMore, TokensSequence, TokensChoice),
+         statements_tokens)
+    ]
+
+    # Both protocols must give the same parse trees.
+    for i in range(0, len(grammars), 2):
+        _, position_grammar, tokens = grammars[i]
+        _, tokens_grammar, tokens = grammars[i + 1]
+
+        if position_grammar.parse(tokens) != tokens_grammar.parse(tokens):
+            sys.exit('Parse trees differ.')
+
+    # Alternate between the grammars and keep the fastest round of
+    # each, as the time of a round varies with the machine load.
+    results = [(name, float('inf')) for name, _, _ in grammars]
+
+    for _ in range(ROUNDS):
+        for i, (name, grammar, tokens) in enumerate(grammars):
+            seconds = timeit.timeit(lambda: grammar.parse(tokens),
+                                    number=ITERATIONS)
+            results[i] = (name, min(results[i][1], seconds))
+
+    print('Parsed each text {} times, fastest of {} rounds:'.format(
+        ITERATIONS,
+        ROUNDS))
+    print()
+    print('GRAMMAR                SECONDS   RATIO')
+
+    for i, (name, seconds) in enumerate(results):
+        print('{:21s}  {:7.02f}  {:5}%'.format(
+            name,
+            seconds,
+            int(round(100 * seconds / results[i - i % 2][1], 0))))
+
+
+if __name__ == '__main__':
+    main()
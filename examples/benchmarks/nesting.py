@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+
+"""A benchmark parsing deeply nested JSON lists, comparing recursive
+matching with matching using an explicit stack.
+
+Example execution:
+
+$ env PYTHONPATH=. python3 examples/benchmarks/nesting.py
+Parsed 10000 levels of nested lists:
+
+MATCHING        SECONDS  RESULT
+recursive             -  RecursionError
+explicit stack     0.13  ok
+
+Parsed 'examples/benchmarks/json/data.json' 1 time(s):
+
+MATCHING        SECONDS
+recursive          0.10
+explicit stack     0.13
+$
+
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import timeit
+
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(SCRIPT_DIR, 'json'))
+
+from parsers.textparser_json import Parser
+
+
+DATA_JSON = os.path.relpath(os.path.join(SCRIPT_DIR, 'json', 'data.json'))
+DEPTH = 10000
+ITERATIONS = 1
+
+
+def parse_time(json_string, recursive):
+    parser = Parser()
+
+    def _parse():
+        parser.parse(json_string, recursive=recursive)
+
+    return timeit.timeit(_parse, number=ITERATIONS)
+
+
+def nesting(json_string):
+    print('MATCHING        SECONDS  RESULT')
+
+    for name, recursive in [('recursive', True), ('explicit stack', False)]:
+        try:
+            seconds = '{:7.02f}'.format(parse_time(json_string, recursive))
+            result = 'ok'
+        except RecursionError:
+            seconds = '      -'
+            result = 'RecursionError'
+
+        print('{:14s}  {}  {}'.format(name, seconds, result))
+
+
+def speed(json_string):
+    print('MATCHING        SECONDS')
+
+    for name, recursive in [('recursive', True), ('explicit stack', False)]:
+        print('{:14s}  {:7.02f}'.format(name,
+                                        parse_time(json_string, recursive)))
+
+
+print('Parsed {} levels of nested lists:'.format(DEPTH))
+print()
+nesting(DEPTH * '[' + '1' + DEPTH * ']')
+print()
+
+with open(DATA_JSON, 'r') as fin:
+    JSON_STRING = fin.read()
+
+print("Parsed '{}' {} time(s):".format(DATA_JSON, ITERATIONS))
+print()
+speed(JSON_STRING)
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+
+"""A benchmark of the number of JSON documents parsed per second by
+Parser.parse_many() with process pool executors of a growing number
+of workers. The documents are the elements of the list in
+'examples/benchmarks/json/data.json', repeated. Each executor is
+created once and used for all calls, as in a long running service,
+and the workers are started before measuring.
+
+Example execution on a machine with one CPU:
+
+$ env PYTHONPATH=. python3 examples/benchmarks/parse_many.py
+Parsed 800 JSON documents of about 1 kbytes 5 times:
+
+PARSED IN         WORKERS  DOCUMENTS/SECOND
+calling thread          -              1191
+process pool            1              1054
+process pool            2              1012
+process pool            4               964
+$
+
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(SCRIPT_DIR, 'json'))
+
+from parsers.textparser_json import Parser
+
+
+DATA_JSON = os.path.join(SCRIPT_DIR, 'json', 'data.json')
+REPETITIONS = 4
+CALLS = 5
+CHUNKSIZE = 100
+
+
+def create_texts():
+    with open(DATA_JSON, 'r') as fin:
+        data = json.load(fin)
+
+    return REPETITIONS * [json.dumps(element) for element in data]
+
+
+def documents_per_second(parser, texts, executor=None):
+    start_time = time.time()
+
+    for _ in range(CALLS):
+        parser.parse_many(texts, executor, CHUNKSIZE)
+
+    end_time = time.time()
+
+    return CALLS * len(texts) / (end_time - start_time)
+
+
+def main():
+    texts = create_texts()
+    size = sum([len(text) for text in texts]) // len(texts)
+    parser = Parser()
+    results = [('calling thread', '-', documents_per_second(parser, texts))]
+
+    for workers in [1, 2, 4]:
+        with ProcessPoolExecutor(workers) as executor:
+            # Start the workers.
+            parser.parse_many(texts, executor, CHUNKSIZE)
+            results.append(('process pool',
+                            workers,
+                            documents_per_second(parser, texts, executor)))
+
+    print('Parsed {} JSON documents of about {} kbytes {} times:'.format(
+        len(texts),
+        (size + 512) // 1024,
+        CALLS))
+    print()
+    print('PARSED IN         WORKERS  DOCUMENTS/SECOND')
+
+    for name, workers, rate in results:
+        print('{:16s}  {:>7}  {:16}'.format(name, workers, int(rate)))
+
+
+if __name__ == '__main__':
+    main()
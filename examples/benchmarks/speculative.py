@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+
+"""A benchmark of trying parsers that fail to parse a minified JSON
+document, a single line of text. The error of each failed parser is
+discarded, as it usually is when parsers are tried
+speculatively. Eager formatting formats each error, as all errors
+did when created before formatting became lazy.
+
+Example execution:
+
+$ env PYTHONPATH=. python3 examples/benchmarks/speculative.py
+Tried 2 failing parsers 10000 times on a document of 211 kbytes:
+
+FORMATTING   SECONDS   RATIO
+eager           0.72    100%
+lazy            0.24     33%
+$
+
+"""
+
+from __future__ import print_function
+
+import os
+import json
+import timeit
+
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+
+import textparser
+from textparser import Forward
+from textparser import Sequence
+from textparser import ZeroOrMore
+from textparser import Optional
+from textparser import DelimitedList
+from textparser import choice
+
+
+DATA_JSON = os.path.join(SCRIPT_DIR, 'json', 'data.json')
+ITERATIONS = 10000
+
+
+class RecordsParser(textparser.Parser):
+    """Fails to tokenize JSON.
+
+    """
+
+    def token_specs(self):
+        return [
+            ('SKIP',             r'[ \r\n\t]+'),
+            ('NUMBER',           r'\d+'),
+            ('WORD',             r'[a-z]+'),
+            ('SEMICOLON',   ';', r';'),
+            ('MISMATCH',         r'.')
+        ]
+
+    def grammar(self):
+        return ZeroOrMore(Sequence('WORD', 'NUMBER', ';'))
+
+
+class ListParser(textparser.Parser):
+    """Fails to tokenize JSON objects.
+
+    """
+
+    def token_specs(self):
+        return [
+            ('SKIP',                r'[ \r\n\t]+'),
+            ('NUMBER',              r'-?\d+'),
+            ('ESCAPED_STRING',      r'"(\\"|[^"])*?"'),
+            ('LBRACKET',       '[', r'\['),
+            ('RBRACKET',       ']', r'\]'),
+            ('COMMA',          ',', r','),
+            ('MISMATCH',            r'.')
+        ]
+
+    def grammar(self):
+        value = Forward()
+        value <<= choice(Sequence('[', Optional(DelimitedList(value)), ']'),
+                         'ESCAPED_STRING',
+                         'NUMBER')
+
+        return value
+
+
+PARSERS = [RecordsParser(), ListParser()]
+
+
+def try_parsers(text, format_errors):
+    for parser in PARSERS:
+        try:
+            parser.parse(text, lazy=True)
+        except textparser.ParseError as e:
+            if format_errors:
+                str(e)
+
+
+def main():
+    with open(DATA_JSON, 'r') as fin:
+        text = json.dumps(json.load(fin), separators=(',', ':'))
+
+    # Build the tokenizers and grammars.
+    try_parsers(text, False)
+    results = []
+
+    for name, format_errors in [('eager', True), ('lazy', False)]:
+        results.append((name, timeit.timeit(
+            lambda: try_parsers(text, format_errors),
+            number=ITERATIONS)))
+
+    print('Tried {} failing parsers {} times on a document of {} '
+          'kbytes:'.format(len(PARSERS), ITERATIONS, len(text) // 1024))
+    print()
+    print('FORMATTING   SECONDS   RATIO')
+
+    for name, seconds in results:
+        print('{:10s}  {:8.02f}  {:5}%'.format(
+            name,
+            seconds,
+            int(round(100 * seconds / results[0][1], 0))))
+
+
+if __name__ == '__main__':
+    main()
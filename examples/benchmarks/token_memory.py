@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+
+"""A benchmark comparing the memory used by a list of tokens and a
+token array.
+
+Example execution:
+
+$ env PYTHONPATH=. python3 examples/benchmarks/token_memory.py
+Tokenized 'examples/benchmarks/json/data.json' (26782 tokens):
+
+STORE           KBYTES   RATIO  SECONDS
+array              471    100%     0.24
+list              3579    759%     0.26
+$
+
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import time
+import tracemalloc
+
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(SCRIPT_DIR, 'json'))
+
+from parsers.textparser_json import Parser
+
+
+DATA_JSON = os.path.relpath(os.path.join(SCRIPT_DIR, 'json', 'data.json'))
+
+
+def measure(tokenize, text):
+    """Returns the memory in bytes used by the tokens, and the time it
+    took to create them.
+
+    """
+
+    tracemalloc.start()
+    start_time = time.time()
+    tokens = tokenize(text)
+    end_time = time.time()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    return tokens, size, end_time - start_time
+
+
+with open(DATA_JSON, 'r') as fin:
+    JSON_STRING = fin.read()
+
+tokenizer = Parser().tokenizer()
+tokens, list_size, list_time = measure(tokenizer.tokenize, JSON_STRING)
+del tokens
+tokens, array_size, array_time = measure(tokenizer.tokenize_array,
+                                         JSON_STRING)
+
+print("Tokenized '{}' ({} tokens):".format(DATA_JSON, len(tokens)))
+print()
+print('STORE           KBYTES   RATIO  SECONDS')
+
+for name, size, seconds in [('array', array_size, array_time),
+                            ('list', list_size, list_time)]:
+    print('{:14s}  {:6}  {:5}%  {:7.02f}'.format(
+        name,
+        size // 1024,
+        int(round(100 * size / array_size, 0)),
+        seconds))
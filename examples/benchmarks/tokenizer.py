@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+
+"""A micro benchmark of the per call tokenizer overhead when
+tokenizing many small texts.
+
+Example execution:
+
+$ env PYTHONPATH=. python3 examples/benchmarks/tokenizer.py
+Tokenized a 27 characters text 100000 time(s) in:
+
+TOKENIZER       SECONDS   RATIO
+cached             2.53    100%
+rebuilt            4.25    168%
+$
+
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import timeit
+
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(SCRIPT_DIR, 'json'))
+
+from parsers.textparser_json import Parser
+from textparser import Tokenizer
+
+
+TEXT = '{"a": [1, 2.5, true, null]}'
+ITERATIONS = 100000
+
+
+def tokenize_cached(parser):
+    parser.tokenize(TEXT)
+
+
+def tokenize_rebuilt(parser):
+    # The tokenizer as it was built before it was cached by the
+    # parser class.
+    Tokenizer(parser.token_specs(), parser.keywords()).tokenize(TEXT)
+
+
+parser = Parser()
+cached_time = timeit.timeit(lambda: tokenize_cached(parser),
+                            number=ITERATIONS)
+rebuilt_time = timeit.timeit(lambda: tokenize_rebuilt(parser),
+                             number=ITERATIONS)
+
+print("Tokenized a {} characters text {} time(s) in:".format(len(TEXT),
+                                                            ITERATIONS))
+print()
+print('TOKENIZER       SECONDS   RATIO')
+
+for name, seconds in [('cached', cached_time), ('rebuilt', rebuilt_time)]:
+    print('{:14s}  {:7.02f}  {:5}%'.format(
+        name,
+        seconds,
+        int(round(100 * seconds / cached_time, 0))))
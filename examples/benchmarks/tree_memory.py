@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+
+"""A benchmark comparing the memory used by the parse tree of the JSON
+grammar, and of the same grammar shaped with Suppress, Flatten and
+Optional with a default value.
+
+Example execution:
+
+$ env PYTHONPATH=. python3 examples/benchmarks/tree_memory.py
+Parsed 'examples/benchmarks/json/data.json':
+
+GRAMMAR       TREE KBYTES  PEAK KBYTES  SECONDS
+shaped               1357         4401     0.30
+plain                1572         4615     0.36
+$
+
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import time
+import tracemalloc
+
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(SCRIPT_DIR, 'json'))
+
+from parsers.textparser_json import Parser
+
+from textparser import Forward
+from textparser import Sequence
+from textparser import DelimitedList
+from textparser import choice
+from textparser import Optional
+from textparser import Suppress
+from textparser import Flatten
+
+
+DATA_JSON = os.path.relpath(os.path.join(SCRIPT_DIR, 'json', 'data.json'))
+
+
+class ShapedParser(Parser):
+
+    def grammar(self):
+        value = Forward()
+        list_ = Sequence(Suppress('['),
+                         Flatten(Optional(DelimitedList(value), default=[])),
+                         Suppress(']'))
+        pair = Sequence('ESCAPED_STRING', Suppress(':'), value)
+        dict_ = Sequence(Suppress('{'),
+                         Flatten(Optional(DelimitedList(pair), default=[])),
+                         Suppress('}'))
+        value <<= choice(list_,
+                         dict_,
+                         'ESCAPED_STRING',
+                         'NUMBER',
+                         'TRUE',
+                         'FALSE',
+                         'NULL')
+
+        return value
+
+
+def measure(parser, text):
+    """Returns the memory in bytes used by the parse tree, the peak
+    memory in bytes used when parsing, and the time it took to parse.
+
+    """
+
+    tracemalloc.start()
+    start_time = time.time()
+    tree = parser.parse(text)
+    end_time = time.time()
+    size, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return tree, size, peak, end_time - start_time
+
+
+with open(DATA_JSON, 'r') as fin:
+    JSON_STRING = fin.read()
+
+# Create the grammars before measuring.
+plain_parser = Parser()
+plain_parser.parse('[]')
+shaped_parser = ShapedParser()
+shaped_parser.parse('[]')
+
+tree, plain_size, plain_peak, plain_time = measure(plain_parser, JSON_STRING)
+del tree
+tree, shaped_size, shaped_peak, shaped_time = measure(shaped_parser,
+                                                      JSON_STRING)
+
+print("Parsed '{}':".format(DATA_JSON))
+print()
+print('GRAMMAR       TREE KBYTES  PEAK KBYTES  SECONDS')
+
+for name, size, peak, seconds in [
+        ('shaped', shaped_size, shaped_peak, shaped_time),
+        ('plain', plain_size, plain_peak, plain_time)
+]:
+    print('{:12s}  {:11}  {:11}  {:7.02f}'.format(name,
+                                                  size // 1024,
+                                                  peak // 1024,
+                                                  seconds))
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+
+"""A benchmark comparing the time and memory used to parse and to
+validate a JSON document.
+
+Example execution:
+
+$ env PYTHONPATH=. python3 examples/benchmarks/validate.py
+Parsed 'examples/benchmarks/json/data.json' 10 time(s):
+
+METHOD          PEAK KBYTES  SECONDS
+parse                  2045     0.86
+validate                621     0.54
+$
+
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import timeit
+import tracemalloc
+
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(SCRIPT_DIR, 'json'))
+
+from parsers.textparser_json import Parser
+
+
+DATA_JSON = os.path.relpath(os.path.join(SCRIPT_DIR, 'json', 'data.json'))
+ITERATIONS = 10
+
+
+def parse(text):
+    Parser().parse(text, compact=True)
+
+
+def validate(text):
+    Parser().validate(text)
+
+
+def measure(function, text):
+    """Returns the peak memory in bytes used by given function, and the
+    time it took.
+
+    """
+
+    function(text)
+    tracemalloc.start()
+    function(text)
+    size = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return size, timeit.timeit(lambda: function(text), number=ITERATIONS)
+
+
+with open(DATA_JSON, 'r') as fin:
+    JSON_STRING = fin.read()
+
+print("Parsed '{}' {} time(s):".format(DATA_JSON, ITERATIONS))
+print()
+print('METHOD          PEAK KBYTES  SECONDS')
+
+for name, function in [('parse', parse), ('validate', validate)]:
+    size, seconds = measure(function, JSON_STRING)
+    print('{:14s}  {:11}  {:7.02f}'.format(name, size // 1024, seconds))
@@ -1,5 +1,16 @@
+import asyncio
+import io
+import multiprocessing
+import os
+import pickle
+import sys
 import unittest
+from concurrent.futures import Executor
+from concurrent.futures import Future
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
 from collections import namedtuple
+from functools import partial
 
 import textparser
 from textparser import Grammar
@@ -15,6 +26,7 @@ from textparser import DelimitedList
 from textparser import Token
 from textparser import TokenizeError
 from textparser import tokenize_init
+from textparser import Tokenizer
 from textparser import Any
 from textparser import AnyUntil
 from textparser import Optional
@@ -44,8 +56,377 @@ def tokenize(items, add_eof_token=True):
     return tokens
 
 
+class RecordsParser(textparser.Parser):
+
+    def token_specs(self):
+        return [
+            ('SKIP',        r'[ \r\n\t]+'),
+            ('NUMBER',      r'\d+'),
+            ('WORD',        r'[a-z]+'),
+            ('SEMI',   ';', r';'),
+            ('MISMATCH',    r'.')
+        ]
+
+    def grammar(self):
+        return ZeroOrMore(Sequence('WORD', 'NUMBER', ';'))
+
+
+class NonSeekableFile(object):
+    """A file object that can only be read at once.
+
+    """
+
+    def __init__(self, text):
+        self._text = text
+
+    def read(self):
+        return self._text
+
+
+UNPICKLED_PIDS = []
+
+
+class CountingParser(RecordsParser):
+    """Returns the number of times the parser was unpickled in the
+    process parsing the text, instead of the parse tree.
+
+    """
+
+    def __setstate__(self, state):
+        UNPICKLED_PIDS.append(os.getpid())
+        super(CountingParser, self).__setstate__(state)
+
+    def parse(self, text, token_tree=False, match_sof=False):
+        return UNPICKLED_PIDS.count(os.getpid())
+
+
+INTEGER_VALUE = textparser.register_function(
+    'test_textparser.integer_value',
+    lambda mo: int(mo))
+
+STATEMENT_KEY = textparser.register_function(
+    'test_textparser.statement_key',
+    lambda mo: mo[0].upper())
+
+
+def spawn_executor(workers):
+    """Returns a process pool executor of given number of workers, which
+    are started without copying this process, if supported.
+
+    """
+
+    if sys.version_info < (3, 7):
+        return ProcessPoolExecutor(workers)
+
+    return ProcessPoolExecutor(workers,
+                               mp_context=multiprocessing.get_context('spawn'))
+
+
+class ShippedParser(textparser.Parser):
+    """The grammar of this parser cannot be created in worker processes,
+    so it must be shipped to them.
+
+    """
+
+    compile_grammar = True
+
+    def token_specs(self):
+        return [
+            ('SKIP',              r'[ \r\n\t]+'),
+            ('INTEGER',           r'\d+'),
+            ('IDENTIFIER',        r'[a-z]+'),
+            ('LPAREN',       '(', r'\('),
+            ('RPAREN',       ')', r'\)'),
+            ('PLUS',         '+', r'\+'),
+            ('SEMI',         ';', r';'),
+            ('MISMATCH',          r'.')
+        ]
+
+    def grammar(self):
+        if multiprocessing.current_process().name != 'MainProcess':
+            raise Exception('Grammar created in a worker process.')
+
+        expression = Forward()
+        operand = choice(textparser.Action('INTEGER', INTEGER_VALUE),
+                         Sequence('(', expression, ')'))
+        expression <<= textparser.Expression(operand, [('+', 'left', 2)])
+
+        return ZeroOrMoreDict(Sequence('IDENTIFIER', expression, ';'),
+                              key=STATEMENT_KEY)
+
+
+class AsyncTexts(object):
+    """An asynchronous iterable of given texts.
+
+    """
+
+    def __init__(self, texts):
+        self._texts = iter(texts)
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        try:
+            return asyncio.sleep(0, result=next(self._texts))
+        except StopIteration:
+            raise StopAsyncIteration
+
+
+class GatedExecutor(Executor):
+    """Calls submitted functions in the event loop `loop`, the oldest
+    first, when `limit` functions are waiting, or all of the `count`
+    functions not yet called. `peak` is the largest number of functions
+    waiting at the same time.
+
+    """
+
+    def __init__(self, loop, limit, count):
+        self._loop = loop
+        self._limit = limit
+        self._count = count
+        self._waiting = []
+        self.peak = 0
+
+    def submit(self, function, *args, **kwargs):
+        future = Future()
+        self._waiting.append((partial(function, *args, **kwargs), future))
+        self.peak = max(self.peak, len(self._waiting))
+        self._call_when_full()
+
+        return future
+
+    def _call_when_full(self):
+        if self._waiting and len(self._waiting) == min(self._limit,
+                                                        self._count):
+            self._loop.call_soon(self._call)
+
+    def _call(self):
+        function, future = self._waiting.pop(0)
+        self._count -= 1
+        future.set_result(function())
+        self._call_when_full()
+
+
+def run_aiter(loop, aiterator):
+    """Returns a list of all items of given asynchronous iterator, and the
+    exception it raised, if any.
+
+    """
+
+    items = []
+
+    while True:
+        try:
+            items.append(loop.run_until_complete(aiterator.__anext__()))
+        except StopAsyncIteration:
+            return items, None
+        except Exception as e:
+            return items, e
+
+
+def create_grammars():
+    """Returns a list of grammars and token lists to parse with them. Used
+    to check that all parsing modes give the same parse trees and
+    errors.
+
+    """
+
+    value = Forward()
+    list_ = Sequence('[', Optional(DelimitedList(value)), ']')
+    value <<= choice(list_, Tag('number', 'NUMBER'), 'WORD')
+    shaped = Forward()
+    shaped <<= choice(
+        Sequence(textparser.Suppress('['),
+                 textparser.Flatten(Optional(DelimitedList(shaped),
+                                             default=[])),
+                 textparser.Suppress(']')),
+        Sequence(Optional('-', default=None),
+                 OneOrMore(textparser.Flatten(Sequence('NUMBER',
+                                                       textparser.Suppress(
+                                                           '.'))))),
+        'WORD')
+
+    operand = Forward()
+    expression = textparser.Expression(operand,
+                                       [('!', 'left', 1),
+                                        ('^', 'right', 2),
+                                        ('-', 'right', 1),
+                                        (['*', '/'], 'left', 2),
+                                        (['+', '-'], 'left', 2)])
+    operand <<= choice('NUMBER', Sequence('(', expression, ')'))
+
+    return [
+        (
+            Sequence('IF',
+                     choice(Sequence(choice('A', 'B'), 'STRING'), 'STRING'),
+                     'WORD',
+                     choice(Sequence(choice(DelimitedList('STRING'),
+                                            ZeroOrMore('NUMBER')),
+                                     '.'),
+                            '.')),
+            [
+                [('IF', 'IF'), ('STRING', 'foo'), ('WORD', 'bar'), ('.', '.')],
+                [('IF', 'IF'), ('A', 'A'), ('STRING', 'foo'), ('WORD', 'bar'),
+                 ('NUMBER', '0'), ('NUMBER', '100'), ('.', '.')],
+                [('IF', 'IF', 1), ('STRING', 'foo', 2), ('WORD', 'bar', 3),
+                 (',', ',', 4)],
+                [('IF', 'IF', 1), ('STRING', 'foo', 2), ('.', '.', 3)],
+                [('IF', 'IF', 1), ('NUMBER', '1', 2)],
+                [('IF', 'IF', 1), ('STRING', 'foo', 2), ('WORD', 'bar', 3),
+                 ('.', '.', 4), ('.', '.', 5)]
+            ]
+        ),
+        (
+            Choice(Sequence('NUMBER', 'WORD'), 'WORD'),
+            [
+                [('WORD', 'm')],
+                [('NUMBER', '1', 5)],
+                [('NUMBER', '1', 5), ('NUMBER', '2', 7)]
+            ]
+        ),
+        (
+            Sequence(DelimitedList('WORD'), Optional('.')),
+            [
+                [('WORD', 'foo'), (',', ','), ('WORD', 'bar'), ('.', '.')],
+                [('WORD', 'foo', 1), (',', ',', 2)],
+                [('WORD', 'foo', 1), ('.', '.', 2), ('.', '.', 3)]
+            ]
+        ),
+        (
+            Sequence(OneOrMoreDict(Sequence('WORD', 'NUMBER')),
+                     ZeroOrMoreDict(Sequence('NUMBER', 'WORD'))),
+            [
+                [('WORD', 'foo'), ('NUMBER', '1'), ('WORD', 'bar'),
+                 ('NUMBER', '2'), ('WORD', 'foo'), ('NUMBER', '3'),
+                 ('NUMBER', '4'), ('WORD', 'fie')],
+                [('NUMBER', '4', 3)],
+                [('WORD', 'foo', 1), ('NUMBER', '1', 2), ('WORD', 'bar', 3)]
+            ]
+        ),
+        (
+            Sequence(AnyUntil(Sequence('NUMBER', ';')),
+                     'NUMBER',
+                     ';',
+                     ZeroOrMore(Sequence(Not('WORD'), Any())),
+                     And('WORD'),
+                     OneOrMore('WORD')),
+            [
+                [('WORD', 'a'), ('NUMBER', '1'), ('WORD', 'b'),
+                 ('NUMBER', '2'), (';', ';'), ('.', '.'), ('WORD', 'c')],
+                [('NUMBER', '2', 1), (';', ';', 2), ('.', '.', 3)],
+                [('NUMBER', '2', 1), (';', ';', 2), ('WORD', 'c', 3),
+                 ('.', '.', 4)]
+            ]
+        ),
+        (
+            value,
+            [
+                [('[', '['), ('NUMBER', '1'), (',', ','), ('[', '['),
+                 ('WORD', 'a'), (',', ','), ('[', '['), (']', ']'), (']', ']'),
+                 (']', ']')],
+                [('[', '[', 1), ('NUMBER', '1', 2), (',', ',', 3),
+                 ('[', '[', 4), ('WORD', 'a', 5), (']', ']', 6)],
+                [('[', '[', 1), (',', ',', 2)],
+                [('NUMBER', '1', 1), ('NUMBER', '2', 2)]
+            ]
+        ),
+        (
+            ZeroOrMore(Choice(Sequence('option', 'WORD', '=', 'NUMBER', ';'),
+                              Sequence('option', 'WORD', '=', 'WORD', ';'),
+                              Sequence(Optional('repeated'), 'WORD', 'WORD',
+                                       ';'),
+                              Sequence('WORD', '=', 'NUMBER', ';'))),
+            [
+                [('option', 'option'), ('WORD', 'a'), ('=', '='),
+                 ('WORD', 'b'), (';', ';'), ('repeated', 'repeated'),
+                 ('WORD', 'c'), ('WORD', 'd'), (';', ';'), ('WORD', 'e'),
+                 ('=', '='), ('NUMBER', '1'), (';', ';')],
+                [('option', 'option', 1), ('WORD', 'a', 2), ('=', '=', 3),
+                 ('STRING', '"b"', 4), (';', ';', 5)],
+                [('WORD', 'a', 1), ('WORD', 'b', 2), ('NUMBER', '1', 3)]
+            ]
+        ),
+        (
+            Choice(Sequence('WORD', '=', 'NUMBER', ';'),
+                   Sequence('WORD', '=', textparser.Suppress('WORD')),
+                   Sequence('WORD', '=',
+                            textparser.Flatten(Sequence('NUMBER', 'WORD'))),
+                   Sequence('WORD'),
+                   Sequence('NUMBER', 'WORD'),
+                   Sequence('NUMBER')),
+            [
+                [('WORD', 'a'), ('=', '='), ('NUMBER', '1'), (';', ';')],
+                [('WORD', 'a'), ('=', '='), ('WORD', 'b')],
+                [('WORD', 'a'), ('=', '='), ('NUMBER', '1'), ('WORD', 'b')],
+                [('WORD', 'a')],
+                [('NUMBER', '1'), ('WORD', 'a')],
+                [('NUMBER', '1')],
+                [('WORD', 'a', 1), ('=', '=', 2), ('NUMBER', '1', 3),
+                 ('NUMBER', '2', 4)],
+                [('WORD', 'a', 1), ('=', '=', 2)],
+                [('NUMBER', '1', 1), ('NUMBER', '2', 2)]
+            ]
+        ),
+        (
+            shaped,
+            [
+                [('[', '['), ('-', '-'), ('NUMBER', '1'), ('.', '.'),
+                 ('NUMBER', '2'), ('.', '.'), (',', ','), ('[', '['),
+                 ('WORD', 'a'), (',', ','), ('[', '['), (']', ']'), (']', ']'),
+                 (']', ']')],
+                [('[', '[', 1), ('NUMBER', '1', 2), ('NUMBER', '2', 3)],
+                [('[', '[', 1), ('NUMBER', '1', 2), ('.', '.', 3),
+                 (']', ']', 4), ('WORD', 'a', 5)]
+            ]
+        ),
+        (
+            expression,
+            [
+                [('NUMBER', '1'), ('+', '+'), ('NUMBER', '2'), ('*', '*'),
+                 ('-', '-'), ('NUMBER', '3'), ('^', '^'), ('(', '('),
+                 ('NUMBER', '4'), ('-', '-'), ('NUMBER', '5'), (')', ')'),
+                 ('!', '!')],
+                [('NUMBER', '1', 1), ('+', '+', 2), ('NUMBER', '2', 3),
+                 ('*', '*', 4), ('(', '(', 5), ('NUMBER', '3', 6)],
+                [('-', '-', 1), ('+', '+', 2)],
+                [('NUMBER', '1', 1), ('NUMBER', '2', 2)]
+            ]
+        ),
+        (
+            NoMatch(),
+            [
+                [('NUMBER', '1', 3)]
+            ]
+        )
+    ]
+
+
 class TextParserTest(unittest.TestCase):
 
+    def assert_same_parse_results(self, parse):
+        """Parse all grammars returned by create_grammars() with `parse`,
+        and check that the results are the same as with
+        Grammar.parse().
+
+        """
+
+        for pattern, datas in create_grammars():
+            grammar = Grammar(pattern)
+
+            for tokens in datas:
+                for token_tree in [False, True]:
+                    try:
+                        expected = grammar.parse(tokenize(tokens), token_tree)
+                    except textparser.GrammarError as e:
+                        with self.assertRaises(textparser.GrammarError) as cm:
+                            parse(grammar, tokenize(tokens), token_tree)
+
+                        self.assertEqual(cm.exception.offset, e.offset)
+                    else:
+                        tree = parse(grammar, tokenize(tokens), token_tree)
+                        self.assertEqual(tree, expected)
+
     def parse_and_assert_tree(self, grammar, datas):
         for tokens, expected_tree in datas:
             tree = grammar.parse(tokenize(tokens))
@@ -144,6 +525,166 @@ class TextParserTest(unittest.TestCase):
 
         self.assertEqual(cm.exception.offset, 3)
 
+    def test_grammar_choice_dict_kind_ids(self):
+        grammar = Grammar(Sequence(ChoiceDict('KIND_ID_A', 'KIND_ID_B'),
+                                   ZeroOrMore(Any())))
+
+        datas = [
+            (
+                [('KIND_ID_B', 'b'), ('KIND_ID_NEVER_SEEN', 'c')],
+                ['b', ['c']]
+            ),
+            (
+                [('KIND_ID_A', 'a')],
+                ['a', []]
+            )
+        ]
+
+        self.parse_and_assert_tree(grammar, datas)
+        self.parse_and_assert_mismatch(
+            grammar,
+            [([('KIND_ID_NEVER_SEEN_EITHER', 'd', 3)], 3)])
+
+    def test_grammar_choice_dict_sparse_kind_ids(self):
+        for i in range(300):
+            textparser._kind_id('KIND_ID_SPARSE_{}'.format(i))
+
+        choice_dict = ChoiceDict('KIND_ID_SPARSE_A', 'NUMBER')
+        grammar = Grammar(choice_dict)
+
+        # A list indexed by the large kind id would be mostly empty.
+        self.assertIsInstance(choice_dict._patterns_table, dict)
+        self.parse_and_assert_tree(grammar,
+                                   [([('KIND_ID_SPARSE_A', 'a')], 'a'),
+                                    ([('NUMBER', '1')], '1')])
+        self.parse_and_assert_mismatch(
+            grammar,
+            [([('KIND_ID_SPARSE_299', 'b', 3)], 3)])
+
+    def test_grammar_choice_dispatch(self):
+        def kind_ids(*kinds):
+            return frozenset([textparser._kind_id(kind) for kind in kinds])
+
+        a = Sequence('A', 'B')
+        optional = Sequence(Optional('C'), 'D')
+        any_ = Sequence(Any(), 'E')
+        b = Sequence('B', 'A')
+        grammar = Grammar(Choice(a, optional, any_, b))
+        table, default = grammar._root._dispatch
+        a, optional, any_, b = grammar._root._patterns
+
+        self.assertEqual(table[textparser._kind_id('A')],
+                         ((a, False, None),
+                          (any_, False, kind_ids('C', 'D')),
+                          (None, True, kind_ids('B'))))
+        self.assertEqual(table[textparser._kind_id('B')],
+                         ((any_, False, kind_ids('A', 'C', 'D')),
+                          (b, True, None)))
+        self.assertEqual(table[textparser._kind_id('C')],
+                         ((optional, False, kind_ids('A')),
+                          (any_, False, None),
+                          (None, True, kind_ids('B'))))
+        self.assertEqual(default,
+                         ((any_, False, kind_ids('A', 'C', 'D')),
+                          (None, True, kind_ids('B'))))
+
+        datas = [
+            ([('B', 'b'), ('A', 'a')], ['b', 'a']),
+            ([('B', 'b'), ('E', 'e')], ['b', 'e']),
+            ([('D', 'd')], [[], 'd']),
+            ([('F', 'f'), ('E', 'e')], ['f', 'e'])
+        ]
+
+        self.parse_and_assert_tree(grammar, datas)
+        self.parse_and_assert_mismatch(
+            grammar,
+            [
+                ([('B', 'b', 1), ('B', 'b', 2)], 2),
+                ([('A', 'a', 1), ('C', 'c', 2)], 2),
+                ([('C', 'c', 1), ('C', 'c', 2)], 2)
+            ])
+
+    def test_grammar_choice_dispatch_expected(self):
+        # The kinds of skipped alternatives are expected as if they
+        # were tried, but not after a nullable alternative matched.
+        datas = [
+            (
+                Choice(Sequence(Not('A'), 'A'), 'B'),
+                [('A', 'a', 1)],
+                ['B']
+            ),
+            (
+                Sequence(Choice(Sequence('A', 'B'), Optional('C'), 'D'), 'E'),
+                [('F', 'f', 1)],
+                ['A', 'C', 'E']
+            ),
+            (
+                Sequence(Choice('A', Sequence('B', 'C'), 'D'), 'E'),
+                [('B', 'b', 1), ('F', 'f', 2)],
+                ['C']
+            )
+        ]
+
+        for pattern, tokens, expected in datas:
+            grammar = Grammar(pattern)
+
+            for parse in [grammar.parse,
+                          lambda tokens: grammar.parse(tokens,
+                                                       recursive=False),
+                          grammar.compile().parse]:
+                with self.assertRaises(textparser.GrammarError) as cm:
+                    parse(tokenize(tokens))
+
+                self.assertEqual(cm.exception.expected, frozenset(expected))
+
+            for inner in textparser._iter_patterns(grammar._root):
+                if isinstance(inner, Choice):
+                    inner._dispatch = None
+
+            with self.assertRaises(textparser.GrammarError) as cm:
+                grammar.parse(tokenize(tokens))
+
+            self.assertEqual(cm.exception.expected, frozenset(expected))
+
+    def test_grammar_choice_dispatch_lazy(self):
+        # No state specific to the grammar, so the patterns are used
+        # as they are.
+        sequence = Sequence('A', Optional('B'))
+        grammar = Grammar(sequence)
+
+        self.assertIs(grammar._root, sequence)
+
+        # Dispatch tables are created on first use.
+        choice = Choice(Sequence('A', 'B'), Sequence('B', 'A'))
+        grammar = Grammar(choice)
+
+        self.assertIsNone(grammar._prepared_root)
+        self.assertEqual(grammar.parse(tokenize([('B', 'b'), ('A', 'a')])),
+                         ['b', 'a'])
+
+        root = grammar._root
+
+        self.assertIsNot(root, choice)
+        self.assertIsNotNone(root._dispatch)
+        self.assertIsNone(choice._dispatch)
+        self.assertEqual(grammar.parse(tokenize([('A', 'a'), ('B', 'b')])),
+                         ['a', 'b'])
+        self.assertIs(grammar._root, root)
+
+    def test_grammar_choice_dispatch_same_results(self):
+        def parse(grammar, tokens, token_tree):
+            for pattern in textparser._iter_patterns(grammar._root):
+                if isinstance(pattern, Choice):
+                    pattern._dispatch = None
+
+            try:
+                return grammar.parse(tokens, token_tree)
+            finally:
+                textparser._install_choice_dispatch(
+                    textparser._FirstSets(grammar._root))
+
+        self.assert_same_parse_results(parse)
+
     def test_grammar_choice_dict_init(self):
         datas = [
             (
@@ -400,6 +941,37 @@ class TextParserTest(unittest.TestCase):
 
         self.parse_and_assert_tree(grammar, datas)
 
+    def test_grammar_string_repetitions(self):
+        grammar = Grammar(Sequence(ZeroOrMore('WORD'),
+                                   textparser.Repeated('NUMBER', 2),
+                                   DelimitedList('WORD'),
+                                   AnyUntil(';'),
+                                   ';'))
+        tokens = [
+            ('WORD', 'a'), ('WORD', 'b'), ('NUMBER', '1'), ('NUMBER', '2'),
+            ('WORD', 'c'), (',', ','), ('WORD', 'd'), (',', ','),
+            ('NUMBER', '3'), (';', ';')
+        ]
+        mismatch_tokens = [
+            ('WORD', 'a', 1), ('NUMBER', '1', 2), ('WORD', 'b', 3)
+        ]
+        parsers = [
+            grammar.parse,
+            grammar.compile().parse,
+            lambda tokens: grammar.parse(tokens, recursive=False),
+            lambda tokens: grammar.parse(iter(tokens))
+        ]
+
+        for parse in parsers:
+            self.assertEqual(parse(tokenize(tokens)),
+                             [['a', 'b'], ['1', '2'], ['c', 'd'], [',', '3'],
+                              ';'])
+
+            with self.assertRaises(textparser.GrammarError) as cm:
+                parse(tokenize(mismatch_tokens))
+
+            self.assertEqual(cm.exception.offset, 3)
+
     def test_grammar_1(self):
         grammar = Grammar(Sequence(
             'IF',
@@ -643,6 +1215,48 @@ class TextParserTest(unittest.TestCase):
 
         self.parse_and_assert_mismatch(grammar, datas)
 
+    def test_grammar_packrat(self):
+        for packrat in [True,
+                        textparser.Packrat(window=1),
+                        textparser.Packrat(window=100),
+                        textparser.Packrat(size=1),
+                        textparser.Packrat(size=100)]:
+            def parse(grammar, tokens, token_tree):
+                return grammar.parse(tokens, token_tree, packrat=packrat)
+
+            self.assert_same_parse_results(parse)
+
+    def test_grammar_packrat_memoizes(self):
+        matches = []
+
+        class Counted(textparser.Pattern):
+
+            def match(self, tokens):
+                matches.append(tokens._pos)
+
+                return tokens.get_value()
+
+        prefix = Sequence('WORD', Counted())
+        grammar = Grammar(Choice(Sequence(prefix, 'A'),
+                                 Sequence(prefix, 'B'),
+                                 Sequence(prefix, 'C')))
+        tokens = [('WORD', 'a'), ('NUMBER', '1'), ('C', 'c')]
+
+        self.assertEqual(grammar.parse(tokenize(tokens)),
+                         [['a', '1'], 'c'])
+        self.assertEqual(matches, [1, 1, 1])
+        del matches[:]
+        self.assertEqual(grammar.parse(tokenize(tokens), packrat=True),
+                         [['a', '1'], 'c'])
+        self.assertEqual(matches, [1])
+
+    def test_packrat_settings(self):
+        with self.assertRaises(textparser.Error) as cm:
+            textparser.Packrat(window=1, size=1)
+
+        self.assertEqual(str(cm.exception),
+                         'Only one of window and size may be given.')
+
     def test_parse_start_and_end_of_file(self):
         class Parser(textparser.Parser):
 
@@ -672,6 +1286,565 @@ class TextParserTest(unittest.TestCase):
 
         self.assertEqual(Parser().parse('', match_sof=False), '__EOF__')
 
+    def test_grammar_not_recursive(self):
+        def parse(grammar, tokens, token_tree):
+            return grammar.parse(tokens, token_tree, recursive=False)
+
+        self.assert_same_parse_results(parse)
+
+        def parse(grammar, tokens, token_tree):
+            return grammar.parse(tokens,
+                                 token_tree,
+                                 packrat=True,
+                                 recursive=False)
+
+        self.assert_same_parse_results(parse)
+
+    def test_grammar_not_recursive_deep_nesting(self):
+        value = Forward()
+        list_ = Sequence('[', Optional(DelimitedList(value)), ']')
+        value <<= choice(list_, 'NUMBER')
+        grammar = Grammar(value)
+        depth = 10000
+        tokens = tokenize([('[', '[')] * depth
+                          + [('NUMBER', '1')]
+                          + [(']', ']')] * depth)
+
+        with self.assertRaises(RecursionError):
+            grammar.parse(tokens)
+
+        tree = grammar.parse(tokens, recursive=False)
+
+        for _ in range(depth):
+            self.assertEqual(tree[0], '[')
+            self.assertEqual(tree[2], ']')
+            tree = tree[1][0][0]
+
+        self.assertEqual(tree, '1')
+
+        tokens[-2] = Token('NUMBER', '2', 5)
+
+        with self.assertRaises(textparser.GrammarError) as cm:
+            grammar.parse(tokens, recursive=False)
+
+        self.assertEqual(cm.exception.offset, 5)
+
+    def test_grammar_match_pos(self):
+        class Twice(textparser.Pattern):
+
+            def __init__(self, pattern):
+                self._pattern = pattern
+
+            def match_pos(self, tokens, pos):
+                matched = []
+
+                for _ in range(2):
+                    pos, mo = self._pattern.match_pos(tokens, pos)
+
+                    if mo is textparser.MISMATCH:
+                        return pos, mo
+
+                    matched.append(mo)
+
+                return pos, matched
+
+        class Reversed(Sequence):
+
+            def match_pos(self, tokens, pos):
+                pos, mo = super(Reversed, self).match_pos(tokens, pos)
+
+                if mo is not textparser.MISMATCH:
+                    mo = mo[::-1]
+
+                return pos, mo
+
+        class Legacy(textparser.Pattern):
+
+            def __init__(self, pattern):
+                self._pattern = pattern
+
+            def match(self, tokens):
+                return self._pattern.match(tokens)
+
+        grammar = Grammar(Sequence(Legacy(Twice(Reversed('WORD', 'NUMBER'))),
+                                   Optional('.')))
+        tokens = [('WORD', 'a'), ('NUMBER', '1'), ('WORD', 'b'),
+                  ('NUMBER', '2')]
+
+        for recursive in [True, False]:
+            for parse in [grammar.parse, grammar.compile().parse]:
+                self.assertEqual(parse(tokenize(tokens), recursive=recursive),
+                                 [[['1', 'a'], ['2', 'b']], []])
+
+                with self.assertRaises(textparser.GrammarError) as cm:
+                    parse(tokenize([('WORD', 'a', 1), ('NUMBER', '1', 2),
+                                    ('WORD', 'b', 3), ('WORD', 'c', 4)]),
+                          recursive=recursive)
+
+                self.assertEqual(cm.exception.offset, 4)
+
+    def test_grammar_recover(self):
+        statement = Sequence('WORD', '=', 'NUMBER', ';')
+        grammar = Grammar(ZeroOrMore(textparser.Recover(statement, ';')))
+        tokens = [
+            ('WORD', 'a', 0), ('=', '=', 2), (';', ';', 4),
+            ('WORD', 'b', 6), ('=', '=', 8), ('NUMBER', '2', 10),
+            (';', ';', 11),
+            ('NUMBER', '3', 13), (';', ';', 14),
+            ('WORD', 'c', 16), ('=', '=', 18), ('NUMBER', '4', 20),
+            (';', ';', 21)
+        ]
+
+        for parse_recover in [grammar.parse_recover,
+                              grammar.compile().parse_recover]:
+            for tokens_ in [tokenize(tokens), iter(tokenize(tokens))]:
+                tree, errors = parse_recover(tokens_)
+
+                self.assertEqual(tree,
+                                 [None,
+                                  ['b', '=', '2', ';'],
+                                  None,
+                                  ['c', '=', '4', ';']])
+                self.assertEqual([error.offset for error in errors], [4, 13])
+
+        # Recovery is opt-in.
+        with self.assertRaises(textparser.GrammarError) as cm:
+            grammar.parse(tokenize(tokens))
+
+        self.assertEqual(cm.exception.offset, 4)
+
+        # Unrecovered errors end the list.
+        tree, errors = grammar.parse_recover(
+            tokenize([('WORD', 'a', 0), ('=', '=', 2)]))
+
+        self.assertEqual(tree, [None])
+        self.assertEqual([error.offset for error in errors], [-1])
+
+        tree, errors = grammar.parse_recover(tokenize(tokens[3:7]))
+
+        self.assertEqual(tree, [['b', '=', '2', ';']])
+        self.assertEqual(errors, [])
+
+    def test_grammar_recover_shared(self):
+        recover = textparser.Recover(Sequence('WORD', 'NUMBER'), ';')
+        grammar = Grammar(ZeroOrMore(recover))
+        Grammar(Sequence(ZeroOrMore(recover), 'END'))
+        tokens = [('WORD', 'a', 0), ('NUMBER', '1', 2), ('END', 'end', 4)]
+
+        # END may only follow the recovered pattern in the second
+        # grammar.
+        tree, errors = grammar.parse_recover(tokenize(tokens))
+
+        self.assertEqual(tree, [['a', '1'], None])
+        self.assertEqual([error.offset for error in errors], [4])
+
+    def test_grammar_recognize(self):
+        for pattern, datas in create_grammars():
+            grammar = Grammar(pattern)
+
+            for tokens in datas:
+                try:
+                    grammar.parse(tokenize(tokens))
+                except textparser.GrammarError as e:
+                    with self.assertRaises(textparser.GrammarError) as cm:
+                        grammar.recognize(tokenize(tokens))
+
+                    self.assertEqual(cm.exception.offset, e.offset)
+                else:
+                    self.assertIs(grammar.recognize(tokenize(tokens)), True)
+
+    def test_grammar_recognize_repeated_dict_minimum(self):
+        grammar = Grammar(textparser.RepeatedDict('WORD', minimum=2))
+
+        self.assertTrue(grammar.recognize(tokenize([('WORD', 'a'),
+                                                    ('WORD', 'b')])))
+
+        for parse in [grammar.parse, grammar.recognize]:
+            with self.assertRaises(textparser.GrammarError) as cm:
+                parse(tokenize([('WORD', 'a', 1), ('WORD', 'a', 2)]))
+
+            self.assertEqual(cm.exception.offset, -1)
+
+    def test_parser_validate(self):
+        class Parser(textparser.Parser):
+
+            def token_specs(self):
+                return [
+                    ('SKIP',        r'[ \r\n\t]+'),
+                    ('NUMBER',      r'\d+'),
+                    ('COMMA',  ',', r','),
+                    ('MISMATCH',    r'.')
+                ]
+
+            def grammar(self):
+                return DelimitedList('NUMBER')
+
+        self.assertTrue(Parser().validate('1, 2'))
+
+        for text, offset in [('1, 2 3', 5), ('1, a', 3)]:
+            with self.assertRaises(textparser.ParseError) as cm:
+                Parser().validate(text)
+
+            self.assertEqual(cm.exception.offset, offset)
+
+    def test_grammar_action(self):
+        value = Forward()
+        list_ = textparser.Action(
+            Sequence('[', Optional(DelimitedList(value)), ']'),
+            lambda mo: mo[1][0] if mo[1] else [])
+        pair = Sequence('STRING', ':', value)
+        dict_ = textparser.Action(
+            Sequence('{', Optional(DelimitedList(pair)), '}'),
+            lambda mo: {k: v for k, _, v in (mo[1][0] if mo[1] else [])})
+        number = textparser.Action('NUMBER', float)
+        value <<= choice(list_, dict_, number)
+        grammar = Grammar(value)
+        tokens = [('{', '{'), ('STRING', 'a'), (':', ':'), ('[', '['),
+                  ('NUMBER', '1'), (',', ','), ('{', '{'), ('}', '}'),
+                  (']', ']'), ('}', '}')]
+
+        self.assertFalse(number._deferred)
+        self.assertFalse(list_._deferred)
+        self.assertFalse(dict_._deferred)
+
+        for parse in [grammar.parse, grammar.compile().parse]:
+            for kwargs in [{}, {'recursive': False}, {'packrat': True}]:
+                self.assertEqual(parse(tokenize(tokens), **kwargs),
+                                 {'a': [1.0, {}]})
+
+        self.assertTrue(grammar.recognize(tokenize(tokens)))
+
+    def test_grammar_action_not_called_on_backtracking(self):
+        calls = []
+
+        def action(mo):
+            calls.append(mo)
+
+            return mo.upper()
+
+        a = textparser.Action('A', action)
+        grammar = Grammar(Sequence(Choice(Sequence(a, 'B'),
+                                          Sequence('A', 'C'),
+                                          Sequence(a, 'D')),
+                                   And(a),
+                                   Optional(Sequence(a, 'B')),
+                                   ZeroOrMore(textparser.Action(
+                                       Sequence('A', 'E'),
+                                       lambda mo: mo[1]))))
+        tokens = [('A', 'a'), ('D', 'd'), ('A', 'a'), ('E', 'e')]
+        actions = [
+            pattern
+            for pattern in textparser._iter_patterns(grammar._root)
+            if isinstance(pattern, textparser.Action)
+            and pattern.function is action
+        ]
+
+        self.assertEqual(len(actions), 1)
+        self.assertTrue(actions[0]._deferred)
+        self.assertFalse(a._deferred)
+
+        for parse in [grammar.parse, grammar.compile().parse]:
+            for kwargs in [{}, {'recursive': False}, {'packrat': True}]:
+                del calls[:]
+                self.assertEqual(parse(tokenize(tokens), **kwargs),
+                                 [['A', 'd'], [], [], ['e']])
+                self.assertEqual(calls, ['a'])
+
+        del calls[:]
+
+        with self.assertRaises(textparser.GrammarError):
+            grammar.parse(tokenize([('A', 'a'), ('E', 'e')]))
+
+        self.assertEqual(calls, [])
+
+    def test_grammar_suppress_and_flatten(self):
+        value = Forward()
+        list_ = Sequence(textparser.Suppress('['),
+                         textparser.Flatten(Optional(DelimitedList(value),
+                                                     default=[])),
+                         textparser.Suppress(']'))
+        pair = Sequence('STRING', textparser.Suppress(':'), value)
+        dict_ = Sequence(textparser.Suppress('{'),
+                         Optional(DelimitedList(pair), default=[]),
+                         textparser.Suppress('}'))
+        value <<= choice(list_,
+                         dict_,
+                         Sequence(Optional('-', default='+'), 'NUMBER'))
+        grammar = Grammar(
+            Sequence(value,
+                     ZeroOrMore(textparser.Suppress(';')),
+                     DelimitedList(textparser.Flatten(Sequence('NUMBER',
+                                                               'NUMBER'))),
+                     textparser.Suppress(Optional('.'))))
+        tokens = [('{', '{'), ('STRING', 'a'), (':', ':'), ('[', '['),
+                  ('-', '-'), ('NUMBER', '1'), (',', ','), ('[', '['),
+                  (']', ']'), (']', ']'), (',', ','), ('STRING', 'b'),
+                  (':', ':'), ('NUMBER', '2'), ('}', '}'), (';', ';'),
+                  (';', ';'), ('NUMBER', '3'), ('NUMBER', '4'), (',', ','),
+                  ('NUMBER', '5'), ('NUMBER', '6')]
+
+        for parse in [grammar.parse, grammar.compile().parse]:
+            for kwargs in [{}, {'recursive': False}, {'packrat': True}]:
+                self.assertEqual(
+                    parse(tokenize(tokens), **kwargs),
+                    [
+                        [
+                            [['a', [['-', '1'], []]], ['b', ['+', '2']]]
+                        ],
+                        [],
+                        ['3', '4', '5', '6']
+                    ])
+
+        self.assertTrue(grammar.recognize(tokenize(tokens)))
+
+        # Standalone.
+        grammar = Grammar(textparser.Suppress(Sequence('NUMBER', 'NUMBER')))
+        self.assertEqual(grammar.parse(tokenize([('NUMBER', '1'),
+                                                 ('NUMBER', '2')])),
+                         [])
+
+        grammar = Grammar(textparser.Flatten(Sequence('NUMBER', 'NUMBER')))
+        self.assertEqual(grammar.parse(tokenize([('NUMBER', '1'),
+                                                 ('NUMBER', '2')])),
+                         ['1', '2'])
+
+        # A minimum number of matches, not values.
+        grammar = Grammar(OneOrMore(textparser.Suppress('NUMBER')))
+        self.assertEqual(grammar.parse(tokenize([('NUMBER', '1')])), [])
+        self.assertEqual(grammar.compile().parse(tokenize([('NUMBER', '1')])),
+                         [])
+
+        with self.assertRaises(textparser.GrammarError):
+            grammar.parse(tokenize([]))
+
+    def test_grammar_expression(self):
+        grammar = Grammar(textparser.Expression('NUMBER',
+                                                [('!', 'left', 1),
+                                                 ('^', 'right', 2),
+                                                 ('-', 'right', 1),
+                                                 (['*', '/'], 'left', 2),
+                                                 (['+', '-'], 'left', 2)]))
+        datas = [
+            ('1', '1'),
+            ('1 + 2 - 3', [['1', '+', '2'], '-', '3']),
+            ('1 ^ 2 ^ 3', ['1', '^', ['2', '^', '3']]),
+            ('1 + 2 * 3', ['1', '+', ['2', '*', '3']]),
+            ('1 * 2 + 3', [['1', '*', '2'], '+', '3']),
+            ('- 1 ^ 2', ['-', ['1', '^', '2']]),
+            ('- 1 * 2', [['-', '1'], '*', '2']),
+            ('- - 1 !', ['-', ['-', ['1', '!']]]),
+            ('1 ! ^ 2 !', [['1', '!'], '^', ['2', '!']]),
+            ('2 ^ - 3', ['2', '^', ['-', '3']]),
+            ('1 + - 2 * 3 ^ 4', ['1', '+', [['-', '2'], '*', ['3', '^', '4']]])
+        ]
+
+        for text, expected in datas:
+            tokens = [('NUMBER', kind) if kind.isdigit() else (kind, kind)
+                      for kind in text.split()]
+
+            for parse in [grammar.parse, grammar.compile().parse]:
+                for kwargs in [{}, {'recursive': False}, {'packrat': True}]:
+                    self.assertEqual(parse(tokenize(tokens), **kwargs),
+                                     expected)
+
+            self.assertTrue(grammar.recognize(tokenize(tokens)))
+
+        grammar = Grammar(Sequence(textparser.Expression('NUMBER',
+                                                         [('+', 'left', 2)]),
+                                   Optional(Sequence('+', 'WORD'))))
+        self.assertEqual(
+            grammar.parse(tokenize([('NUMBER', '1'), ('+', '+'),
+                                    ('NUMBER', '2'), ('+', '+'),
+                                    ('WORD', 'a')])),
+            [['1', '+', '2'], [['+', 'a']]])
+
+        with self.assertRaises(textparser.Error) as cm:
+            textparser.Expression('NUMBER', [('+', 'middle', 2)])
+
+        self.assertEqual(
+            str(cm.exception),
+            "Operator associativity must be 'left' or 'right', not middle.")
+
+        with self.assertRaises(textparser.Error) as cm:
+            textparser.Expression('NUMBER', [('+', 'left', 3)])
+
+        self.assertEqual(str(cm.exception),
+                         'Operator arity must be 1 or 2, not 3.')
+
+    def test_grammar_optimize(self):
+        def parse(grammar, tokens, token_tree):
+            return grammar.optimize().parse(tokens, token_tree)
+
+        self.assert_same_parse_results(parse)
+
+        def parse(grammar, tokens, token_tree):
+            return grammar.optimize().compile().parse(tokens, token_tree)
+
+        self.assert_same_parse_results(parse)
+
+        def parse(grammar, tokens, token_tree):
+            return grammar.optimize().parse(tokens, token_tree, recursive=False)
+
+        self.assert_same_parse_results(parse)
+
+    def test_grammar_optimize_rewrites(self):
+        value = Forward()
+        value <<= Sequence(Choice(Choice('A', Tag('b', 'B'))),
+                           textparser.Flatten(Sequence('C', Choice('D'))),
+                           textparser.Suppress(Sequence('E', 'F')),
+                           Choice(Sequence('G', 'H')),
+                           Choice())
+        grammar = Grammar(value)
+        optimized = grammar.optimize()
+        root = optimized._root
+
+        self.assertIs(type(root), Sequence)
+        self.assertIs(type(root.patterns[0]), ChoiceDict)
+        self.assertEqual(root.patterns[1].kind, 'C')
+        self.assertIs(type(root.patterns[2]), Choice)
+        self.assertIs(type(root.patterns[3]), textparser.Suppress)
+        self.assertIs(type(root.patterns[4]), textparser.Suppress)
+        self.assertIs(type(root.patterns[5]), Choice)
+        self.assertIs(type(root.patterns[6]), NoMatch)
+        self.assertIs(type(grammar._root), Forward)
+
+        # Strings of the same kind are merged.
+        grammar = Grammar(Sequence('A', ZeroOrMore(Sequence('A', 'B'))))
+        root = grammar.optimize()._root
+        self.assertIs(root.patterns[0], root.patterns[1]._pattern.patterns[0])
+
+        self.assertIs(type(grammar.compile().optimize()),
+                      textparser.CompiledGrammar)
+
+        # The error offset would change if this choice was removed.
+        grammar = Grammar(Sequence(Choice(Sequence('A', Choice('B'))), 'C'))
+        root = grammar.optimize()._root
+        self.assertIs(type(root.patterns[0]), Choice)
+        self.assertIs(type(root.patterns[0]._patterns[0].patterns[1]), Choice)
+
+    def test_grammar_compile(self):
+        def parse(grammar, tokens, token_tree):
+            return grammar.compile().parse(tokens, token_tree)
+
+        self.assert_same_parse_results(parse)
+
+    def test_grammar_compile_left_factoring(self):
+        grammar = Grammar(
+            ZeroOrMore(Choice(Sequence('option', 'WORD', '=', 'NUMBER', ';'),
+                              Sequence('option', 'WORD', '=', 'WORD', ';'),
+                              Sequence('WORD', '=', 'NUMBER', ';'))))
+        source = grammar.compile().source()
+
+        # The common prefix of the first two alternatives is matched
+        # once.
+        self.assertRegex(source, r'def r\d+g\d+\(\):')
+        self.assertEqual(source.count('p2 = '), 1)
+
+        tokens = [
+            ('option', 'option', 1), ('WORD', 'a', 2), ('=', '=', 3),
+            ('WORD', 'b', 4), (';', ';', 5), ('WORD', 'c', 6), ('=', '=', 7),
+            ('NUMBER', '1', 8), (';', ';', 9)
+        ]
+
+        self.assertEqual(grammar.compile().parse(tokenize(tokens)),
+                         [['option', 'a', '=', 'b', ';'],
+                          ['c', '=', '1', ';']])
+
+        tokens = tokens[:3] + [('STRING', 'b', 4)]
+
+        with self.assertRaises(textparser.GrammarError) as cm:
+            grammar.compile().parse(tokenize(tokens))
+
+        self.assertEqual(cm.exception.offset, 4)
+
+    def test_grammar_compile_user_pattern(self):
+        class AnyAsNone(textparser.Pattern):
+
+            def match(self, tokens):
+                tokens.get_value()
+
+                return None
+
+        class Word(textparser.Sequence):
+
+            def match(self, tokens):
+                mo = super(Word, self).match(tokens)
+
+                if mo is not textparser.MISMATCH:
+                    mo = mo[0].upper()
+
+                return mo
+
+        grammar = Grammar(Sequence(Word('WORD'),
+                                   AnyAsNone(),
+                                   Optional(Word('WORD')))).compile()
+        tokens = [('WORD', 'a'), ('NUMBER', '1'), ('WORD', 'b')]
+
+        self.assertEqual(grammar.parse(tokenize(tokens)), ['A', None, ['B']])
+
+        with self.assertRaises(textparser.GrammarError) as cm:
+            grammar.parse(tokenize([('NUMBER', '1', 4)]))
+
+        self.assertEqual(cm.exception.offset, 4)
+
+    def test_parser_compile_grammar(self):
+        class Parser(textparser.Parser):
+
+            compile_grammar = True
+
+            def token_specs(self):
+                return [
+                    ('SKIP',        r'[ \r\n\t]+'),
+                    ('NUMBER',      r'\d+'),
+                    ('WORD',        r'[a-z]+'),
+                    ('COMMA',  ',', r','),
+                    ('MISMATCH',    r'.')
+                ]
+
+            def grammar(self):
+                return DelimitedList(Tag('item', choice('NUMBER', 'WORD')))
+
+        parser = Parser()
+        grammar = parser.compiled_grammar()
+
+        self.assertIsInstance(grammar, textparser.CompiledGrammar)
+        self.assertIn('def parse(', grammar.source())
+
+        for kwargs in [{}, {'lazy': True}, {'compact': True}]:
+            self.assertEqual(parser.parse('1, a', **kwargs),
+                             [('item', '1'), ('item', 'a')])
+            tree = parser.parse('1, a', token_tree=True, **kwargs)
+            self.assertEqual(tree[1], ('item', Token('WORD', 'a', 3)))
+
+            with self.assertRaises(textparser.ParseError) as cm:
+                parser.parse('1, a b', **kwargs)
+
+            self.assertEqual(cm.exception.offset, 5)
+
+    def test_parser_optimize_grammar(self):
+        class Parser(textparser.Parser):
+
+            optimize_grammar = True
+
+            def token_specs(self):
+                return [
+                    ('SKIP',        r'[ \r\n\t]+'),
+                    ('WORD',        r'[a-z]+'),
+                    ('COMMA',  ',', r','),
+                    ('MISMATCH',    r'.')
+                ]
+
+            def grammar(self):
+                words = Forward()
+                words <<= DelimitedList('WORD')
+
+                return words
+
+        parser = Parser()
+
+        self.assertIs(type(parser.compiled_grammar()._root), DelimitedList)
+        self.assertEqual(parser.parse('a, b'), ['a', 'b'])
+
     def test_grammar_none(self):
         class AnyAsNone(textparser.Pattern):
 
@@ -743,6 +1916,676 @@ class TextParserTest(unittest.TestCase):
                              [Token(kind='__SOF__', value='__SOF__', offset=0)])
             self.assertEqual(re_token, expected_re_token)
 
+    def test_tokenizer(self):
+        tokenizer = Tokenizer([
+            ('SKIP',               r'[ \r\n\t]+'),
+            ('NUMBER',             r'-?\d+(\.\d+)?'),
+            ('DOT',           '.', r'\.'),
+            ('WORD',               r'[A-Za-z0-9_]+'),
+            ('MISMATCH',           r'.')
+        ],
+                              ['IF', 'DOT'])
+
+        self.assertEqual(tokenizer.tokenize('IF 1.5 foo . DOT'),
+                         [
+                             Token(kind='__SOF__', value='__SOF__', offset=0),
+                             Token(kind='IF', value='IF', offset=0),
+                             Token(kind='NUMBER', value='1.5', offset=3),
+                             Token(kind='WORD', value='foo', offset=7),
+                             Token(kind='.', value='.', offset=11),
+                             Token(kind='.', value='DOT', offset=13)
+                         ])
+
+        with self.assertRaises(TokenizeError) as cm:
+            tokenizer.tokenize('foo !')
+
+        self.assertEqual(cm.exception.offset, 4)
+
+        # The kind ids are found by the tokenizer when parsing.
+        text = 'IF 1.5 foo . DOT'
+
+        for match_sof in [False, True]:
+            tokens = tokenizer._tokenize_ids(text, match_sof)
+            expected = tokenizer.tokenize(text)
+            expected.append(Token('__EOF__', '__EOF__', len(text)))
+
+            if not match_sof:
+                del expected[0]
+
+            self.assertEqual(tokens.tokens, expected)
+            self.assertEqual(tokens.kind_ids,
+                             [textparser._kind_id(token.kind)
+                              for token in expected])
+
+    def test_parser_tokenizer_cache(self):
+        class Parser(textparser.Parser):
+
+            def grammar(self):
+                return 'WORD'
+
+        class SubParser(Parser):
+
+            def token_specs(self):
+                return [('NUMBER', r'\d+')]
+
+        tokenizer = Parser().tokenizer()
+        self.assertIs(Parser().tokenizer(), tokenizer)
+        self.assertIsNot(SubParser().tokenizer(), tokenizer)
+        self.assertIs(SubParser().tokenizer(), SubParser().tokenizer())
+        self.assertEqual(Parser().parse('foo'), 'foo')
+
+        # Opt-out per instance.
+        parser = Parser()
+        parser.cache_tokenizer = False
+        self.assertIsNot(parser.tokenizer(), tokenizer)
+        self.assertIsNot(parser.tokenizer(), parser.tokenizer())
+        self.assertEqual(parser.parse('bar'), 'bar')
+        self.assertIs(Parser().tokenizer(), tokenizer)
+
+    def test_parser_grammar_cache(self):
+        calls = []
+
+        class Parser(textparser.Parser):
+
+            def grammar(self):
+                calls.append(None)
+
+                return Sequence('WORD', 'WORD')
+
+        self.assertEqual(Parser().parse('a b'), ['a', 'b'])
+        self.assertEqual(Parser().parse('c d'), ['c', 'd'])
+        self.assertEqual(len(calls), 1)
+        self.assertIs(Parser().compiled_grammar(),
+                      Parser().compiled_grammar())
+
+        # Opt-out per instance.
+        parser = Parser()
+        parser.cache_grammar = False
+        self.assertEqual(parser.parse('e f'), ['e', 'f'])
+        self.assertEqual(len(calls), 2)
+        self.assertIsNot(parser.compiled_grammar(),
+                         Parser().compiled_grammar())
+
+        # Invalidation.
+        grammar = Parser().compiled_grammar()
+        tokenizer = Parser().tokenizer()
+        Parser.clear_cache()
+        self.assertIsNot(Parser().compiled_grammar(), grammar)
+        self.assertIsNot(Parser().tokenizer(), tokenizer)
+        self.assertEqual(Parser().parse('g h'), ['g', 'h'])
+
+    def test_parser_lazy(self):
+        class Parser(textparser.Parser):
+
+            def keywords(self):
+                return set(['IF'])
+
+            def token_specs(self):
+                return [
+                    ('SKIP',                r'[ \r\n\t]+'),
+                    ('NUMBER',              r'-?\d+(\.\d+)?([eE][+-]?\d+)?'),
+                    ('DOT',            '.', r'\.'),
+                    ('WORD',                r'[A-Za-z0-9_]+'),
+                    ('MISMATCH',            r'.')
+                ]
+
+            def grammar(self):
+                return Sequence('IF',
+                                Optional(choice(DelimitedList('WORD'),
+                                                ZeroOrMore('NUMBER'))),
+                                '.')
+
+        datas = [
+            ('IF .', False),
+            ('IF a, b .', False),
+            ('IF 1 2 3 .', True),
+            ('', False),
+            ('IF a, .', False),
+            ('IF 1 a .', False),
+            ('IF a b .', False),
+            ('IF a ! .', False),
+            ('IF a . !', False),
+            ('IF a . b', False),
+        ]
+
+        for text, match_sof in datas:
+            for token_tree in [False, True]:
+                try:
+                    expected = Parser().parse(text, token_tree=token_tree)
+                except textparser.ParseError as e:
+                    with self.assertRaises(textparser.ParseError) as cm:
+                        Parser().parse(text, token_tree=token_tree, lazy=True)
+
+                    self.assertEqual(str(cm.exception), str(e))
+                else:
+                    tree = Parser().parse(text, token_tree=token_tree, lazy=True)
+                    self.assertEqual(tree, expected)
+
+    def test_parser_lazy_start_and_end_of_file(self):
+        class Parser(textparser.Parser):
+
+            def grammar(self):
+                return Sequence('__SOF__', 'WORD', '__EOF__')
+
+        self.assertEqual(Parser().parse('a', match_sof=True, lazy=True),
+                         ['__SOF__', 'a', '__EOF__'])
+
+        class Parser(textparser.Parser):
+
+            def tokenize(self, text):
+                return tokenize([('WORD', text, 0)])
+
+            def grammar(self):
+                return 'WORD'
+
+        self.assertEqual(Parser().parse('a', lazy=True), 'a')
+
+    def test_grammar_lazy_discards_consumed_tokens(self):
+        lengths = []
+
+        class BufferLength(textparser.Pattern):
+
+            def match(self, tokens):
+                lengths.append(len(tokens._tokens._buffer))
+
+                return []
+
+        grammar = Grammar(Sequence(ZeroOrMore(Sequence('WORD', ',')),
+                                   BufferLength()))
+        tokens = tokenize([('WORD', 'a'), (',', ',')] * 10000)
+        tree = grammar.parse(iter(tokens))
+
+        self.assertEqual(len(tree[0]), 10000)
+        self.assertLess(lengths[0], 1000)
+
+    def test_grammar_iter_parse(self):
+        datas = [
+            (
+                ZeroOrMore(Sequence('WORD', ';')),
+                [('WORD', 'a'), (';', ';'), ('WORD', 'b'), (';', ';')]
+            ),
+            (
+                OneOrMore(textparser.Flatten(Sequence('WORD',
+                                                      textparser.Suppress(
+                                                          ';')))),
+                [('WORD', 'a'), (';', ';'), ('WORD', 'b'), (';', ';')]
+            ),
+            (
+                DelimitedList(Sequence('WORD', 'NUMBER')),
+                [('WORD', 'a'), ('NUMBER', '1'), (',', ','), ('WORD', 'b'),
+                 ('NUMBER', '2')]
+            ),
+            (
+                DelimitedList('WORD'),
+                [('WORD', 'a', 1), (',', ',', 2), ('WORD', 'b', 3),
+                 (',', ',', 4)]
+            ),
+            (
+                OneOrMore('WORD'),
+                [('NUMBER', '1', 1)]
+            ),
+            (
+                ZeroOrMore(Sequence('WORD', ';')),
+                [('WORD', 'a', 1), (';', ';', 2), ('WORD', 'b', 3),
+                 ('NUMBER', '1', 4)]
+            )
+        ]
+
+        for pattern, tokens in datas:
+            grammar = Grammar(pattern)
+
+            for token_tree in [False, True]:
+                for create_tokens in [list, iter]:
+                    elements = []
+
+                    try:
+                        expected = grammar.parse(tokenize(tokens), token_tree)
+                    except textparser.GrammarError as e:
+                        with self.assertRaises(textparser.GrammarError) as cm:
+                            for element in grammar.iter_parse(
+                                    create_tokens(tokenize(tokens)),
+                                    token_tree):
+                                elements.append(element)
+
+                        self.assertEqual(cm.exception.offset, e.offset)
+                    else:
+                        for element in grammar.iter_parse(
+                                create_tokens(tokenize(tokens)),
+                                token_tree):
+                            elements.append(element)
+
+                        self.assertEqual(elements, expected)
+
+        with self.assertRaises(textparser.Error) as cm:
+            Grammar(Sequence('WORD')).iter_parse(tokenize([]))
+
+        self.assertEqual(
+            str(cm.exception),
+            "The grammar root must be a Repeated or DelimitedList pattern, "
+            "not <class 'textparser.Sequence'>.")
+
+    def test_grammar_iter_parse_streams_elements(self):
+        read = []
+
+        def tokens():
+            for token in tokenize([('WORD', 'a'), (';', ';')] * 10000):
+                read.append(token)
+
+                yield token
+
+        grammar = Grammar(ZeroOrMore(Sequence('WORD', ';')))
+        elements = grammar.iter_parse(tokens())
+
+        self.assertEqual(next(elements), ['a', ';'])
+        self.assertLess(len(read), 1000)
+        self.assertEqual(len(list(elements)), 9999)
+
+    def test_parser_iter_parse(self):
+        class Parser(textparser.Parser):
+
+            def token_specs(self):
+                return [
+                    ('SKIP',        r'[ \r\n\t]+'),
+                    ('NUMBER',      r'\d+'),
+                    ('WORD',        r'[a-z]+'),
+                    ('SEMI',   ';', r';'),
+                    ('MISMATCH',    r'.')
+                ]
+
+            def grammar(self):
+                return ZeroOrMore(Sequence('WORD', 'NUMBER', ';'))
+
+        self.assertEqual(list(Parser().iter_parse(io.StringIO('a 1; b 2;'))),
+                         [['a', '1', ';'], ['b', '2', ';']])
+
+        elements = []
+
+        with self.assertRaises(textparser.ParseError) as cm:
+            for element in Parser().iter_parse('a 1; b 2 c 3;'):
+                elements.append(element)
+
+        self.assertEqual(elements, [['a', '1', ';']])
+        self.assertEqual(cm.exception.offset, 9)
+
+        # Files are read in chunks, and at once on error.
+        text = 50000 * 'abc 123;\n'
+        fin = io.StringIO(text)
+        elements = Parser().iter_parse(fin)
+        self.assertEqual(next(elements), ['abc', '123', ';'])
+        self.assertLess(fin.tell(), len(text))
+        self.assertEqual(len(list(elements)), 49999)
+
+        text += 'a 1; b $'
+
+        for fin in [io.StringIO(text), NonSeekableFile(text)]:
+            with self.assertRaises(textparser.ParseError) as cm:
+                list(Parser().iter_parse(fin))
+
+            self.assertEqual(cm.exception.offset, len(text) - 1)
+            self.assertEqual(cm.exception.line, 50001)
+            self.assertEqual(cm.exception.text, text)
+
+    def test_tokenizer_iter_tokenize_chunks(self):
+        tokenizer = Tokenizer([
+            ('SKIP',                r'[ \r\n\t]+'),
+            ('COMMENT',             r'/\*.*?\*/'),
+            ('NUMBER',              r'\d+'),
+            ('WORD',                r'[a-z]+'),
+            ('SLASH',          '/', r'/'),
+            ('MISMATCH',            r'.')
+        ])
+        text = 'ab 12 / /* a b */ abc 1/2 /* \n */ 12345 /*'
+        expected = tokenizer.tokenize(text[:-1])
+
+        for size in range(1, len(text) + 1):
+            chunks = [text[i:i + size] for i in range(0, len(text), size)]
+            tokens = tokenizer._iter_tokenize_chunks(chunks, 12)
+
+            with self.assertRaises(TokenizeError) as cm:
+                for i, token in enumerate(tokens):
+                    self.assertEqual(token, expected[i])
+
+            self.assertEqual(i, len(expected) - 1)
+            self.assertEqual(cm.exception.offset, len(text) - 1)
+
+        tokens = list(tokenizer._iter_tokenize_chunks(['ab 1', '2', ' '], 1))
+        self.assertEqual(tokens[1:],
+                         [
+                             Token('WORD', 'ab', 0),
+                             Token('NUMBER', '12', 3),
+                             Token('__EOF__', '__EOF__', 6)
+                         ])
+
+    def test_parser_parse_recover(self):
+
+        class Parser(textparser.Parser):
+
+            def token_specs(self):
+                return [
+                    ('SKIP',             r'[ \r\n\t]+'),
+                    ('NUMBER',           r'\d+'),
+                    ('WORD',             r'[a-z]+'),
+                    ('EQ',          '=', r'='),
+                    ('SEMI',        ';', r';'),
+                    ('LBRACE',      '{', r'\{'),
+                    ('RBRACE',      '}', r'\}'),
+                    ('MISMATCH',         r'.')
+                ]
+
+            def grammar(self):
+                block = Forward()
+                statement = choice(Sequence('WORD', '=', 'NUMBER', ';'),
+                                   block)
+                statements = ZeroOrMore(textparser.Recover(statement, ';'))
+                block <<= Sequence('{', statements, '}')
+
+                return statements
+
+        text = '{ a = 1; 5; b = ; } c = 2; d 3; }'
+
+        for kwargs in [{}, {'lazy': True}, {'compact': True}]:
+            tree, errors = Parser().parse_recover(text, **kwargs)
+
+            self.assertEqual(tree,
+                             [['{', [['a', '=', '1', ';'], None, None], '}'],
+                              ['c', '=', '2', ';'],
+                              None])
+            self.assertEqual([error.offset for error in errors],
+                             [9, 16, 29, 32])
+            self.assertEqual([error.expected for error in errors],
+                             [{'WORD', '{'},
+                              {'NUMBER'},
+                              {'='},
+                              {'WORD', '{', '__EOF__'}])
+            self.assertEqual(str(errors[0]),
+                             'Invalid syntax at line 1, column 10: '
+                             '"{ a = 1; >>!<<5; b = ; } c = 2; d 3; }"')
+
+        tree, errors = Parser().parse_recover('a = 1; {}')
+
+        self.assertEqual(tree, [['a', '=', '1', ';'], ['{', [], '}']])
+        self.assertEqual(errors, [])
+
+        with self.assertRaises(textparser.ParseError) as cm:
+            Parser().parse_recover('a = 1; $')
+
+        self.assertEqual(cm.exception.offset, 7)
+
+    def test_parser_parse_many(self):
+        texts = ['a 1;', 'b 2; 3', 'd 4; e 5;']
+        executors = [
+            None,
+            ThreadPoolExecutor(2),
+            ProcessPoolExecutor(2)
+        ]
+
+        for executor in executors:
+            trees = RecordsParser().parse_many(texts, executor, 2)
+
+            self.assertEqual(len(trees), 3)
+            self.assertEqual(trees[0], [['a', '1', ';']])
+            self.assertIsInstance(trees[1], textparser.ParseError)
+            self.assertEqual(trees[1].offset, 5)
+            self.assertEqual(trees[1].text, 'b 2; 3')
+            self.assertEqual(trees[2], [['d', '4', ';'], ['e', '5', ';']])
+
+            with self.assertRaises(textparser.ParseError) as cm:
+                RecordsParser().parse_many(texts,
+                                           executor,
+                                           return_exceptions=False)
+
+            self.assertEqual(cm.exception.offset, 5)
+
+            if executor is not None:
+                executor.shutdown()
+
+    def test_parser_parse_many_unpickled_once(self):
+        parser = CountingParser()
+
+        with spawn_executor(2) as executor:
+            counts = parser.parse_many(20 * ['a 1;'], executor)
+            counts += parser.parse_many(20 * ['a 1;'], executor)
+
+        self.assertEqual(counts, 40 * [1])
+
+    def test_parser_parse_async(self):
+        loop = asyncio.new_event_loop()
+        parser = RecordsParser()
+
+        try:
+            tree = loop.run_until_complete(parser.parse_async('a 1;'))
+            self.assertEqual(tree, [['a', '1', ';']])
+
+            with self.assertRaises(textparser.ParseError) as cm:
+                loop.run_until_complete(parser.parse_async('b 2; 3'))
+
+            self.assertEqual(cm.exception.offset, 5)
+        finally:
+            loop.close()
+
+    def test_parser_parse_async_limit(self):
+        loop = asyncio.new_event_loop()
+        parser = RecordsParser()
+        parser.async_limit = 2
+        texts = ['a {};'.format(i) for i in range(6)]
+
+        try:
+            parser.async_executor = GatedExecutor(loop, 2, len(texts))
+            futures = [
+                asyncio.ensure_future(parser.parse_async(text), loop=loop)
+                for text in texts
+            ]
+            trees = loop.run_until_complete(asyncio.gather(*futures))
+            self.assertEqual(trees, [[['a', str(i), ';']] for i in range(6)])
+            self.assertEqual(parser.async_executor.peak, 2)
+
+            # Texts are read ahead up to the limit.
+            parser.async_executor = GatedExecutor(loop, 2, len(texts))
+            trees, error = run_aiter(loop, parser.aiter_parse(texts))
+            self.assertEqual(trees, [[['a', str(i), ';']] for i in range(6)])
+            self.assertIsNone(error)
+            self.assertEqual(parser.async_executor.peak, 2)
+        finally:
+            loop.close()
+
+    def test_parser_aiter_parse(self):
+        loop = asyncio.new_event_loop()
+        parser = RecordsParser()
+        texts = ['a 1;', 'b 2; c 3;', 'd 4; 5', 'e 6;']
+
+        try:
+            for aiterable in [texts, AsyncTexts(texts)]:
+                trees, error = run_aiter(loop, parser.aiter_parse(aiterable))
+                self.assertEqual(trees,
+                                 [
+                                     [['a', '1', ';']],
+                                     [['b', '2', ';'], ['c', '3', ';']]
+                                 ])
+                self.assertIsInstance(error, textparser.ParseError)
+                self.assertEqual(error.offset, 5)
+
+            trees, error = run_aiter(loop, parser.aiter_parse(AsyncTexts([])))
+            self.assertEqual(trees, [])
+            self.assertIsNone(error)
+        finally:
+            loop.close()
+
+    def test_grammar_pickle(self):
+        def parse(grammar, tokens, token_tree):
+            return pickle.loads(pickle.dumps(grammar)).parse(tokens,
+                                                            token_tree)
+
+        def parse_compiled(grammar, tokens, token_tree):
+            grammar = grammar.compile()
+            grammar.parse(tokens, token_tree)
+
+            return parse(grammar, tokens, token_tree)
+
+        self.assert_same_parse_results(parse)
+        self.assert_same_parse_results(parse_compiled)
+
+    def test_grammar_pickle_registered_function(self):
+        grammar = Grammar(textparser.Action('NUMBER', lambda mo: int(mo)))
+
+        with self.assertRaises((pickle.PicklingError, AttributeError)):
+            pickle.dumps(grammar)
+
+        grammar = Grammar(OneOrMoreDict(Sequence('WORD', 'NUMBER'),
+                                        key=STATEMENT_KEY))
+        tokens = [
+            ('WORD', 'a'), ('NUMBER', '1'), ('WORD', 'a'), ('NUMBER', '2')
+        ]
+        grammar = pickle.loads(pickle.dumps(grammar))
+
+        self.assertEqual(grammar.parse(tokenize(tokens)),
+                         {'A': [['a', '1'], ['a', '2']]})
+
+        reference = textparser._FunctionReference('foo', __name__)
+
+        with self.assertRaises(textparser.Error) as cm:
+            reference.load()
+
+        self.assertEqual(str(cm.exception),
+                         "Function 'foo' is not registered.")
+
+    def test_parser_pickle_spawn(self):
+        # Kind ids are not the same in the worker.
+        textparser._kind_id('SHIPPED')
+
+        texts = ['a 1 + (2 + 3); b 4; a 5;', 'a +']
+        parser = ShippedParser()
+        expected = parser.parse_many(texts)
+
+        with spawn_executor(1) as executor:
+            trees = parser.parse_many(texts, executor)
+
+        self.assertEqual(trees[0],
+                         {
+                             'A': [
+                                 ['a', [1, '+', ['(', [2, '+', 3], ')']], ';'],
+                                 ['a', 5, ';']
+                             ],
+                             'B': [['b', 4, ';']]
+                         })
+        self.assertEqual(trees[0], expected[0])
+        self.assertEqual(trees[1].offset, expected[1].offset)
+
+    def test_errors_args(self):
+        error = textparser.ParseError('a b', 2)
+        message = 'Invalid syntax at line 1, column 3: "a >>!<<b"'
+
+        self.assertEqual(error.args, (message, ))
+        self.assertEqual(repr(error), 'ParseError({!r})'.format(message))
+
+        error = textparser.GrammarError(3)
+
+        self.assertEqual(error.args, ('Invalid syntax at offset 3.', ))
+        self.assertEqual(repr(error),
+                         "GrammarError('Invalid syntax at offset 3.')")
+
+    def test_errors_pickle(self):
+        errors = [
+            textparser.ParseError('a b', 2),
+            textparser.TokenizeError('a b', 1),
+            textparser.GrammarError(3)
+        ]
+
+        for error in errors:
+            loaded = pickle.loads(pickle.dumps(error))
+            self.assertIs(type(loaded), type(error))
+            self.assertEqual(str(loaded), str(error))
+            self.assertEqual(loaded.offset, error.offset)
+
+    def test_tokenizer_array(self):
+        tokenizer = Tokenizer([
+            ('SKIP',               r'[ \r\n\t]+'),
+            ('NUMBER',             r'-?\d+(\.\d+)?'),
+            ('DOT',           '.', r'\.'),
+            ('WORD',               r'[A-Za-z0-9_]+'),
+            ('MISMATCH',           r'.')
+        ],
+                              ['IF', 'DOT'])
+        text = 'IF 1.5 foo . DOT'
+        tokens = tokenizer.tokenize_array(text)
+
+        self.assertEqual(len(tokens), 6)
+        self.assertEqual(list(tokens), tokenizer.tokenize(text))
+        self.assertEqual(tokens[-1], Token(kind='.', value='DOT', offset=13))
+        self.assertEqual(tokens.value(2), '1.5')
+        self.assertEqual(list(tokens.starts), [0, 0, 3, 7, 11, 13])
+        self.assertEqual(list(tokens.ends), [0, 2, 6, 10, 12, 16])
+
+        tokens.append(Token('__EOF__', '__EOF__', len(text)))
+        del tokens[0]
+        self.assertEqual(tokens[0], Token(kind='IF', value='IF', offset=0))
+        self.assertEqual(tokens[-1],
+                         Token(kind='__EOF__', value='__EOF__', offset=16))
+
+        with self.assertRaises(TokenizeError) as cm:
+            tokenizer.tokenize_array('foo !')
+
+        self.assertEqual(cm.exception.offset, 4)
+
+    def test_token_array_large_kind_ids(self):
+        tokens = textparser.TokenArray('ab')
+        tokens.add(1, 0, 1)
+        tokens.add(70000, 1, 2)
+
+        self.assertEqual(list(tokens.kinds), [1, 70000])
+        self.assertEqual(tokens.value(1), 'b')
+
+    def test_parser_compact(self):
+        class Parser(textparser.Parser):
+
+            def keywords(self):
+                return set(['IF'])
+
+            def token_specs(self):
+                return [
+                    ('SKIP',                r'[ \r\n\t]+'),
+                    ('NUMBER',              r'-?\d+(\.\d+)?([eE][+-]?\d+)?'),
+                    ('DOT',            '.', r'\.'),
+                    ('WORD',                r'[A-Za-z0-9_]+'),
+                    ('MISMATCH',            r'.')
+                ]
+
+            def grammar(self):
+                return Sequence('IF',
+                                Optional(choice(DelimitedList('WORD'),
+                                                ZeroOrMore('NUMBER'))),
+                                ZeroOrMore(Any()))
+
+        datas = [
+            'IF .',
+            'IF a, b .',
+            'IF 1 2 3 . . .',
+            '',
+            'IF a, .',
+            'IF a ! .'
+        ]
+
+        for text in datas:
+            for token_tree in [False, True]:
+                for match_sof in [False, True]:
+                    try:
+                        expected = Parser().parse(text,
+                                                  token_tree=token_tree,
+                                                  match_sof=match_sof)
+                    except textparser.ParseError as e:
+                        with self.assertRaises(textparser.ParseError) as cm:
+                            Parser().parse(text,
+                                           token_tree=token_tree,
+                                           match_sof=match_sof,
+                                           compact=True)
+
+                        self.assertEqual(str(cm.exception), str(e))
+                    else:
+                        tree = Parser().parse(text,
+                                              token_tree=token_tree,
+                                              match_sof=match_sof,
+                                              compact=True)
+                        self.assertEqual(tree, expected)
+
     def test_parser(self):
         class Parser(textparser.Parser):
 
@@ -937,6 +2780,111 @@ class TextParserTest(unittest.TestCase):
         self.assertEqual(cm.exception.column, 6)
         self.assertEqual(str(cm.exception),
                          'Invalid syntax at line 1, column 6: "1.45 >>!<<2"')
+        self.assertEqual(cm.exception.expected, frozenset(['WORD']))
+
+    def test_parser_grammar_mismatch_expected(self):
+
+        class Parser(textparser.Parser):
+
+            def token_specs(self):
+                return [
+                    ('SKIP',             r'[ \r\n\t]+'),
+                    ('NUMBER',           r'\d+'),
+                    ('WORD',             r'[a-z]+'),
+                    ('EQ',          '=', r'='),
+                    ('SEMI',        ';', r';'),
+                    ('COMMA',       ',', r','),
+                    ('PLUS',        '+', r'\+'),
+                    ('MINUS',       '-', r'-'),
+                    ('LBRACKET',    '[', r'\['),
+                    ('RBRACKET',    ']', r'\]'),
+                    ('MISMATCH',         r'.')
+                ]
+
+            def grammar(self):
+                expression = textparser.Expression(
+                    choice('NUMBER', 'WORD'),
+                    [('-', 'right', 1), ('+', 'left', 2)])
+                value = choice(Sequence('[', DelimitedList('NUMBER'), ']'),
+                               expression)
+                statement = Sequence(Not('if'), 'WORD', '=', value, ';')
+
+                return ZeroOrMore(statement)
+
+        class CompiledParser(Parser):
+            compile_grammar = True
+            optimize_grammar = True
+
+        datas = [
+            ('a = ;', ['-', 'NUMBER', 'WORD', '[']),
+            ('a = 1 + ;', ['-', 'NUMBER', 'WORD']),
+            ('a = 1 2;', ['+', ';']),
+            ('a = [1 2];', [',', ']']),
+            ('a = 1; 2', ['WORD', '__EOF__']),
+            ('a = 1; b 2', ['='])
+        ]
+
+        for parser in [Parser(), CompiledParser()]:
+            for text, expected in datas:
+                for parse in [parser.parse,
+                              parser.validate,
+                              lambda text: parser.parse(text, lazy=True),
+                              lambda text: parser.parse(text, packrat=True),
+                              lambda text: parser.parse(text,
+                                                        recursive=False)]:
+                    with self.assertRaises(textparser.ParseError) as cm:
+                        parse(text)
+
+                    self.assertEqual(cm.exception.expected,
+                                     frozenset(expected))
+
+                with self.assertRaises(textparser.ParseError) as cm:
+                    list(parser.iter_parse(text))
+
+                self.assertEqual(cm.exception.expected, frozenset(expected))
+
+                error = pickle.loads(pickle.dumps(cm.exception))
+                self.assertEqual(error.expected, frozenset(expected))
+
+            with self.assertRaises(textparser.ParseError) as cm:
+                parser.parse('a = $;')
+
+            self.assertIsNone(cm.exception.expected)
+
+        self.assertIsNone(textparser.ParseError('a', 0).expected)
+
+    def test_parser_grammar_mismatch_expected_actions(self):
+        calls = []
+
+        def action(mo):
+            calls.append(mo)
+
+            return mo
+
+        class Parser(textparser.Parser):
+
+            def token_specs(self):
+                return [
+                    ('SKIP',             r'[ \r\n\t]+'),
+                    ('NUMBER',           r'\d+'),
+                    ('WORD',             r'[a-z]+'),
+                    ('EQ',          '=', r'='),
+                    ('SEMI',        ';', r';'),
+                    ('MISMATCH',         r'.')
+                ]
+
+            def grammar(self):
+                return ZeroOrMore(
+                    textparser.Action(Sequence('WORD', '=', 'NUMBER', ';'),
+                                      action))
+
+        with self.assertRaises(textparser.ParseError) as cm:
+            Parser().parse('a = 1; b = 2; c = d;')
+
+        # The kinds are recorded while parsing, without calling the
+        # actions again.
+        self.assertEqual(cm.exception.expected, frozenset(['NUMBER']))
+        self.assertEqual(len(calls), 2)
 
     def test_parser_grammar_mismatch_choice_max(self):
         class Parser(textparser.Parser):
@@ -1010,6 +2958,7 @@ class TextParserTest(unittest.TestCase):
         self.assertEqual(cm.exception.offset, 5)
         self.assertEqual(cm.exception.line, 2)
         self.assertEqual(cm.exception.column, 3)
+        self.assertEqual(cm.exception.marked_line, '34>>!<<56')
         self.assertEqual(str(cm.exception),
                          'Invalid syntax at line 2, column 3: "34>>!<<56"')
 
@@ -1036,6 +2985,32 @@ class TextParserTest(unittest.TestCase):
 
             self.assertEqual(text, line)
 
+    def test_line_index(self):
+        text = '0\n1234\n56'
+        index = textparser.LineIndex(text)
+        offsets = list(range(len(text) + 1))
+
+        self.assertEqual(list(index.starts), [0, 2, 7])
+        self.assertEqual(index.locations(offsets),
+                         [(textparser.line(text, offset),
+                           textparser.column(text, offset))
+                          for offset in offsets])
+
+        for offset in offsets:
+            self.assertEqual(index.line(offset),
+                             textparser.line(text, offset))
+            self.assertEqual(index.column(offset),
+                             textparser.column(text, offset))
+            self.assertEqual(index.markup_line(offset),
+                             markup_line(text, offset))
+
+        error = textparser.ParseError(text, 4, index)
+
+        self.assertEqual(error.line, 2)
+        self.assertEqual(error.column, 3)
+        self.assertEqual(str(error),
+                         'Invalid syntax at line 2, column 3: "12>>!<<34"')
+
     def test_replace_blocks(self):
         datas = [
             ('{}', '{}'),
@@ -1,7 +1,18 @@
 # A text parser.
 
+import copy
+import importlib
+import pickle
 import re
+import threading
+import weakref
+from array import array
+from bisect import bisect_right
+from collections import OrderedDict
+from collections import deque
 from collections import namedtuple
+from functools import partial
+from itertools import islice
 from operator import itemgetter
 
 
@@ -10,7 +21,9 @@ __version__ = '0.24.0'
 
 
 class _Mismatch(object):
-    pass
+
+    def __reduce__(self):
+        return 'MISMATCH'
 
 
 MISMATCH = _Mismatch()
@@ -19,6 +32,156 @@ MISMATCH = _Mismatch()
 """
 
 
+_KIND_NAMES = [None]
+_KIND_IDS = {}
+_KIND_IDS_LOCK = threading.Lock()
+
+
+def _kind_id(kind):
+    """Returns the small integer id of given token kind `kind`. Ids are
+    assigned on first use and never change.
+
+    """
+
+    try:
+        return _KIND_IDS[kind]
+    except KeyError:
+        with _KIND_IDS_LOCK:
+            if kind not in _KIND_IDS:
+                _KIND_IDS[kind] = len(_KIND_NAMES)
+                _KIND_NAMES.append(kind)
+
+            return _KIND_IDS[kind]
+
+
+_SOF_ID = _kind_id('__SOF__')
+_EOF_ID = _kind_id('__EOF__')
+
+
+def _kind_names_table(table):
+    """Returns given dictionary keyed by token kind ids keyed by token
+    kinds instead. Kind ids are not the same in all processes, so they
+    are never pickled.
+
+    """
+
+    return {_KIND_NAMES[kind_id]: value for kind_id, value in table.items()}
+
+
+def _kind_ids_table(table):
+    return {_kind_id(kind): value for kind, value in table.items()}
+
+
+def _kind_names_alternatives(alternatives):
+    """Returns given alternatives of a choice dispatch table with the
+    kind ids of skipped alternatives replaced by kinds.
+
+    """
+
+    return tuple([
+        (pattern,
+         is_last,
+         None if skipped is None else [_KIND_NAMES[kind_id]
+                                       for kind_id in skipped])
+        for pattern, is_last, skipped in alternatives
+    ])
+
+
+def _kind_ids_alternatives(alternatives):
+    return tuple([
+        (pattern,
+         is_last,
+         None if skipped is None else frozenset([_kind_id(kind)
+                                                 for kind in skipped]))
+        for pattern, is_last, skipped in alternatives
+    ])
+
+
+def _kinds_array():
+    """Returns an empty array of token kind ids, using two bytes per id
+    if all ids assigned so far fit.
+
+    """
+
+    if len(_KIND_NAMES) <= 65536:
+        return array('H')
+    else:
+        return array('I')
+
+
+def _offsets_array():
+    """Returns an empty array of text offsets, using eight bytes per
+    offset. Python 2 has no long long arrays, so unsigned longs are
+    used there instead.
+
+    """
+
+    try:
+        return array('Q')
+    except ValueError:
+        return array('L')
+
+
+_FUNCTIONS = {}
+
+
+def register_function(name, function):
+    """Register `function` by `name`, and return it. Patterns using a
+    registered function, for example as :class:`~textparser.Action`
+    function or :class:`~textparser.RepeatedDict` key, pickle the
+    name instead of the function. Use it for functions that cannot be
+    pickled, for example lambdas.
+
+    The module of the function is imported when it is unpickled, if
+    not already done, so it should register the function when
+    imported.
+
+    .. code-block:: python
+
+       >>> key = register_function('mymodule.key', lambda mo: mo[1])
+       >>> RepeatedDict(Sequence('WORD', 'NUMBER'), key=key)
+
+    """
+
+    _FUNCTIONS[name] = (function, function.__module__)
+
+    return function
+
+
+class _FunctionReference(object):
+    """A registered function, pickled by name.
+
+    """
+
+    def __init__(self, name, module):
+        self.name = name
+        self.module = module
+
+    def load(self):
+        if self.name not in _FUNCTIONS:
+            importlib.import_module(self.module)
+
+        try:
+            return _FUNCTIONS[self.name][0]
+        except KeyError:
+            raise Error(
+                "Function '{}' is not registered.".format(self.name))
+
+
+def _function_reference(value):
+    """Returns a reference to given value if it is a registered function,
+    and the value itself otherwise.
+
+    """
+
+    if callable(value):
+        for name, (function, module) in _FUNCTIONS.items():
+            if function is value:
+                return _FunctionReference(name, module)
+
+    return value
+
+
 class _String(object):
     """Matches a specific token kind.
 
@@ -26,31 +189,81 @@ class _String(object):
 
     def __init__(self, kind):
         self.kind = kind
+        self.kind_id = _kind_id(kind)
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.kind_id = _kind_id(self.kind)
 
     def match(self, tokens):
-        if self.kind == tokens.peek().kind:
+        if self.kind_id == tokens.peek_kind_id():
             return tokens.get_value()
         else:
+            tokens.fail(tokens._pos, self.kind_id)
+
             return MISMATCH
 
+    def match_pos(self, tokens, pos):
+        if self.kind_id == tokens._kinds[pos]:
+            return pos + 1, tokens.value(pos)
+        else:
+            tokens.fail(pos, self.kind_id)
+
+            return pos, MISMATCH
+
 
 class _Tokens(object):
 
+    _memo = None
+    _errors = None
+
     def __init__(self, tokens):
+        if type(tokens) is _TokenList:
+            kinds = tokens.kind_ids
+            tokens = tokens.tokens
+        elif hasattr(tokens, '__getitem__'):
+            kinds = [_KIND_IDS.get(token.kind, 0) for token in tokens]
+        else:
+            tokens = _TokenStream(tokens, self)
+            kinds = _TokenStreamKinds(tokens)
+
         self._tokens = tokens
+        self._kinds = kinds
         self._pos = 0
         self._max_pos = -1
+        self._expected = []
+        self._failed_pos = -1
+        self._failed = []
         self._stack = []
 
+    def low_water(self):
+        """The lowest position the parser may backtrack to.
+
+        """
+
+        if self._stack:
+            return self._stack[0]
+        else:
+            return self._pos
+
     def get_value(self):
         pos = self._pos
         self._pos += 1
 
         return self._tokens[pos]
 
+    def value(self, pos):
+        return self._tokens[pos]
+
     def peek(self):
         return self._tokens[self._pos]
 
+    def peek_kind(self):
+        return self._tokens[self._pos].kind
+
+    def peek_kind_id(self):
+        return self._kinds[self._pos]
+
     def peek_max(self):
         pos = self._pos
 
@@ -62,6 +275,122 @@ class _Tokens(object):
         else:
             return self._tokens[pos]
 
+    def fail(self, pos, kind_ids):
+        """Records that given token kind id, or collection of kind ids,
+        was tried at `pos` without a match. Failures at the same
+        position are collected until one at another position.
+
+        """
+
+        if pos == self._failed_pos:
+            self._failed.append(kind_ids)
+        else:
+            self._failed_pos = pos
+            self._failed = [kind_ids]
+
+    def save_failed(self):
+        """Returns the failures recorded so far, to be given to
+        :meth:`restore_failed()`.
+
+        """
+
+        return (self._failed_pos, self._failed, len(self._failed))
+
+    def restore_failed(self, saved):
+        """Discards the failures recorded since given saved failures, as
+        done by lookahead patterns.
+
+        """
+
+        failed_pos, failed, length = saved
+
+        if self._failed is failed:
+            del failed[length:]
+        else:
+            self._failed_pos = failed_pos
+            self._failed = failed
+
+    def mark_max(self, pos):
+        """Makes `pos` the max position if after it. Failures at `pos` are
+        collected as expected at the max position.
+
+        """
+
+        if pos >= self._max_pos:
+            self._max_pos = self.expect_max(pos, self._max_pos)
+
+    def expect_max(self, pos, max_pos):
+        """Same as :meth:`mark_max()`, but with the max position `max_pos`
+        given, and not before `pos`. Returns the new max position.
+
+        """
+
+        if pos > max_pos:
+            self._expected = []
+
+        if pos == self._failed_pos:
+            failed = self._failed
+            expected = self._expected
+
+            if not expected or expected[-1] is not failed:
+                expected.append(failed)
+
+        return pos
+
+    def push_max(self):
+        """Starts over with no max position, and returns the current max
+        position and expected kinds, to be given to :meth:`pop_max()`.
+
+        """
+
+        outer = (self._max_pos, self._expected)
+        self._max_pos = -1
+        self._expected = []
+
+        return outer
+
+    def pop_max(self, outer):
+        """Merges given max position and expected kinds into the current.
+
+        """
+
+        max_pos, expected = outer
+
+        if max_pos > self._max_pos:
+            self._max_pos = max_pos
+            self._expected = expected
+        elif max_pos == self._max_pos:
+            self._expected = expected + self._expected
+
+    def expected(self, pos, matched):
+        """Returns a frozenset of the names of the token kinds tried at the
+        failure position `pos`, including the end of file if the
+        grammar was `matched` up to it.
+
+        """
+
+        self.mark_max(pos)
+        kind_ids = set()
+
+        if self._max_pos == pos:
+            for failed in self._expected:
+                for item in failed:
+                    if type(item) is int:
+                        kind_ids.add(item)
+                    else:
+                        kind_ids.update(item)
+
+        if matched and self._pos == pos:
+            kind_ids.add(_EOF_ID)
+
+        return frozenset([_KIND_NAMES[kind_id] for kind_id in kind_ids])
+
+    def offset(self, pos):
+        try:
+            return self._tokens[pos].offset
+        except IndexError:
+            return self._tokens[-1].offset
+
     def save(self):
         self._stack.append(self._pos)
 
@@ -72,15 +401,11 @@ class _Tokens(object):
         self._stack[-1] = self._pos
 
     def mark_max_restore(self):
-        if self._pos > self._max_pos:
-            self._max_pos = self._pos
-
+        self.mark_max(self._pos)
         self._pos = self._stack.pop()
 
     def mark_max_load(self):
-        if self._pos > self._max_pos:
-            self._max_pos = self._pos
-
+        self.mark_max(self._pos)
         self._pos = self._stack[-1]
 
     def drop(self):
@@ -98,6 +423,136 @@ class _StringTokens(_Tokens):
 
         return self._tokens[pos].value
 
+    def value(self, pos):
+        return self._tokens[pos].value
+
+
+class _ArrayTokens(_Tokens):
+
+    def __init__(self, tokens):
+        self._tokens = tokens
+        self._kinds = tokens.kinds
+        self._pos = 0
+        self._max_pos = -1
+        self._expected = []
+        self._failed_pos = -1
+        self._failed = []
+        self._stack = []
+
+    def peek_kind(self):
+        return _KIND_NAMES[self._kinds[self._pos]]
+
+
+class _StringArrayTokens(_ArrayTokens):
+
+    def get_value(self):
+        pos = self._pos
+        self._pos += 1
+
+        return self._tokens.value(pos)
+
+    def value(self, pos):
+        return self._tokens.value(pos)
+
+
+class _TokenStream(object):
+    """A sequence of tokens read on demand from the iterator `tokens`.
+
+    Tokens before the lowest position `owner` may backtrack to are
+    discarded while reading, so only the lookahead needed for
+    backtracking and error reporting is kept in memory.
+
+    """
+
+    CHUNK_SIZE = 256
+
+    def __init__(self, tokens, owner):
+        self._iterator = iter(tokens)
+        self._owner = owner
+        self._buffer = []
+        self._base = 0
+        self._exhausted = False
+
+    def _read_chunk(self):
+        """Discard unreachable tokens, and then read a chunk of tokens into
+        the buffer. Returns ``False`` if there are no more tokens.
+
+        """
+
+        if self._exhausted:
+            return False
+
+        buffer = self._buffer
+        low_water = self._owner.low_water()
+
+        if low_water - self._base >= self.CHUNK_SIZE:
+            del buffer[:low_water - self._base]
+            self._base = low_water
+
+        size = len(buffer)
+        buffer.extend(islice(self._iterator, self.CHUNK_SIZE))
+
+        if len(buffer) - size < self.CHUNK_SIZE:
+            self._exhausted = True
+
+        return len(buffer) > size
+
+    def _read_all(self):
+        while self._read_chunk():
+            pass
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+
+        if index < 0:
+            self._read_all()
+
+            return self._buffer[index]
+
+        while index >= self._base + len(self._buffer):
+            if not self._read_chunk():
+                raise IndexError('token index out of range')
+
+        return self._buffer[index - self._base]
+
+    def __len__(self):
+        """Reads all remaining tokens, and returns the total number of
+        tokens.
+
+        """
+
+        self._read_all()
+
+        return self._base + len(self._buffer)
+
+
+class _TokenStreamKinds(object):
+    """The token kind ids of given token stream `tokens`.
+
+    """
+
+    def __init__(self, tokens):
+        self._tokens = tokens
+
+    def __getitem__(self, index):
+        return _KIND_IDS.get(self._tokens[index].kind, 0)
+
+    def index(self, kind_id, start):
+        """Returns the position of the first token of given kind id at or
+        after `start`. Raises ValueError if there is none.
+
+        """
+
+        while True:
+            try:
+                if self[start] == kind_id:
+                    return start
+            except IndexError:
+                raise ValueError('kind id not found')
+
+            start += 1
+
 
 def _wrap_string(item):
     if isinstance(item, str):
@@ -110,11 +565,52 @@ def _wrap_strings(items):
     return [_wrap_string(item) for item in items]
 
 
-def _format_invalid_syntax(text, offset):
-    return 'Invalid syntax at line {}, column {}: "{}"'.format(
-        line(text, offset),
-        column(text, offset),
-        markup_line(text, offset))
+def _is_pattern(item):
+    return isinstance(item, (Pattern, _String))
+
+
+def _transform_graph(root, transform):
+    """Returns a copy of the pattern graph `root`. `transform` is called
+    with each copied pattern, before its children are copied, and
+    returns the pattern to use in its place. Cycles are preserved.
+
+    Children are found by looking for patterns, and lists, tuples and
+    dictionaries of patterns, among the pattern attributes, which also
+    works for most user defined patterns.
+
+    """
+
+    copies = {}
+
+    def copy_item(item):
+        if _is_pattern(item):
+            return copy_pattern(item)
+        elif isinstance(item, (list, tuple)):
+            return type(item)([copy_item(element) for element in item])
+        elif isinstance(item, dict):
+            return {key: copy_item(value) for key, value in item.items()}
+        else:
+            return item
+
+    def copy_pattern(pattern):
+        key = id(pattern)
+
+        if key not in copies:
+            pattern_copy = copy.copy(pattern)
+            copies[key] = transform(pattern_copy)
+
+            for name, value in vars(pattern).items():
+                setattr(pattern_copy, name, copy_item(value))
+
+        return copies[key]
+
+    return copy_pattern(root)
+
+
+def _format_invalid_syntax(line, column, marked_line):
+    return 'Invalid syntax at line {}, column {}: "{}"'.format(line,
+                                                              column,
+                                                              marked_line)
 
 
 class Error(Exception):
@@ -125,17 +621,101 @@ class Error(Exception):
     pass
 
 
-class TokenizeError(Error):
+class _LazyError(Error):
+    """Base class of errors at offset `offset`, which format their
+    message with :meth:`_format_message()` the first time it is used,
+    as errors are often discarded.
+
+    """
+
+    def __init__(self, offset):
+        super(_LazyError, self).__init__(offset)
+        self._offset = offset
+        self._message = None
+
+    def __str__(self):
+        if self._message is None:
+            self._message = self._format_message()
+
+        return self._message
+
+    def __repr__(self):
+        return '{}({!r})'.format(type(self).__name__, str(self))
+
+    @property
+    def args(self):
+        return (str(self), )
+
+    @args.setter
+    def args(self, value):
+        Error.args.__set__(self, value)
+        self._message = Error.__str__(self)
+
+
+class _TextError(_LazyError):
+    """Base class of errors at offset `offset` into text `text`. The
+    line, column and marked line are found the first time they are
+    used.
+
+    """
+
+    def __init__(self, text, offset, line_index):
+        super(_TextError, self).__init__(offset)
+        self._text = text
+        self._line_index = line_index
+        self._line = None
+        self._column = None
+        self._marked_line = None
+
+    def __reduce__(self):
+        return (type(self), (self._text, self._offset))
+
+    def _format_message(self):
+        return _format_invalid_syntax(self._get_line(),
+                                      self._get_column(),
+                                      self._get_marked_line())
+
+    def _get_line(self):
+        if self._line is None:
+            if self._line_index is None:
+                self._line = line(self._text, self._offset)
+            else:
+                self._line = self._line_index.line(self._offset)
+
+        return self._line
+
+    def _get_column(self):
+        if self._column is None:
+            if self._line_index is None:
+                self._column = column(self._text, self._offset)
+            else:
+                self._column = self._line_index.column(self._offset)
+
+        return self._column
+
+    def _get_marked_line(self):
+        if self._marked_line is None:
+            if self._line_index is None:
+                self._marked_line = markup_line(self._text, self._offset)
+            else:
+                self._marked_line = self._line_index.markup_line(
+                    self._offset)
+
+        return self._marked_line
+
+
+class TokenizeError(_TextError):
     """This exception is raised when the text cannot be converted into
     tokens.
 
+    The line and column of `offset` are found using `line_index`, a
+    :class:`~textparser.LineIndex` of `text`, if given. The message
+    is formatted the first time it is used.
+
     """
 
-    def __init__(self, text, offset):
-        self._text = text
-        self._offset = offset
-        message = _format_invalid_syntax(text, offset)
-        super(TokenizeError, self).__init__(message)
+    def __init__(self, text, offset, line_index=None):
+        super(TokenizeError, self).__init__(text, offset, line_index)
 
     @property
     def text(self):
@@ -154,16 +734,21 @@ class TokenizeError(Error):
         return self._offset
 
 
-class GrammarError(Error):
+class GrammarError(_LazyError):
     """This exception is raised when the tokens cannot be converted into a
     parse tree.
 
     """
 
-    def __init__(self, offset):
-        self._offset = offset
-        message = 'Invalid syntax at offset {}.'.format(offset)
-        super(GrammarError, self).__init__(message)
+    def __init__(self, offset, expected=None):
+        super(GrammarError, self).__init__(offset)
+        self._expected = expected
+
+    def __reduce__(self):
+        return (type(self), (self._offset, self._expected))
+
+    def _format_message(self):
+        return 'Invalid syntax at offset {}.'.format(self._offset)
 
     @property
     def offset(self):
@@ -173,19 +758,32 @@ class GrammarError(Error):
 
         return self._offset
 
+    @property
+    def expected(self):
+        """A frozenset of the names of the token kinds the parser tried
+        where it failed, or ``None`` if not known.
+
+        """
+
+        return self._expected
 
-class ParseError(Error):
+
+class ParseError(_TextError):
     """This exception is raised when the parser fails to parse the text.
 
+    The line and column of `offset` are found using `line_index`, a
+    :class:`~textparser.LineIndex` of `text`, if given. Share one
+    index between errors in the same text. The message, line, column
+    and marked line are found the first time they are used.
+
     """
 
-    def __init__(self, text, offset):
-        self._text = text
-        self._offset = offset
-        self._line = line(text, offset)
-        self._column = column(text, offset)
-        message = _format_invalid_syntax(text, offset)
-        super(ParseError, self).__init__(message)
+    def __init__(self, text, offset, line_index=None, expected=None):
+        super(ParseError, self).__init__(text, offset, line_index)
+        self._expected = expected
+
+    def __reduce__(self):
+        return (type(self), (self._text, self._offset, None, self._expected))
 
     @property
     def text(self):
@@ -209,7 +807,7 @@ class ParseError(Error):
 
         """
 
-        return self._line
+        return self._get_line()
 
     @property
     def column(self):
@@ -217,17 +815,223 @@ class ParseError(Error):
 
         """
 
-        return self._column
+        return self._get_column()
+
+    @property
+    def marked_line(self):
+        """The line where the parser failed, with a marker at the
+        failure. See :func:`~textparser.markup_line()`.
+
+        """
+
+        return self._get_marked_line()
+
+    @property
+    def expected(self):
+        """A frozenset of the names of the token kinds the parser tried
+        where it failed, or ``None`` if not known, as for tokenization
+        errors. The kinds are recorded while parsing, by the built-in
+        patterns only.
+
+        """
+
+        return self._expected
 
 
 Token = namedtuple('Token', ['kind', 'value', 'offset'])
 
 
+class _TokenList(object):
+    """A list of tokens `tokens` created by the tokenizer, and the kind
+    ids of the tokens `kind_ids`, so the parser does not look them up
+    again. The tokens are parsed as a plain list, which is indexed
+    faster than a list subclass.
+
+    """
+
+    def __init__(self, tokens, kind_ids):
+        self.tokens = tokens
+        self.kind_ids = kind_ids
+
+    def __getitem__(self, index):
+        return self.tokens[index]
+
+    def __len__(self):
+        return len(self.tokens)
+
+
+class TokenArray(object):
+    """A compact list of tokens in the text `text`, stored as token kind
+    ids and start and end offsets in arrays instead of as
+    :class:`~textparser.Token` objects. Token values are sliced from
+    the text when needed.
+
+    Items are :class:`~textparser.Token` objects created on access, so
+    a token array can be used in place of a list of tokens. Create it
+    with :func:`~textparser.Tokenizer.tokenize_array()`.
+
+    """
+
+    def __init__(self, text):
+        self._text = text
+        self._kinds = _kinds_array()
+        self._starts = _offsets_array()
+        self._ends = _offsets_array()
+
+    @property
+    def text(self):
+        """The tokenized text.
+
+        """
+
+        return self._text
+
+    @property
+    def kinds(self):
+        """An array of token kind ids.
+
+        """
+
+        return self._kinds
+
+    @property
+    def starts(self):
+        """An array of token start offsets.
+
+        """
+
+        return self._starts
+
+    @property
+    def ends(self):
+        """An array of token end offsets.
+
+        """
+
+        return self._ends
+
+    def add(self, kind_id, start, end):
+        """Append a token with given kind id `kind_id`, and start and end
+        offsets `start` and `end`.
+
+        """
+
+        try:
+            self._kinds.append(kind_id)
+        except OverflowError:
+            self._kinds = array('I', self._kinds)
+            self._kinds.append(kind_id)
+
+        self._starts.append(start)
+        self._ends.append(end)
+
+    def append(self, token):
+        """Append given token `token`. Its value must be the text between
+        its offset and end offset, or its kind for start and end of
+        file tokens.
+
+        """
+
+        kind_id = _kind_id(token.kind)
+
+        if kind_id in [_SOF_ID, _EOF_ID]:
+            end = token.offset
+        else:
+            end = token.offset + len(token.value)
+
+        self.add(kind_id, token.offset, end)
+
+    def value(self, index):
+        """The value of the token at given index `index`.
+
+        """
+
+        kind_id = self._kinds[index]
+
+        if kind_id in [_SOF_ID, _EOF_ID]:
+            return _KIND_NAMES[kind_id]
+        else:
+            return self._text[self._starts[index]:self._ends[index]]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+
+        return Token(_KIND_NAMES[self._kinds[index]],
+                     self.value(index),
+                     self._starts[index])
+
+    def __delitem__(self, index):
+        del self._kinds[index]
+        del self._starts[index]
+        del self._ends[index]
+
+    def __len__(self):
+        return len(self._kinds)
+
+
+def _create_match(match_pos):
+    """Returns a :func:`~textparser.Pattern.match()` method calling
+    `match_pos` at the current token position.
+
+    """
+
+    def match(self, tokens):
+        tokens._pos, mo = match_pos(self, tokens, tokens._pos)
+
+        return mo
+
+    return match
+
+
 class Pattern(object):
     """Base class of all patterns.
 
+    Subclasses implement either :func:`~textparser.Pattern.match()`
+    or :func:`~textparser.Pattern.match_pos()`, and the other one is
+    created automatically. Overriding only one of them in a subclass
+    of a pattern overrides the other as well. The built-in patterns
+    define both, as Python 2 does not create the other one.
+
     """
 
+    def __init_subclass__(cls, **kwargs):
+        super(Pattern, cls).__init_subclass__(**kwargs)
+
+        if 'match_pos' in cls.__dict__:
+            if 'match' not in cls.__dict__:
+                cls.match = _create_match(cls.__dict__['match_pos'])
+        elif 'match' in cls.__dict__:
+            cls.match_pos = Pattern.match_pos
+
+    def __getstate__(self):
+        """Returns the state of the pattern to pickle, with registered
+        functions replaced by references to them. See
+        :func:`~textparser.register_function()`.
+
+        Subclasses with state that cannot be pickled, or is not the
+        same in all processes, override this method and
+        :func:`~textparser.Pattern.__setstate__()`.
+
+        """
+
+        return {
+            name: _function_reference(value)
+            for name, value in self.__dict__.items()
+        }
+
+    def __setstate__(self, state):
+        """Restores given state returned by
+        :func:`~textparser.Pattern.__getstate__()`.
+
+        """
+
+        for name, value in state.items():
+            if type(value) is _FunctionReference:
+                value = value.load()
+
+            self.__dict__[name] = value
+
     def match(self, tokens):
         """Returns :data:`~textparser.MISMATCH` on mismatch, and anything else
         on match.
@@ -236,6 +1040,20 @@ class Pattern(object):
 
         raise NotImplementedError('To be implemented by subclasses.')
 
+    def match_pos(self, tokens, pos):
+        """Same as :func:`~textparser.Pattern.match()`, but given the token
+        position `pos` instead of the position in `tokens`. Returns a
+        two-tuple of the position after the match and the match. On
+        mismatch the match is :data:`~textparser.MISMATCH` and the
+        position is where the pattern failed.
+
+        """
+
+        tokens._pos = pos
+        mo = self.match(tokens)
+
+        return tokens._pos, mo
+
 
 class Sequence(Pattern):
     """Matches a sequence of patterns. Becomes a list in the parse tree.
@@ -244,19 +1062,38 @@ class Sequence(Pattern):
 
     def __init__(self, *patterns):
         self.patterns = _wrap_strings(patterns)
+        self._shapes = _shapes(self.patterns)
+
+    def match_pos(self, tokens, pos):
+        if self._shapes is not None:
+            return self._match_pos_shaped(tokens, pos)
 
-    def match(self, tokens):
         matched = []
 
         for pattern in self.patterns:
-            mo = pattern.match(tokens)
+            pos, mo = pattern.match_pos(tokens, pos)
 
             if mo is MISMATCH:
-                return MISMATCH
+                return pos, MISMATCH
 
             matched.append(mo)
 
-        return matched
+        return pos, matched
+
+    match = _create_match(match_pos)
+
+    def _match_pos_shaped(self, tokens, pos):
+        matched = []
+
+        for pattern, shape in self._shapes:
+            pos, mo = pattern.match_pos(tokens, pos)
+
+            if mo is MISMATCH:
+                return pos, MISMATCH
+
+            _add_shaped(matched, mo, shape)
+
+        return pos, matched
 
 
 class Choice(Pattern):
@@ -267,22 +1104,84 @@ class Choice(Pattern):
 
     def __init__(self, *patterns):
         self._patterns = _wrap_strings(patterns)
+        self._dispatch = None
 
-    def match(self, tokens):
-        tokens.save()
+    def __getstate__(self):
+        state = super(Choice, self).__getstate__()
+
+        if self._dispatch is not None:
+            table, default = self._dispatch
+            table = {kind_id: _kind_names_alternatives(alternatives)
+                     for kind_id, alternatives in table.items()}
+            state['_dispatch'] = (_kind_names_table(table),
+                                  _kind_names_alternatives(default))
+
+        return state
+
+    def __setstate__(self, state):
+        super(Choice, self).__setstate__(state)
+
+        if self._dispatch is not None:
+            table, default = self._dispatch
+            table = {kind: _kind_ids_alternatives(alternatives)
+                     for kind, alternatives in table.items()}
+            self._dispatch = (_kind_ids_table(table),
+                              _kind_ids_alternatives(default))
+
+    def match_pos(self, tokens, pos):
+        if self._dispatch is not None:
+            return self._match_pos_dispatch(tokens, pos)
+
+        end = pos
 
         for pattern in self._patterns:
-            tokens.mark_max_load()
-            mo = pattern.match(tokens)
+            if end >= tokens._max_pos:
+                tokens.mark_max(end)
+
+            end, mo = pattern.match_pos(tokens, pos)
 
             if mo is not MISMATCH:
-                tokens.drop()
+                return end, mo
 
-                return mo
+        return pos, MISMATCH
 
-        tokens.restore()
+    match = _create_match(match_pos)
+
+    def _match_pos_dispatch(self, tokens, pos):
+        """Only tries the alternatives that can start with the current
+        token kind, as given by the dispatch table created by
+        :class:`~textparser.Grammar`. Skipped alternatives would fail
+        without consuming any tokens, so the max position is the same
+        as if all alternatives were tried, and their FIRST sets are
+        recorded as failures where they would have been tried.
+
+        """
+
+        table, default = self._dispatch
+        alternatives = table.get(tokens._kinds[pos], default)
+
+        if pos >= tokens._max_pos:
+            tokens.mark_max(pos)
+
+        for pattern, is_last, skipped in alternatives:
+            if skipped is not None:
+                tokens.fail(pos, skipped)
+
+                if pattern is None:
+                    break
+
+                if pos >= tokens._max_pos:
+                    tokens.mark_max(pos)
+
+            end, mo = pattern.match_pos(tokens, pos)
+
+            if mo is not MISMATCH:
+                return end, mo
+
+            if not is_last and end >= tokens._max_pos:
+                tokens.mark_max(end)
 
-        return MISMATCH
+        return pos, MISMATCH
 
 
 class ChoiceDict(Pattern):
@@ -302,6 +1201,19 @@ class ChoiceDict(Pattern):
         for pattern in patterns:
             self._check_pattern(pattern, pattern)
 
+        self._patterns_table = self._create_patterns_table()
+
+    def __getstate__(self):
+        state = super(ChoiceDict, self).__getstate__()
+        del state['_patterns_table']
+        del state['_kind_ids']
+
+        return state
+
+    def __setstate__(self, state):
+        super(ChoiceDict, self).__setstate__(state)
+        self._patterns_table = self._create_patterns_table()
+
     @property
     def patterns_map(self):
         return self._patterns_map
@@ -328,13 +1240,42 @@ class ChoiceDict(Pattern):
 
         self._patterns_map[kind] = pattern
 
-    def match(self, tokens):
-        kind = tokens.peek().kind
+    def _create_patterns_table(self):
+        """Returns a list of patterns indexed by token kind id, with
+        ``None`` for kinds without a pattern. A dictionary of patterns
+        keyed by kind id is returned instead if the list would be
+        mostly empty.
 
-        if kind in self._patterns_map:
-            return self._patterns_map[kind].match(tokens)
+        """
+
+        kind_ids = {_kind_id(kind): kind for kind in self._patterns_map}
+        self._kind_ids = frozenset(kind_ids)
+        size = max([0] + list(kind_ids)) + 1
+
+        if size > 256 and size > 4 * len(kind_ids):
+            table = {}
         else:
-            return MISMATCH
+            table = [None] * size
+
+        for kind_id, kind in kind_ids.items():
+            table[kind_id] = self._patterns_map[kind]
+
+        return table
+
+    def match_pos(self, tokens, pos):
+        try:
+            pattern = self._patterns_table[tokens._kinds[pos]]
+        except LookupError:
+            pattern = None
+
+        if pattern is None:
+            tokens.fail(pos, self._kind_ids)
+
+            return pos, MISMATCH
+
+        return pattern.match_pos(tokens, pos)
+
+    match = _create_match(match_pos)
 
 
 class Repeated(Pattern):
@@ -346,25 +1287,81 @@ class Repeated(Pattern):
     def __init__(self, pattern, minimum=0):
         self._pattern = _wrap_string(pattern)
         self._minimum = minimum
+        self._shape = _shape(self._pattern)
+        self._kind_id = _string_kind_id(self._pattern)
+
+    def __setstate__(self, state):
+        super(Repeated, self).__setstate__(state)
+        self._kind_id = _string_kind_id(self._pattern)
+
+    def match_pos(self, tokens, pos):
+        if self._kind_id is not None:
+            return self._match_pos_kind(tokens, pos)
+
+        if self._shape is not None:
+            return self._match_pos_shaped(tokens, pos)
 
-    def match(self, tokens):
         matched = []
-        tokens.save()
 
         while True:
-            mo = self._pattern.match(tokens)
+            end, mo = self._pattern.match_pos(tokens, pos)
 
             if mo is MISMATCH:
-                tokens.mark_max_restore()
+                if end >= tokens._max_pos:
+                    tokens.mark_max(end)
+
                 break
 
             matched.append(mo)
-            tokens.update()
+            pos = end
 
         if len(matched) >= self._minimum:
-            return matched
+            return pos, matched
         else:
-            return MISMATCH
+            return pos, MISMATCH
+
+    match = _create_match(match_pos)
+
+    def _match_pos_shaped(self, tokens, pos):
+        pattern, shape = self._shape
+        matched = []
+        count = 0
+
+        while True:
+            end, mo = pattern.match_pos(tokens, pos)
+
+            if mo is MISMATCH:
+                if end >= tokens._max_pos:
+                    tokens.mark_max(end)
+
+                break
+
+            _add_shaped(matched, mo, shape)
+            count += 1
+            pos = end
+
+        if count >= self._minimum:
+            return pos, matched
+        else:
+            return pos, MISMATCH
+
+    def _match_pos_kind(self, tokens, pos):
+        kinds = tokens._kinds
+        kind_id = self._kind_id
+        start = pos
+
+        while kinds[pos] == kind_id:
+            pos += 1
+
+        tokens.fail(pos, kind_id)
+
+        if pos >= tokens._max_pos:
+            tokens.mark_max(pos)
+
+        if pos - start >= self._minimum:
+            return pos, [tokens.value(i) for i in range(start, pos)]
+        else:
+            return pos, MISMATCH
 
 
 class RepeatedDict(Repeated):
@@ -385,15 +1382,16 @@ class RepeatedDict(Repeated):
 
         self._key = key
 
-    def match(self, tokens):
+    def match_pos(self, tokens, pos):
         matched = {}
-        tokens.save()
 
         while True:
-            mo = self._pattern.match(tokens)
+            end, mo = self._pattern.match_pos(tokens, pos)
 
             if mo is MISMATCH:
-                tokens.mark_max_restore()
+                if end >= tokens._max_pos:
+                    tokens.mark_max(end)
+
                 break
 
             key = self._key(mo)
@@ -403,12 +1401,14 @@ class RepeatedDict(Repeated):
             except KeyError:
                 matched[key] = [mo]
 
-            tokens.update()
+            pos = end
 
         if len(matched) >= self._minimum:
-            return matched
+            return pos, matched
         else:
-            return MISMATCH
+            return pos, MISMATCH
+
+    match = _create_match(match_pos)
 
 
 class ZeroOrMore(Repeated):
@@ -465,59 +1465,136 @@ class DelimitedList(Pattern):
     def __init__(self, pattern, delim=','):
         self._pattern = _wrap_string(pattern)
         self._delim = _wrap_string(delim)
+        self._shape = _shape(self._pattern)
+        self._kind_ids = _string_kind_ids(self._pattern, self._delim)
+
+    def __setstate__(self, state):
+        super(DelimitedList, self).__setstate__(state)
+        self._kind_ids = _string_kind_ids(self._pattern, self._delim)
+
+    def match_pos(self, tokens, pos):
+        if self._kind_ids is not None:
+            return self._match_pos_kinds(tokens, pos)
+
+        if self._shape is not None:
+            return self._match_pos_shaped(tokens, pos)
 
-    def match(self, tokens):
         # First pattern.
-        mo = self._pattern.match(tokens)
+        pos, mo = self._pattern.match_pos(tokens, pos)
 
         if mo is MISMATCH:
-            return MISMATCH
+            return pos, MISMATCH
 
         matched = [mo]
-        tokens.save()
 
         while True:
             # Discard the delimiter.
-            mo = self._delim.match(tokens)
+            end, mo = self._delim.match_pos(tokens, pos)
 
             if mo is MISMATCH:
                 break
 
             # Pattern.
-            mo = self._pattern.match(tokens)
+            end, mo = self._pattern.match_pos(tokens, end)
 
             if mo is MISMATCH:
                 break
 
             matched.append(mo)
-            tokens.update()
+            pos = end
 
-        tokens.restore()
+        return pos, matched
+
+    match = _create_match(match_pos)
+
+    def _match_pos_shaped(self, tokens, pos):
+        pattern, shape = self._shape
+        pos, mo = pattern.match_pos(tokens, pos)
+
+        if mo is MISMATCH:
+            return pos, MISMATCH
+
+        matched = []
+        _add_shaped(matched, mo, shape)
+
+        while True:
+            end, mo = self._delim.match_pos(tokens, pos)
+
+            if mo is MISMATCH:
+                break
+
+            end, mo = pattern.match_pos(tokens, end)
+
+            if mo is MISMATCH:
+                break
+
+            _add_shaped(matched, mo, shape)
+            pos = end
+
+        return pos, matched
+
+    def _match_pos_kinds(self, tokens, pos):
+        kinds = tokens._kinds
+        kind_id, delim_kind_id = self._kind_ids
+
+        if kinds[pos] != kind_id:
+            tokens.fail(pos, kind_id)
+
+            return pos, MISMATCH
+
+        start = pos
+        pos += 1
+
+        while kinds[pos] == delim_kind_id and kinds[pos + 1] == kind_id:
+            pos += 2
+
+        if kinds[pos] == delim_kind_id:
+            tokens.fail(pos + 1, kind_id)
+        else:
+            tokens.fail(pos, delim_kind_id)
+
+        return pos, [tokens.value(i) for i in range(start, pos, 2)]
+
+
+class _NoDefault(object):
 
-        return matched
+    def __reduce__(self):
+        return '_NO_DEFAULT'
+
+
+_NO_DEFAULT = _NoDefault()
 
 
 class Optional(Pattern):
     """Matches `pattern` zero or one times. Becomes a list in the parse
     tree, empty on mismatch.
 
+    If `default` is given the match is not wrapped in a list, and
+    `default` is used in the parse tree on mismatch instead.
+
     """
 
-    def __init__(self, pattern):
+    def __init__(self, pattern, default=_NO_DEFAULT):
         self._pattern = _wrap_string(pattern)
+        self._default = default
 
-    def match(self, tokens):
-        tokens.save()
-        mo = self._pattern.match(tokens)
+    def match_pos(self, tokens, pos):
+        end, mo = self._pattern.match_pos(tokens, pos)
 
         if mo is MISMATCH:
-            tokens.mark_max_restore()
+            if end >= tokens._max_pos:
+                tokens.mark_max(end)
 
-            return []
+            if self._default is _NO_DEFAULT:
+                return pos, []
+            else:
+                return pos, self._default
+        elif self._default is _NO_DEFAULT:
+            return end, [mo]
         else:
-            tokens.drop()
+            return end, mo
 
-            return [mo]
+    match = _create_match(match_pos)
 
 
 class Any(Pattern):
@@ -525,11 +1602,13 @@ class Any(Pattern):
 
     """
 
-    def match(self, tokens):
-        if tokens.peek().kind == '__EOF__':
-            return MISMATCH
+    def match_pos(self, tokens, pos):
+        if tokens._kinds[pos] == _EOF_ID:
+            return pos, MISMATCH
         else:
-            return tokens.get_value()
+            return pos + 1, tokens.value(pos)
+
+    match = _create_match(match_pos)
 
 
 class AnyUntil(Pattern):
@@ -540,23 +1619,31 @@ class AnyUntil(Pattern):
 
     def __init__(self, pattern):
         self._pattern = _wrap_string(pattern)
+        self._kind_id = _string_kind_id(self._pattern)
 
-    def match(self, tokens):
-        matched = []
+    def __setstate__(self, state):
+        super(AnyUntil, self).__setstate__(state)
+        self._kind_id = _string_kind_id(self._pattern)
 
-        while True:
-            tokens.save()
-            mo = self._pattern.match(tokens)
+    def match_pos(self, tokens, pos):
+        if self._kind_id is not None:
+            try:
+                end = tokens._kinds.index(self._kind_id, pos)
+            except ValueError:
+                # Fail as below.
+                pass
+            else:
+                return end, [tokens.value(i) for i in range(pos, end)]
 
-            if mo is not MISMATCH:
-                break
+        matched = []
 
-            tokens.restore()
-            matched.append(tokens.get_value())
+        while self._pattern.match_pos(tokens, pos)[1] is MISMATCH:
+            matched.append(tokens.value(pos))
+            pos += 1
 
-        tokens.restore()
+        return pos, matched
 
-        return matched
+    match = _create_match(match_pos)
 
 
 class And(Pattern):
@@ -568,15 +1655,17 @@ class And(Pattern):
     def __init__(self, pattern):
         self._pattern = _wrap_string(pattern)
 
-    def match(self, tokens):
-        tokens.save()
-        mo = self._pattern.match(tokens)
-        tokens.restore()
+    def match_pos(self, tokens, pos):
+        failed = tokens.save_failed()
+        mo = self._pattern.match_pos(tokens, pos)[1]
+        tokens.restore_failed(failed)
 
         if mo is MISMATCH:
-            return MISMATCH
+            return pos, MISMATCH
         else:
-            return []
+            return pos, []
+
+    match = _create_match(match_pos)
 
 
 class Not(Pattern):
@@ -590,15 +1679,17 @@ class Not(Pattern):
     def __init__(self, pattern):
         self._pattern = _wrap_string(pattern)
 
-    def match(self, tokens):
-        tokens.save()
-        mo = self._pattern.match(tokens)
-        tokens.restore()
+    def match_pos(self, tokens, pos):
+        failed = tokens.save_failed()
+        mo = self._pattern.match_pos(tokens, pos)[1]
+        tokens.restore_failed(failed)
 
         if mo is MISMATCH:
-            return []
+            return pos, []
         else:
-            return MISMATCH
+            return pos, MISMATCH
+
+    match = _create_match(match_pos)
 
 
 class NoMatch(Pattern):
@@ -606,8 +1697,10 @@ class NoMatch(Pattern):
 
     """
 
-    def match(self, tokens):
-        return MISMATCH
+    def match_pos(self, tokens, pos):
+        return pos, MISMATCH
+
+    match = _create_match(match_pos)
 
 
 class Tag(Pattern):
@@ -624,64 +1717,3382 @@ class Tag(Pattern):
     def pattern(self):
         return self._pattern
 
-    def match(self, tokens):
-        mo = self._pattern.match(tokens)
+    def match_pos(self, tokens, pos):
+        pos, mo = self._pattern.match_pos(tokens, pos)
 
         if mo is not MISMATCH:
-            return (self._name, mo)
+            return pos, (self._name, mo)
         else:
-            return MISMATCH
+            return pos, MISMATCH
 
+    match = _create_match(match_pos)
 
-class Forward(Pattern):
-    """Forward declaration of a pattern.
 
-    .. code-block:: python
+class Recover(Pattern):
+    """Matches `pattern`. In recovery mode, see
+    :func:`~textparser.Grammar.parse_recover()`, a mismatch of
+    `pattern` is recorded as an error, and the tokens from the error
+    up to and including the next match of `sync` are skipped. The
+    skipped tokens become `default` in the parse tree.
+
+    A mismatch at the first token is not an error if the token may
+    follow this pattern in the grammar, so that repetitions of
+    recovered patterns end as usual. Other patterns are matched as
+    without recovery.
+
+    .. code-block:: python
+
+       >>> ZeroOrMore(Recover(statement, sync=';'))
+
+    """
+
+    def __init__(self, pattern, sync=';', default=None):
+        self._pattern = _wrap_string(pattern)
+        self._sync = _wrap_string(sync)
+        self._default = default
+        self._follow = None
+
+    def __getstate__(self):
+        state = super(Recover, self).__getstate__()
+
+        if self._follow is not None:
+            state['_follow'] = [_KIND_NAMES[kind_id]
+                                for kind_id in self._follow]
+
+        return state
+
+    def __setstate__(self, state):
+        super(Recover, self).__setstate__(state)
+
+        if self._follow is not None:
+            self._follow = frozenset([_kind_id(kind)
+                                      for kind in self._follow])
+
+    @property
+    def pattern(self):
+        return self._pattern
+
+    def match_pos(self, tokens, pos):
+        if tokens._errors is None:
+            return self._pattern.match_pos(tokens, pos)
+
+        outer = tokens.push_max()
+        end, mo = self._pattern.match_pos(tokens, pos)
+
+        if mo is MISMATCH:
+            end, mo = self._recover(tokens, pos, end)
+
+        tokens.pop_max(outer)
+
+        return end, mo
+
+    match = _create_match(match_pos)
+
+    def _recover(self, tokens, pos, end):
+        """Called in recovery mode when `pattern` failed at `end`, after
+        starting at `pos`. Returns the position after the skipped
+        tokens and the default value, or the failure position and
+        :data:`~textparser.MISMATCH` if the mismatch is not an error.
+
+        """
+
+        if tokens._max_pos > end:
+            end = tokens._max_pos
+
+        kinds = tokens._kinds
+
+        if end == pos:
+            kind_id = kinds[pos]
+
+            if (kind_id == _EOF_ID
+                or self._follow is None
+                or kind_id in self._follow):
+                return end, MISMATCH
+
+        tokens._errors.append(GrammarError(tokens.offset(end),
+                                           tokens.expected(end, False)))
+
+        while kinds[end] != _EOF_ID:
+            sync_end, mo = self._sync.match_pos(tokens, end)
+
+            if mo is not MISMATCH:
+                end = sync_end
+
+                break
+
+            end += 1
+
+        # The error is recorded, and its position no longer the max
+        # position.
+        tokens._max_pos = -1
+        tokens._expected = []
+
+        return end, self._default
+
+
+class Expression(Pattern):
+    """Matches an expression of `operand` and operators `operators`,
+    using precedence climbing.
+
+    `operators` is a list of ``(kinds, assoc, arity)`` tuples, ordered
+    from highest to lowest precedence. `kinds` is a token kind, or a
+    list of token kinds, of operators with the same precedence,
+    `assoc` is ``'left'`` or ``'right'``, and `arity` is ``1`` or
+    ``2``. Unary operators are prefix operators if `assoc` is
+    ``'right'``, and postfix operators if ``'left'``.
+
+    A binary operation becomes a list of the left operand, the
+    operator and the right operand in the parse tree, a prefix
+    operation a list of the operator and the operand, and a postfix
+    operation a list of the operand and the operator. An operand
+    without operators becomes its match.
+
+    .. code-block:: python
+
+       >>> Expression('NUMBER', [('-', 'right', 1),
+       ...                       (['*', '/'], 'left', 2),
+       ...                       (['+', '-'], 'left', 2)])
+
+    """
+
+    def __init__(self, operand, operators):
+        self._operand = _wrap_string(operand)
+        self._prefix = {}
+        self._infix = {}
+        self._postfix = {}
+        self._operators = operators
+
+        for i, (kinds, assoc, arity) in enumerate(operators):
+            precedence = len(operators) - i
+
+            if assoc not in ['left', 'right']:
+                raise Error(
+                    "Operator associativity must be 'left' or 'right', not "
+                    "{}.".format(assoc))
+
+            if arity == 1:
+                if assoc == 'right':
+                    table = self._prefix
+                else:
+                    table = self._postfix
+
+                value = precedence
+            elif arity == 2:
+                table = self._infix
+
+                # The lowest precedence of operators in the right
+                # operand.
+                if assoc == 'left':
+                    value = (precedence, precedence + 1)
+                else:
+                    value = (precedence, precedence)
+            else:
+                raise Error(
+                    'Operator arity must be 1 or 2, not {}.'.format(arity))
+
+            if isinstance(kinds, str):
+                kinds = [kinds]
+
+            for kind in kinds:
+                table[_kind_id(kind)] = value
+
+        self._follow = frozenset(self._infix) | frozenset(self._postfix)
+
+    def __getstate__(self):
+        state = super(Expression, self).__getstate__()
+        del state['_follow']
+
+        for name in ['_prefix', '_infix', '_postfix']:
+            state[name] = _kind_names_table(state[name])
+
+        return state
+
+    def __setstate__(self, state):
+        super(Expression, self).__setstate__(state)
+
+        for name in ['_prefix', '_infix', '_postfix']:
+            setattr(self, name, _kind_ids_table(getattr(self, name)))
+
+        self._follow = frozenset(self._infix) | frozenset(self._postfix)
+
+    @property
+    def operand(self):
+        return self._operand
+
+    @property
+    def operators(self):
+        return self._operators
+
+    def match_pos(self, tokens, pos):
+        kinds = tokens._kinds
+        prefix = self._prefix
+        infix = self._infix
+        postfix = self._postfix
+        operands = []
+        operators = []
+        depth = None
+
+        while True:
+            start = pos
+
+            while kinds[pos] in prefix:
+                operators.append((prefix[kinds[pos]], tokens.value(pos), 1))
+                pos += 1
+
+            end, mo = self._operand.match_pos(tokens, pos)
+
+            if mo is MISMATCH:
+                # Prefix operators may precede any operand.
+                if end == pos and prefix:
+                    tokens.fail(pos, prefix)
+
+                if depth is None:
+                    return end, MISMATCH
+
+                if end >= tokens._max_pos:
+                    tokens.mark_max(end)
+
+                # Backtrack to before the binary operator.
+                del operators[depth:]
+                pos = start - 1
+                break
+
+            operands.append(mo)
+            pos = end
+
+            while kinds[pos] in postfix:
+                _reduce_expression(operands, operators, postfix[kinds[pos]])
+                operands[-1] = [operands[-1], tokens.value(pos)]
+                pos += 1
+
+            if kinds[pos] not in infix:
+                tokens.fail(pos, self._follow)
+
+                break
+
+            precedence, minimum = infix[kinds[pos]]
+            _reduce_expression(operands, operators, precedence)
+            depth = len(operators)
+            operators.append((minimum, tokens.value(pos), 2))
+            pos += 1
+
+        _reduce_expression(operands, operators, 0)
+
+        return pos, operands[0]
+
+    match = _create_match(match_pos)
+
+
+def _reduce_expression(operands, operators, precedence):
+    """Apply operators in the stack `operators` to the operands in the
+    stack `operands`, until an operator whose operand may contain an
+    operator of given precedence is found.
+
+    """
+
+    while operators and precedence < operators[-1][0]:
+        _, operator, arity = operators.pop()
+
+        if arity == 1:
+            operands[-1] = [operator, operands[-1]]
+        else:
+            right = operands.pop()
+            operands[-1] = [operands[-1], operator, right]
+
+
+class Flatten(Pattern):
+    """Matches `pattern`. A list match is spliced into the list of an
+    enclosing :class:`~textparser.Sequence`,
+    :class:`~textparser.Repeated` or
+    :class:`~textparser.DelimitedList` instead of being nested in
+    it. Any other match is added as is.
+
+    """
+
+    def __init__(self, pattern):
+        self._pattern = _wrap_string(pattern)
+
+    @property
+    def pattern(self):
+        return self._pattern
+
+    def match_pos(self, tokens, pos):
+        return self._pattern.match_pos(tokens, pos)
+
+    match = _create_match(match_pos)
+
+
+class Suppress(Flatten):
+    """Matches `pattern`, but leaves it out of the list of an enclosing
+    :class:`~textparser.Sequence`, :class:`~textparser.Repeated` or
+    :class:`~textparser.DelimitedList`. Becomes an empty list in the
+    parse tree elsewhere.
+
+    """
+
+    def match_pos(self, tokens, pos):
+        pos, mo = self._pattern.match_pos(tokens, pos)
+
+        if mo is MISMATCH:
+            return pos, MISMATCH
+        else:
+            return pos, []
+
+    match = _create_match(match_pos)
+
+
+_FLATTEN = 1
+_SUPPRESS = 2
+
+
+def _shape(pattern):
+    """Returns a two-tuple of the pattern to match and how to add its
+    match to an enclosing list, or ``None`` if the match of given
+    pattern is added as is.
+
+    """
+
+    match = type(pattern).match
+
+    if match == Flatten.match:
+        return (pattern.pattern, _FLATTEN)
+    elif match == Suppress.match:
+        return (pattern.pattern, _SUPPRESS)
+    else:
+        return None
+
+
+def _string_kind_id(pattern):
+    """Returns the kind id of given pattern if it is a string pattern,
+    and ``None`` otherwise. Repetitions of string patterns are matched
+    by scanning the token kinds.
+
+    """
+
+    if type(pattern).match == _String.match:
+        return pattern.kind_id
+    else:
+        return None
+
+
+def _string_kind_ids(pattern, delim):
+    kind_id = _string_kind_id(pattern)
+    delim_kind_id = _string_kind_id(delim)
+
+    if kind_id is None or delim_kind_id is None:
+        return None
+
+    return (kind_id, delim_kind_id)
+
+
+def _shapes(patterns):
+    shapes = [_shape(pattern) for pattern in patterns]
+
+    if all(shape is None for shape in shapes):
+        return None
+
+    return [shape or (pattern, None)
+            for pattern, shape in zip(patterns, shapes)]
+
+
+def _add_shaped(matched, mo, shape):
+    if shape is None:
+        matched.append(mo)
+    elif shape == _FLATTEN:
+        if type(mo) is list:
+            matched.extend(mo)
+        else:
+            matched.append(mo)
+
+
+class _Deferred(object):
+    """A call of `function` with `value`, deferred until the match is
+    known to be part of the parse tree.
+
+    """
+
+    __slots__ = ('function', 'value')
+
+    def __init__(self, function, value):
+        self.function = function
+        self.value = value
+
+
+def _resolve_deferred(value):
+    """Returns given value with all deferred action calls replaced by
+    their results. Lists and dictionaries are modified in place. Action
+    results are not searched, as they never contain deferred calls.
+
+    """
+
+    kind = type(value)
+
+    if kind is _Deferred:
+        if value.function is not None:
+            value.value = value.function(_resolve_deferred(value.value))
+            value.function = None
+
+        return value.value
+    elif kind is list:
+        for i, item in enumerate(value):
+            value[i] = _resolve_deferred(item)
+    elif kind is tuple:
+        value = tuple([_resolve_deferred(item) for item in value])
+    elif kind is dict:
+        for key, items in value.items():
+            value[key] = _resolve_deferred(items)
+
+    return value
+
+
+class Action(Pattern):
+    """Calls `function` with any match of `pattern`, and uses its return
+    value in the parse tree instead of the match. Use it to build the
+    final objects while parsing, instead of walking the parse tree
+    afterwards.
+
+    `function` is only called for matches that are part of the parse
+    tree, never for matches the parser later backtracks from. It is
+    called as soon as the match is complete if the grammar allows the
+    parser to know that it will not backtrack, which is the case for
+    grammars where all choices can be made by looking at the next
+    token, as for example JSON. Otherwise the call is deferred until
+    it is known. Matches of an action pattern that may match no
+    tokens are always deferred.
+
+    .. code-block:: python
+
+       >>> Action('NUMBER', float)
+
+    """
+
+    def __init__(self, pattern, function):
+        self._pattern = _wrap_string(pattern)
+        self._function = function
+        self._deferred = False
+        self._resolve = False
+
+    @property
+    def pattern(self):
+        return self._pattern
+
+    @property
+    def function(self):
+        return self._function
+
+    def _apply(self, mo):
+        if self._deferred:
+            return _Deferred(self._function, mo)
+
+        if self._resolve:
+            mo = _resolve_deferred(mo)
+
+        return self._function(mo)
+
+    def match_pos(self, tokens, pos):
+        pos, mo = self._pattern.match_pos(tokens, pos)
+
+        if mo is not MISMATCH:
+            return pos, self._apply(mo)
+        else:
+            return pos, MISMATCH
+
+    match = _create_match(match_pos)
+
+
+class Forward(Pattern):
+    """Forward declaration of a pattern.
+
+    .. code-block:: python
 
        >>> foo = Forward()
        >>> foo <<= Sequence('NUMBER')
 
-    """
+    """
+
+    def __init__(self):
+        self._pattern = None
+
+    @property
+    def pattern(self):
+        return self._pattern
+
+    def __ilshift__(self, other):
+        self._pattern = _wrap_string(other)
+
+        return self
+
+    def match_pos(self, tokens, pos):
+        return self._pattern.match_pos(tokens, pos)
+
+    match = _create_match(match_pos)
+
+
+class _Memoized(Pattern):
+    """Packrat memoization of `pattern` matches.
+
+    """
+
+    def __init__(self, pattern):
+        self._pattern = pattern
+
+    def match_pos(self, tokens, pos):
+        memo = tokens._memo
+        entry = memo.get(self, pos)
+
+        if entry is not None:
+            mo, end, max_pos, expected, failed_pos, failed = entry
+            tokens.pop_max((max_pos, list(expected)))
+            tokens._failed_pos = failed_pos
+            tokens._failed = list(failed)
+
+            return end, mo
+
+        outer = tokens.push_max()
+        end, mo = self._pattern.match_pos(tokens, pos)
+
+        # Zero length matches are not memoized, as their values could
+        # otherwise appear more than once in the parse tree.
+        if mo is MISMATCH or end != pos:
+            memo.put(self, pos, (mo,
+                                 end,
+                                 tokens._max_pos,
+                                 list(tokens._expected),
+                                 tokens._failed_pos,
+                                 list(tokens._failed)))
+
+        tokens.pop_max(outer)
+
+        return end, mo
+
+    match = _create_match(match_pos)
+
+
+class _MemoTable(object):
+
+    def __init__(self):
+        self._entries = {}
+
+    def get(self, pattern, pos):
+        return self._entries.get((pattern, pos))
+
+    def put(self, pattern, pos, entry):
+        self._entries[(pattern, pos)] = entry
+
+
+class _WindowMemoTable(object):
+
+    def __init__(self, window):
+        self._window = window
+        self._entries = {}
+        self._low_pos = 0
+
+    def get(self, pattern, pos):
+        entries = self._entries.get(pos)
+
+        if entries is not None:
+            return entries.get(pattern)
+
+    def put(self, pattern, pos, entry):
+        try:
+            self._entries[pos][pattern] = entry
+        except KeyError:
+            self._entries[pos] = {pattern: entry}
+            low_pos = pos - self._window
+
+            if low_pos > self._low_pos:
+                for old_pos in range(self._low_pos, low_pos):
+                    self._entries.pop(old_pos, None)
+
+                self._low_pos = low_pos
+
+
+class _LruMemoTable(object):
+
+    def __init__(self, size):
+        self._size = size
+        self._entries = OrderedDict()
+
+    def get(self, pattern, pos):
+        key = (pattern, pos)
+        entry = self._entries.get(key)
+
+        if entry is not None:
+            self._entries.move_to_end(key)
+
+        return entry
+
+    def put(self, pattern, pos, entry):
+        self._entries[(pattern, pos)] = entry
+
+        if len(self._entries) > self._size:
+            self._entries.popitem(last=False)
+
+
+class Packrat(object):
+    """Packrat parsing settings, given to
+    :func:`~textparser.Grammar.parse()` and
+    :func:`~textparser.Parser.parse()`.
+
+    Match results are memoized per pattern and token position, so a
+    pattern is matched at most once at any position, even if the
+    parser backtracks. By default all results are kept until parsing
+    ends. Give `window` to only keep results for the last `window`
+    token positions, or `size` to keep at most `size` results,
+    discarding the least recently used first.
+
+    """
+
+    def __init__(self, window=None, size=None):
+        if window is not None and size is not None:
+            raise Error('Only one of window and size may be given.')
+
+        self.window = window
+        self.size = size
+
+    def create_memo_table(self):
+        if self.window is not None:
+            return _WindowMemoTable(self.window)
+        elif self.size is not None:
+            return _LruMemoTable(self.size)
+        else:
+            return _MemoTable()
+
+
+def _memoize(pattern):
+    if isinstance(pattern, (_String, Any, NoMatch, Forward, Tag)):
+        return pattern
+    else:
+        return _Memoized(pattern)
+
+
+def _iter_children(pattern):
+    """Yields the child patterns of given pattern. Children are found the
+    same way as in :func:`_transform_graph`.
+
+    """
+
+    stack = list(vars(pattern).values())
+
+    while stack:
+        item = stack.pop()
+
+        if _is_pattern(item):
+            yield item
+        elif isinstance(item, (list, tuple)):
+            stack.extend(item)
+        elif isinstance(item, dict):
+            stack.extend(item.values())
+
+
+def _iter_patterns(root):
+    """Yields all patterns in the pattern graph `root`, once each.
+
+    """
+
+    visited = set([id(root)])
+    stack = [root]
+
+    while stack:
+        pattern = stack.pop()
+
+        yield pattern
+
+        for child in _iter_children(pattern):
+            if id(child) not in visited:
+                visited.add(id(child))
+                stack.append(child)
+
+
+class _FirstSets(object):
+    """FIRST sets and nullability of all patterns in the pattern graph
+    `root`.
+
+    The FIRST set of a pattern is the set of token kind ids it may
+    start with, or ``None`` if it may start with any token kind. A
+    pattern is nullable if it may match without consuming any
+    tokens. Patterns that are not built-in, or override the built-in
+    match method, may start with any token kind and are nullable.
+
+    """
+
+    def __init__(self, root):
+        self._patterns = list(_iter_patterns(root))
+        self._first = {}
+        self._nullable = {}
+        self._rules = {
+            _String.match: self._string,
+            Sequence.match: self._sequence,
+            Choice.match: self._choice,
+            ChoiceDict.match: self._choice_dict,
+            Repeated.match: self._repeated,
+            RepeatedDict.match: self._repeated,
+            DelimitedList.match: self._delimited_list,
+            Optional.match: self._optional,
+            Any.match: self._any,
+            AnyUntil.match: self._any_until,
+            And.match: self._lookahead,
+            Not.match: self._lookahead,
+            NoMatch.match: self._no_match,
+            Expression.match: self._expression,
+            Tag.match: self._inner,
+            Recover.match: self._inner,
+            Flatten.match: self._inner,
+            Suppress.match: self._inner,
+            Forward.match: self._inner,
+            Action.match: self._inner
+        }
+
+        for pattern in self._patterns:
+            self._first[id(pattern)] = frozenset()
+            self._nullable[id(pattern)] = False
+
+        # Iterate until nothing changes, as recursive grammars have
+        # cycles.
+        changed = True
+
+        while changed:
+            changed = False
+
+            for pattern in self._patterns:
+                rule = self._rules.get(type(pattern).match, self._unknown)
+                first, nullable = rule(pattern)
+                key = id(pattern)
+
+                if (first != self._first[key]
+                    or nullable != self._nullable[key]):
+                    self._first[key] = first
+                    self._nullable[key] = nullable
+                    changed = True
+
+    @property
+    def patterns(self):
+        return self._patterns
+
+    def first(self, pattern):
+        return self._first[id(pattern)]
+
+    def nullable(self, pattern):
+        return self._nullable[id(pattern)]
+
+    def _union(self, patterns):
+        """Returns the FIRST set and nullability of given patterns, where
+        any of them may match.
+
+        """
+
+        first = frozenset()
+        nullable = False
+
+        for pattern in patterns:
+            first = _first_union(first, self.first(pattern))
+            nullable = nullable or self.nullable(pattern)
+
+        return first, nullable
+
+    def concatenation(self, patterns):
+        """Returns the FIRST set and nullability of given patterns, matched
+        one after the other.
+
+        """
+
+        first = frozenset()
+
+        for pattern in patterns:
+            first = _first_union(first, self.first(pattern))
+
+            if not self.nullable(pattern):
+                return first, False
+
+        return first, True
+
+    def _string(self, pattern):
+        return frozenset([pattern.kind_id]), False
+
+    def _sequence(self, pattern):
+        return self.concatenation(pattern.patterns)
+
+    def _choice(self, pattern):
+        return self._union(pattern._patterns)
+
+    def _choice_dict(self, pattern):
+        return self._union(pattern.patterns_map.values())
+
+    def _repeated(self, pattern):
+        first = self.first(pattern._pattern)
+        nullable = pattern._minimum == 0 or self.nullable(pattern._pattern)
+
+        return first, nullable
+
+    def _delimited_list(self, pattern):
+        first = self.concatenation([pattern._pattern,
+                                    pattern._delim,
+                                    pattern._pattern])[0]
+
+        return first, self.nullable(pattern._pattern)
+
+    def _optional(self, pattern):
+        return self.first(pattern._pattern), True
+
+    def _any(self, _pattern):
+        return None, False
+
+    def _expression(self, pattern):
+        first = _first_union(self.first(pattern._operand),
+                             frozenset(pattern._prefix))
+
+        return first, self.nullable(pattern._operand)
+
+    def _any_until(self, _pattern):
+        return None, True
+
+    def _lookahead(self, _pattern):
+        return frozenset(), True
+
+    def _no_match(self, _pattern):
+        return frozenset(), False
+
+    def _inner(self, pattern):
+        if pattern.pattern is None:
+            return None, True
+
+        return self.first(pattern.pattern), self.nullable(pattern.pattern)
+
+    def _unknown(self, _pattern):
+        return None, True
+
+
+def _first_union(first, other):
+    if first is None or other is None:
+        return None
+    else:
+        return first | other
+
+
+def _first_overlap(first, other):
+    if first is None or other is None:
+        return True
+    else:
+        return not first.isdisjoint(other)
+
+
+def _install_choice_dispatch(first_sets):
+    """Gives each :class:`~textparser.Choice` in given FIRST sets' pattern
+    graph a table of the alternatives that can start with each token
+    kind, if any alternative can be skipped for some token kind.
+
+    An alternative can start with a token kind if it is in its FIRST
+    set, or if it is nullable. Each alternative is given with a flag
+    telling if it is the last one, as the max position is not updated
+    after the last alternative fails, and the union of the FIRST sets
+    of the alternatives skipped before it, or ``None`` if none
+    were. The FIRST sets of alternatives skipped after the last tried
+    one are given last, without an alternative.
+
+    """
+
+    for pattern in first_sets.patterns:
+        if type(pattern).match != Choice.match:
+            continue
+
+        alternatives = list(pattern._patterns)
+        kind_ids = set()
+        default = []
+
+        for i, alternative in enumerate(alternatives):
+            first = first_sets.first(alternative)
+
+            if first is None or first_sets.nullable(alternative):
+                default.append(i)
+            else:
+                kind_ids |= first
+
+        if len(default) == len(alternatives):
+            pattern._dispatch = None
+
+            continue
+
+        table = {}
+
+        for kind_id in kind_ids:
+            table[kind_id] = _dispatch_alternatives(
+                alternatives,
+                [i for i, alternative in enumerate(alternatives)
+                 if i in default or kind_id in first_sets.first(alternative)],
+                first_sets)
+
+        pattern._dispatch = (table,
+                             _dispatch_alternatives(alternatives,
+                                                    default,
+                                                    first_sets))
+
+
+def _dispatch_alternatives(alternatives, tried, first_sets):
+    """Returns the dispatch table entry trying given indices `tried` of
+    given alternatives, as described in
+    :func:`_install_choice_dispatch()`.
+
+    """
+
+    last = len(alternatives) - 1
+    entry = []
+    skipped = set()
+
+    for i, alternative in enumerate(alternatives):
+        if i in tried:
+            entry.append((alternative,
+                          i == last,
+                          frozenset(skipped) if skipped else None))
+            skipped = set()
+        else:
+            skipped |= first_sets.first(alternative)
+
+    if skipped:
+        entry.append((None, True, frozenset(skipped)))
+
+    return tuple(entry)
+
+
+class _FollowSets(object):
+    """FOLLOW sets of all patterns in the pattern graph `root`, that is,
+    the token kind ids that may follow a match of each pattern, or
+    ``None`` for any token kind.
+
+    """
+
+    def __init__(self, root, first_sets):
+        self._first_sets = first_sets
+        self._follow = {}
+        self._rules = {
+            Sequence.match: self._sequence,
+            Choice.match: self._inner,
+            ChoiceDict.match: self._inner,
+            Repeated.match: self._repeated,
+            RepeatedDict.match: self._repeated,
+            DelimitedList.match: self._delimited_list,
+            Optional.match: self._inner,
+            Expression.match: self._expression,
+            Tag.match: self._inner,
+            Recover.match: self._inner,
+            Flatten.match: self._inner,
+            Suppress.match: self._inner,
+            Forward.match: self._inner,
+            Action.match: self._inner
+        }
+
+        for pattern in first_sets.patterns:
+            self._follow[id(pattern)] = frozenset()
+
+        self._follow[id(root)] = frozenset([_EOF_ID])
+        changed = True
+
+        while changed:
+            changed = False
+
+            for pattern in first_sets.patterns:
+                rule = self._rules.get(type(pattern).match, self._unknown)
+
+                for child, follow in rule(pattern):
+                    key = id(child)
+                    follow = _first_union(self._follow[key], follow)
+
+                    if follow != self._follow[key]:
+                        self._follow[key] = follow
+                        changed = True
+
+    def follow(self, pattern):
+        return self._follow[id(pattern)]
+
+    def _sequence(self, pattern):
+        patterns = pattern.patterns
+
+        for i, child in enumerate(patterns):
+            first, nullable = self._first_sets.concatenation(patterns[i + 1:])
+
+            if nullable:
+                first = _first_union(first, self.follow(pattern))
+
+            yield child, first
+
+    def _inner(self, pattern):
+        follow = self.follow(pattern)
+
+        for child in _iter_children(pattern):
+            yield child, follow
+
+    def _repeated(self, pattern):
+        yield pattern._pattern, _first_union(
+            self._first_sets.first(pattern._pattern),
+            self.follow(pattern))
+
+    def _delimited_list(self, pattern):
+        first_sets = self._first_sets
+        follow = _first_union(first_sets.first(pattern._delim),
+                              self.follow(pattern))
+
+        if first_sets.nullable(pattern._delim):
+            follow = _first_union(follow, first_sets.first(pattern._pattern))
+
+        yield pattern._pattern, follow
+        follow = first_sets.first(pattern._pattern)
+
+        if first_sets.nullable(pattern._pattern):
+            follow = _first_union(follow, first_sets.first(pattern._delim))
+            follow = _first_union(follow, self.follow(pattern))
+
+        yield pattern._delim, follow
+
+    def _expression(self, pattern):
+        follow = frozenset(pattern._infix) | frozenset(pattern._postfix)
+
+        yield pattern._operand, _first_union(follow, self.follow(pattern))
+
+    def _unknown(self, pattern):
+        for child in _iter_children(pattern):
+            yield child, None
+
+
+def _install_recovers(root, first_sets):
+    """Gives each :class:`~textparser.Recover` in the pattern graph
+    `root` the token kind ids that may follow it, or ``None`` for any
+    token kind.
+
+    """
+
+    recovers = [pattern
+                for pattern in first_sets.patterns
+                if type(pattern).match == Recover.match]
+
+    if not recovers:
+        return
+
+    follow_sets = _FollowSets(root, first_sets)
+
+    for pattern in recovers:
+        pattern._follow = follow_sets.follow(pattern)
+
+
+def _install_actions(root, first_sets):
+    """Decides which :class:`~textparser.Action` calls in the pattern
+    graph `root` are deferred, and returns ``True`` if the parse tree
+    may contain deferred calls.
+
+    A call is deferred if the parser may backtrack from the match. A
+    pattern that may discard matches of its children, a backtracking
+    point, is harmless if its children only discard matches after
+    consuming a token that cannot follow it, as the parser then
+    fails. For a choice the alternatives must also start with
+    different tokens. Children of harmful backtracking points, and all
+    their descendants, are speculative. Lookahead patterns always
+    discard the matches of their children.
+
+    """
+
+    actions = [pattern
+               for pattern in first_sets.patterns
+               if type(pattern).match == Action.match]
+
+    if not actions:
+        return False
+
+    follow_sets = _FollowSets(root, first_sets)
+    speculative = set()
+    visited = set()
+    stack = [(root, False)]
+
+    while stack:
+        pattern, is_speculative = stack.pop()
+        key = (id(pattern), is_speculative)
+
+        if key in visited:
+            continue
+
+        visited.add(key)
+
+        if is_speculative:
+            speculative.add(id(pattern))
+
+        harmful = _is_harmful_backtracking(pattern, first_sets, follow_sets)
+
+        for child in _iter_children(pattern):
+            stack.append((child, is_speculative or harmful))
+
+    for action in actions:
+        if (id(action) in speculative
+            or first_sets.nullable(action.pattern)):
+            action._deferred = True
+
+    for action in actions:
+        if not action._deferred:
+            action._resolve |= _may_contain_deferred(action.pattern)
+
+    return _may_contain_deferred(root)
+
+
+def _has_grammar_state(patterns):
+    """Returns ``True`` if any of given patterns is given state specific
+    to a grammar, that is a :class:`~textparser.Choice`,
+    :class:`~textparser.Recover` or :class:`~textparser.Action`.
+
+    """
+
+    matches = (Choice.match, Recover.match, Action.match)
+
+    return any(type(pattern).match in matches for pattern in patterns)
+
+
+def _is_harmful_backtracking(pattern, first_sets, follow_sets):
+    match = type(pattern).match
+
+    if match in (Sequence.match,
+                 ChoiceDict.match,
+                 Tag.match,
+                 Flatten.match,
+                 Suppress.match,
+                 Forward.match,
+                 Action.match,
+                 _String.match,
+                 Any.match,
+                 NoMatch.match):
+        return False
+    elif match == Choice.match:
+        kind_ids = frozenset()
+
+        for alternative in pattern._patterns:
+            first = first_sets.first(alternative)
+
+            if first_sets.nullable(alternative):
+                first = _first_union(first, follow_sets.follow(pattern))
+
+            if _first_overlap(first, kind_ids):
+                return True
+
+            kind_ids = first | kind_ids
+
+        return False
+    elif match in (Repeated.match, RepeatedDict.match, Optional.match):
+        return _first_overlap(first_sets.first(pattern._pattern),
+                              follow_sets.follow(pattern))
+    elif match == Expression.match:
+        if first_sets.nullable(pattern._operand):
+            return True
+
+        kind_ids = frozenset(pattern._infix) | frozenset(pattern._postfix)
+
+        return _first_overlap(kind_ids, follow_sets.follow(pattern))
+    elif match == DelimitedList.match:
+        first = first_sets.first(pattern._delim)
+
+        if first_sets.nullable(pattern._delim):
+            first = _first_union(first, first_sets.first(pattern._pattern))
+
+        return _first_overlap(first, follow_sets.follow(pattern))
+    else:
+        return True
+
+
+def _may_contain_deferred(pattern):
+    """Returns ``True`` if a match of given pattern may contain deferred
+    action calls not resolved by an immediate action call.
+
+    """
+
+    visited = set([id(pattern)])
+    stack = [pattern]
+
+    while stack:
+        pattern = stack.pop()
+
+        if type(pattern).match == Action.match:
+            if pattern._deferred:
+                return True
+
+            continue
+
+        for child in _iter_children(pattern):
+            if id(child) not in visited:
+                visited.add(id(child))
+                stack.append(child)
+
+    return False
+
+
+class _MatchSites(object):
+    """Flags telling how the match attempts of each pattern in the pattern
+    graph `root` affect the max position, that is, the error offset.
+
+    A pattern is start marked if the max position is at least its
+    start position when it is tried, and its failure position is
+    ignored if it never is used. Each flag must hold for all places
+    the pattern is matched from.
+
+    """
+
+    BUILTINS = frozenset([
+        Sequence.match,
+        Choice.match,
+        ChoiceDict.match,
+        Repeated.match,
+        RepeatedDict.match,
+        DelimitedList.match,
+        Optional.match,
+        AnyUntil.match,
+        And.match,
+        Not.match,
+        Expression.match,
+        Tag.match,
+        Recover.match,
+        Flatten.match,
+        Suppress.match,
+        Forward.match,
+        Action.match
+    ])
+
+    def __init__(self, root):
+        self._flags = {}
+        self._rules = {
+            Sequence.match: self._sequence,
+            Choice.match: self._choice,
+            ChoiceDict.match: self._choice_dict,
+            Repeated.match: self._repeated,
+            RepeatedDict.match: self._repeated,
+            DelimitedList.match: self._delimited_list,
+            Optional.match: self._optional,
+            AnyUntil.match: self._any_until,
+            And.match: self._lookahead,
+            Not.match: self._lookahead,
+            Expression.match: self._expression,
+            Tag.match: self._inner,
+            Recover.match: self._inner,
+            Flatten.match: self._inner,
+            Suppress.match: self._inner,
+            Forward.match: self._inner,
+            Action.match: self._inner,
+            _String.match: self._leaf,
+            Any.match: self._leaf,
+            NoMatch.match: self._leaf
+        }
+        patterns = list(_iter_patterns(root))
+
+        for pattern in patterns:
+            self._flags[id(pattern)] = (True, True)
+
+        # The root start position is never above the position the
+        # parse ends at, which is used as error offset, and the root
+        # failure position is the position the parse ends at.
+        self._flags[id(root)] = (True, False)
+        changed = True
+
+        while changed:
+            changed = False
+
+            for pattern in patterns:
+                rule = self._rules.get(type(pattern).match, self._unknown)
+                start_marked, ignored = self._flags[id(pattern)]
+
+                for child, flags in rule(pattern, start_marked, ignored):
+                    key = id(child)
+                    old_flags = self._flags[key]
+                    new_flags = (old_flags[0] and flags[0],
+                                 old_flags[1] and flags[1])
+
+                    if new_flags != old_flags:
+                        self._flags[key] = new_flags
+                        changed = True
+
+    def start_marked(self, pattern):
+        return self._flags[id(pattern)][0]
+
+    def failure_ignored(self, pattern):
+        return self._flags[id(pattern)][1]
+
+    def _sequence(self, pattern, start_marked, ignored):
+        for i, child in enumerate(pattern.patterns):
+            yield child, (start_marked and i == 0, ignored)
+
+    def _choice(self, pattern, _start_marked, _ignored):
+        # The failure position of the last alternative is replaced by
+        # the start position, and the others are marked.
+        last = len(pattern._patterns) - 1
+
+        for i, child in enumerate(pattern._patterns):
+            yield child, (True, i == last)
+
+    def _choice_dict(self, pattern, start_marked, ignored):
+        for child in pattern.patterns_map.values():
+            yield child, (start_marked, ignored)
+
+    def _repeated(self, pattern, _start_marked, _ignored):
+        yield pattern._pattern, (False, False)
+
+    def _delimited_list(self, pattern, _start_marked, ignored):
+        yield pattern._pattern, (False, ignored)
+        yield pattern._delim, (False, True)
+
+    def _optional(self, pattern, start_marked, _ignored):
+        yield pattern._pattern, (start_marked, False)
+
+    def _any_until(self, pattern, _start_marked, _ignored):
+        yield pattern._pattern, (False, True)
+
+    def _lookahead(self, pattern, start_marked, _ignored):
+        yield pattern._pattern, (start_marked, True)
+
+    def _expression(self, pattern, _start_marked, _ignored):
+        yield pattern._operand, (False, False)
+
+    def _inner(self, pattern, start_marked, ignored):
+        if pattern.pattern is not None:
+            yield pattern.pattern, (start_marked, ignored)
+
+    def _leaf(self, _pattern, _start_marked, _ignored):
+        return []
+
+    def _unknown(self, pattern, _start_marked, _ignored):
+        for child in _iter_children(pattern):
+            yield child, (False, False)
+
+
+def _fails_at_start(pattern, replaced, visited=None):
+    """Returns ``True`` if given pattern always returns its start position
+    on mismatch. Choices in `replaced` may not.
+
+    """
+
+    if visited is None:
+        visited = set()
+
+    if id(pattern) in visited:
+        return False
+
+    visited.add(id(pattern))
+    match = type(pattern).match
+
+    if match == Choice.match:
+        return id(pattern) not in replaced
+    elif match in (_String.match,
+                   Any.match,
+                   NoMatch.match,
+                   And.match,
+                   Not.match):
+        return True
+    elif match in (Tag.match,
+                   Flatten.match,
+                   Suppress.match,
+                   Forward.match,
+                   Action.match):
+        return (pattern.pattern is not None
+                and _fails_at_start(pattern.pattern, replaced, visited))
+    elif match == ChoiceDict.match:
+        return all(_fails_at_start(child, replaced, visited)
+                   for child in pattern.patterns_map.values())
+    else:
+        return False
+
+
+def _map_children(patterns, function):
+    """Replace the children of given built-in patterns with the patterns
+    returned by `function`.
+
+    """
+
+    def map_item(item):
+        if _is_pattern(item):
+            return function(item)
+        elif isinstance(item, (list, tuple)):
+            return type(item)([map_item(element) for element in item])
+        elif isinstance(item, dict):
+            return {key: map_item(value) for key, value in item.items()}
+        else:
+            return item
+
+    for pattern in patterns:
+        if type(pattern).match in _MatchSites.BUILTINS:
+            for name, value in list(vars(pattern).items()):
+                setattr(pattern, name, map_item(value))
+
+
+def _inline_sequences(patterns, visited=None):
+    """Returns given sequence patterns with the patterns of flattened or
+    suppressed inner sequences inlined.
+
+    """
+
+    if visited is None:
+        visited = set()
+
+    inlined = []
+
+    for pattern in patterns:
+        match = type(pattern).match
+
+        if (match in (Flatten.match, Suppress.match)
+            and type(pattern.pattern).match == Sequence.match
+            and id(pattern.pattern) not in visited):
+            visited.add(id(pattern.pattern))
+            inner = _inline_sequences(pattern.pattern.patterns, visited)
+            visited.remove(id(pattern.pattern))
+
+            if match == Suppress.match:
+                inner = [_suppressed(child) for child in inner]
+
+            inlined += inner
+        else:
+            inlined.append(pattern)
+
+    return inlined
+
+
+def _suppressed(pattern):
+    match = type(pattern).match
+
+    if match == Suppress.match:
+        return pattern
+    elif match == Flatten.match:
+        return Suppress(pattern.pattern)
+    else:
+        return Suppress(pattern)
+
+
+def _optimize(root):
+    """Returns an optimized copy of the pattern graph `root`, which
+    creates the same parse trees and errors. Only built-in patterns
+    are rewritten.
+
+    """
+
+    root = _transform_graph(root, lambda pattern: pattern)
+    strings = {}
+
+    def resolve(pattern):
+        # Flatten and suppress patterns must not become children of
+        # sequences and repetitions.
+        while (type(pattern).match == Forward.match
+               and pattern.pattern is not None
+               and type(pattern.pattern).match not in (Flatten.match,
+                                                       Suppress.match)):
+            pattern = pattern.pattern
+
+        if type(pattern).match == _String.match:
+            pattern = strings.setdefault(pattern.kind, pattern)
+
+        return pattern
+
+    # Remove forward indirections and duplicated strings, and inline
+    # flattened and suppressed inner sequences.
+    patterns = list(_iter_patterns(root))
+    _map_children(patterns, resolve)
+    root = resolve(root)
+    patterns = list(_iter_patterns(root))
+
+    for pattern in patterns:
+        if type(pattern).match == Sequence.match:
+            pattern.patterns = _inline_sequences(pattern.patterns)
+            pattern._shapes = _shapes(pattern.patterns)
+
+    # Replace choices with cheaper patterns, if the max position is
+    # not changed.
+    patterns = list(_iter_patterns(root))
+    choices = [pattern
+               for pattern in patterns
+               if type(pattern).match == Choice.match]
+    sites = _MatchSites(root)
+
+    # Choices replaced by patterns that may not fail at their start
+    # position. Grows until all replacements are known.
+    replaced = set()
+
+    while True:
+        replacements = {}
+
+        for pattern in choices:
+            replacement = _choice_replacement(pattern, sites, replaced)
+
+            if replacement is not None:
+                replacements[id(pattern)] = replacement
+
+        size = len(replaced)
+
+        for pattern in choices:
+            key = id(pattern)
+
+            if (key in replacements
+                and not _fails_at_start(replacements[key], replaced)):
+                replaced.add(key)
+
+        if len(replaced) == size:
+            break
+
+    def replace(pattern):
+        while id(pattern) in replacements:
+            pattern = replacements[id(pattern)]
+
+        return pattern
+
+    _map_children(patterns, replace)
+    root = replace(root)
+
+    for pattern in _iter_patterns(root):
+        match = type(pattern).match
+
+        if match == Choice.match:
+            pattern._dispatch = None
+        elif match in (Repeated.match, AnyUntil.match):
+            pattern._kind_id = _string_kind_id(pattern._pattern)
+        elif match == DelimitedList.match:
+            pattern._kind_ids = _string_kind_ids(pattern._pattern,
+                                                 pattern._delim)
+
+    return root
+
+
+def _choice_replacement(pattern, sites, replaced):
+    """Returns a cheaper pattern matching the same as given choice, or
+    ``None`` if there is none.
+
+    A choice marks its start position, which must already be marked,
+    and its failure position is its start position, which must be the
+    failure position of the replacement as well, or ignored.
+
+    """
+
+    alternatives = pattern._patterns
+
+    if not alternatives:
+        return NoMatch()
+
+    if not sites.start_marked(pattern):
+        return None
+
+    if all(_fails_at_start(alternative, replaced)
+           for alternative in alternatives):
+        if len(alternatives) > 1:
+            try:
+                return ChoiceDict(*alternatives)
+            except Error:
+                return None
+    elif len(alternatives) > 1 or not sites.failure_ignored(pattern):
+        return None
+
+    alternative = alternatives[0]
+
+    # Flatten and suppress patterns must not become children of
+    # sequences and repetitions.
+    if type(alternative).match in (Flatten.match, Suppress.match):
+        return None
+
+    return alternative
+
+
+def _stack_sequence(pattern, tokens):
+    matched = []
+
+    if pattern._shapes is None:
+        for inner in pattern.patterns:
+            mo = yield inner
+
+            if mo is MISMATCH:
+                yield (MISMATCH, )
+
+            matched.append(mo)
+    else:
+        for inner, shape in pattern._shapes:
+            mo = yield inner
+
+            if mo is MISMATCH:
+                yield (MISMATCH, )
+
+            _add_shaped(matched, mo, shape)
+
+    yield (matched, )
+
+
+def _stack_choice(pattern, tokens):
+    tokens.save()
+
+    if pattern._dispatch is None:
+        for inner in pattern._patterns:
+            tokens.mark_max_load()
+            mo = yield inner
+
+            if mo is not MISMATCH:
+                tokens.drop()
+
+                yield (mo, )
+    else:
+        table, default = pattern._dispatch
+        alternatives = table.get(tokens.peek_kind_id(), default)
+        tokens.mark_max_load()
+
+        for inner, is_last, skipped in alternatives:
+            if skipped is not None:
+                tokens.fail(tokens._pos, skipped)
+
+                if inner is None:
+                    break
+
+                tokens.mark_max(tokens._pos)
+
+            mo = yield inner
+
+            if mo is not MISMATCH:
+                tokens.drop()
+
+                yield (mo, )
+
+            if not is_last:
+                tokens.mark_max_load()
+
+    tokens.restore()
+
+    yield (MISMATCH, )
+
+
+def _stack_choice_dict(pattern, tokens):
+    try:
+        inner = pattern._patterns_table[tokens.peek_kind_id()]
+    except LookupError:
+        inner = None
+
+    if inner is None:
+        tokens.fail(tokens._pos, pattern._kind_ids)
+
+        yield (MISMATCH, )
+
+    yield ((yield inner), )
+
+
+def _stack_repeated(pattern, tokens):
+    if pattern._kind_id is not None:
+        tokens._pos, mo = pattern.match_pos(tokens, tokens._pos)
+
+        yield (mo, )
+
+    inner, shape = pattern._shape or (pattern._pattern, None)
+    matched = []
+    count = 0
+    tokens.save()
+
+    while True:
+        mo = yield inner
+
+        if mo is MISMATCH:
+            tokens.mark_max_restore()
+            break
+
+        _add_shaped(matched, mo, shape)
+        count += 1
+        tokens.update()
+
+    if count >= pattern._minimum:
+        yield (matched, )
+    else:
+        yield (MISMATCH, )
+
+
+def _stack_repeated_dict(pattern, tokens):
+    matched = {}
+    tokens.save()
+
+    while True:
+        mo = yield pattern._pattern
+
+        if mo is MISMATCH:
+            tokens.mark_max_restore()
+            break
+
+        key = pattern._key(mo)
+
+        try:
+            matched[key].append(mo)
+        except KeyError:
+            matched[key] = [mo]
+
+        tokens.update()
+
+    if len(matched) >= pattern._minimum:
+        yield (matched, )
+    else:
+        yield (MISMATCH, )
+
+
+def _stack_delimited_list(pattern, tokens):
+    if pattern._kind_ids is not None:
+        tokens._pos, mo = pattern.match_pos(tokens, tokens._pos)
+
+        yield (mo, )
+
+    inner, shape = pattern._shape or (pattern._pattern, None)
+    mo = yield inner
+
+    if mo is MISMATCH:
+        yield (MISMATCH, )
+
+    matched = []
+    _add_shaped(matched, mo, shape)
+    tokens.save()
+
+    while True:
+        mo = yield pattern._delim
+
+        if mo is MISMATCH:
+            break
+
+        mo = yield inner
+
+        if mo is MISMATCH:
+            break
+
+        _add_shaped(matched, mo, shape)
+        tokens.update()
+
+    tokens.restore()
+
+    yield (matched, )
+
+
+def _stack_optional(pattern, tokens):
+    tokens.save()
+    mo = yield pattern._pattern
+
+    if mo is MISMATCH:
+        tokens.mark_max_restore()
+
+        if pattern._default is _NO_DEFAULT:
+            yield ([], )
+        else:
+            yield (pattern._default, )
+    else:
+        tokens.drop()
+
+        if pattern._default is _NO_DEFAULT:
+            yield ([mo], )
+        else:
+            yield (mo, )
+
+
+def _stack_any_until(pattern, tokens):
+    if pattern._kind_id is not None:
+        tokens._pos, mo = pattern.match_pos(tokens, tokens._pos)
+
+        yield (mo, )
+
+    matched = []
+
+    while True:
+        tokens.save()
+        mo = yield pattern._pattern
+
+        if mo is not MISMATCH:
+            break
+
+        tokens.restore()
+        matched.append(tokens.get_value())
+
+    tokens.restore()
+
+    yield (matched, )
+
+
+def _stack_and(pattern, tokens):
+    tokens.save()
+    failed = tokens.save_failed()
+    mo = yield pattern._pattern
+    tokens.restore_failed(failed)
+    tokens.restore()
+
+    if mo is MISMATCH:
+        yield (MISMATCH, )
+    else:
+        yield ([], )
+
+
+def _stack_not(pattern, tokens):
+    tokens.save()
+    failed = tokens.save_failed()
+    mo = yield pattern._pattern
+    tokens.restore_failed(failed)
+    tokens.restore()
+
+    if mo is MISMATCH:
+        yield ([], )
+    else:
+        yield (MISMATCH, )
+
+
+def _stack_expression(pattern, tokens):
+    prefix = pattern._prefix
+    infix = pattern._infix
+    postfix = pattern._postfix
+    operands = []
+    operators = []
+    depth = None
+
+    while True:
+        while tokens.peek_kind_id() in prefix:
+            operators.append((prefix[tokens.peek_kind_id()],
+                              tokens.get_value(),
+                              1))
+
+        start = tokens._pos
+        mo = yield pattern._operand
+
+        if mo is MISMATCH:
+            # Prefix operators may precede any operand.
+            if tokens._pos == start and prefix:
+                tokens.fail(start, prefix)
+
+            if depth is None:
+                yield (MISMATCH, )
+
+            tokens.mark_max_restore()
+            del operators[depth:]
+            break
+
+        if depth is not None:
+            tokens.drop()
+
+        operands.append(mo)
+
+        while tokens.peek_kind_id() in postfix:
+            _reduce_expression(operands,
+                               operators,
+                               postfix[tokens.peek_kind_id()])
+            operands[-1] = [operands[-1], tokens.get_value()]
+
+        if tokens.peek_kind_id() not in infix:
+            tokens.fail(tokens._pos, pattern._follow)
+
+            break
+
+        precedence, minimum = infix[tokens.peek_kind_id()]
+        _reduce_expression(operands, operators, precedence)
+        depth = len(operators)
+        tokens.save()
+        operators.append((minimum, tokens.get_value(), 2))
+
+    _reduce_expression(operands, operators, 0)
+
+    yield (operands[0], )
+
+
+def _stack_tag(pattern, tokens):
+    mo = yield pattern._pattern
+
+    if mo is not MISMATCH:
+        yield ((pattern._name, mo), )
+    else:
+        yield (MISMATCH, )
+
+
+def _stack_recover(pattern, tokens):
+    if tokens._errors is None:
+        yield ((yield pattern._pattern), )
+
+    pos = tokens._pos
+    outer = tokens.push_max()
+    tokens.save()
+    mo = yield pattern._pattern
+
+    if mo is MISMATCH:
+        tokens._pos, mo = pattern._recover(tokens, pos, tokens._pos)
+
+    tokens.drop()
+    tokens.pop_max(outer)
+
+    yield (mo, )
+
+
+def _stack_flatten(pattern, tokens):
+    yield ((yield pattern._pattern), )
+
+
+def _stack_suppress(pattern, tokens):
+    mo = yield pattern._pattern
+
+    if mo is MISMATCH:
+        yield (MISMATCH, )
+    else:
+        yield ([], )
+
+
+def _stack_action(pattern, tokens):
+    mo = yield pattern._pattern
+
+    if mo is not MISMATCH:
+        yield (pattern._apply(mo), )
+    else:
+        yield (MISMATCH, )
+
+
+def _stack_memoized(pattern, tokens):
+    memo = tokens._memo
+    pos = tokens._pos
+    entry = memo.get(pattern, pos)
+
+    if entry is not None:
+        mo, tokens._pos, max_pos, expected, failed_pos, failed = entry
+        tokens.pop_max((max_pos, list(expected)))
+        tokens._failed_pos = failed_pos
+        tokens._failed = list(failed)
+
+        yield (mo, )
+
+    outer = tokens.push_max()
+    mo = yield pattern._pattern
+
+    if mo is MISMATCH or tokens._pos != pos:
+        memo.put(pattern, pos, (mo,
+                                tokens._pos,
+                                tokens._max_pos,
+                                list(tokens._expected),
+                                tokens._failed_pos,
+                                list(tokens._failed)))
+
+    tokens.pop_max(outer)
+
+    yield (mo, )
+
+
+_STACK_MATCHERS = {
+    Sequence.match: _stack_sequence,
+    Choice.match: _stack_choice,
+    ChoiceDict.match: _stack_choice_dict,
+    Repeated.match: _stack_repeated,
+    RepeatedDict.match: _stack_repeated_dict,
+    DelimitedList.match: _stack_delimited_list,
+    Optional.match: _stack_optional,
+    AnyUntil.match: _stack_any_until,
+    And.match: _stack_and,
+    Not.match: _stack_not,
+    Expression.match: _stack_expression,
+    Tag.match: _stack_tag,
+    Recover.match: _stack_recover,
+    Flatten.match: _stack_flatten,
+    Suppress.match: _stack_suppress,
+    Action.match: _stack_action,
+    _Memoized.match: _stack_memoized
+}
+
+
+def _stack_match(root, tokens):
+    """Matches the pattern graph `root` using a stack of generators
+    instead of recursive match calls, so the nesting depth is only
+    limited by the available memory.
+
+    Each generator in the stack matches one pattern. It yields child
+    patterns to match, and is sent their values. The value of the
+    pattern itself is yielded as a one-tuple, which never is a
+    pattern. Patterns without a generator, including patterns that
+    are not built-in and override the built-in match method, are
+    matched by calling their match method.
+
+    """
+
+    forward_match = Forward.match
+    matchers = _STACK_MATCHERS
+    stack = []
+    pattern = root
+    value = None
+
+    while True:
+        if pattern is not None:
+            while type(pattern).match is forward_match:
+                pattern = pattern._pattern
+
+            matcher = matchers.get(type(pattern).match)
+
+            if matcher is None:
+                value = pattern.match(tokens)
+            else:
+                stack.append(matcher(pattern, tokens))
+                value = None
+
+        if not stack:
+            return value
+
+        item = stack[-1].send(value)
+
+        if type(item) is tuple:
+            stack.pop()
+            value = item[0]
+            pattern = None
+        else:
+            pattern = item
+
+
+class Grammar(object):
+    """Creates a tree of given tokens using the grammar `grammar`.
+
+    Each :class:`~textparser.Choice` in the grammar only tries the
+    alternatives that can start with the current token kind. The
+    alternatives are found the first time the grammar is used.
+
+    The grammar uses a copy of the patterns in `grammar` if any of
+    them is given state specific to the grammar, so patterns may be
+    shared by any number of grammars.
+
+    """
+
+    def __init__(self, grammar):
+        if isinstance(grammar, str):
+            grammar = _wrap_string(grammar)
+
+        self._grammar = grammar
+        self._prepared_root = None
+        self._resolve = False
+        self._packrat_root = None
+        self._recognize = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+
+        # Created again when needed.
+        state['_prepared_root'] = None
+        state['_resolve'] = False
+        state['_packrat_root'] = None
+        state['_recognize'] = None
+
+        return state
+
+    @property
+    def _root(self):
+        """The patterns of the grammar, with the state specific to the
+        grammar installed the first time they are needed.
+
+        """
+
+        if self._prepared_root is None:
+            self._prepared_root = self._prepare(self._grammar)
+
+        return self._prepared_root
+
+    def _prepare(self, root):
+        if not _has_grammar_state(_iter_patterns(root)):
+            return root
+
+        # The copy is given the state specific to this grammar.
+        root = _transform_graph(root, lambda pattern: pattern)
+        first_sets = _FirstSets(root)
+        _install_choice_dispatch(first_sets)
+        _install_recovers(root, first_sets)
+        self._resolve = _install_actions(root, first_sets)
+
+        return root
+
+    def _get_packrat_root(self):
+        if self._packrat_root is None:
+            self._packrat_root = _transform_graph(self._root, _memoize)
+
+        return self._packrat_root
+
+    def parse(self,
+              tokens,
+              token_tree=False,
+              packrat=False,
+              recursive=True):
+        """Parse given tokens `tokens` and return the parse tree. Raises
+        :class:`~textparser.GrammarError` on failure.
+
+        `tokens` is either a list of tokens, a
+        :class:`~textparser.TokenArray`, or any other iterable of
+        tokens that is read lazily while parsing.
+
+        Enable packrat parsing by setting `packrat` to ``True``, or to
+        a :class:`~textparser.Packrat` instance for bounded memory
+        usage. It may reduce the parsing time of grammars that
+        backtrack a lot, but is otherwise slower.
+
+        Patterns are matched using recursive calls if `recursive` is
+        ``True``, which limits the nesting depth of the input to
+        roughly the Python recursion limit divided by the number of
+        patterns per nesting level. Set it to ``False`` to instead use
+        an explicit stack, only limited by the available memory. Lazy
+        tokens are always matched using an explicit stack, as it
+        tells which tokens the parser may backtrack to.
+
+        """
+
+        tokens = _create_tokens(tokens, token_tree)
+
+        if packrat:
+            if packrat is True:
+                packrat = Packrat()
+
+            tokens._memo = packrat.create_memo_table()
+            root = self._get_packrat_root()
+        else:
+            root = self._root
+
+        if recursive and not isinstance(tokens._tokens, _TokenStream):
+            tokens._pos, parsed = root.match_pos(tokens, 0)
+        else:
+            parsed = _stack_match(root, tokens)
+
+        return self._parse_result(tokens, parsed)
+
+    def parse_recover(self, tokens, token_tree=False):
+        """Same as :func:`~textparser.Grammar.parse()`, but parses in
+        recovery mode, in which :class:`~textparser.Recover` patterns
+        record errors and skip tokens instead of failing. Returns a
+        two-tuple of the parse tree and a list of all
+        :class:`~textparser.GrammarError` found, in the order they
+        were found. The list is empty if the tokens match the grammar.
+
+        The error the parse fails with, if any, is the last error in
+        the list. The parse tree is then ``None`` if the grammar root
+        did not match.
+
+        The tokens are always matched by the patterns of the grammar,
+        even if it is compiled.
+
+        """
+
+        tokens = _create_tokens(tokens, token_tree)
+        tokens._errors = []
+
+        if isinstance(tokens._tokens, _TokenStream):
+            parsed = _stack_match(self._root, tokens)
+        else:
+            tokens._pos, parsed = self._root.match_pos(tokens, 0)
+
+        try:
+            parsed = self._parse_result(tokens, parsed)
+        except GrammarError as e:
+            tokens._errors.append(e)
+
+            if parsed is MISMATCH:
+                parsed = None
+            elif self._resolve:
+                parsed = _resolve_deferred(parsed)
+
+        return parsed, tokens._errors
+
+    def iter_parse(self, tokens, token_tree=False):
+        """Same as :func:`~textparser.Grammar.parse()`, but returns an
+        iterator of the elements of the grammar root, which must be a
+        :class:`~textparser.Repeated` or
+        :class:`~textparser.DelimitedList` pattern. Each element is
+        yielded as soon as it is matched, and lazy tokens before it are
+        discarded, so the memory usage does not grow with the number
+        of elements.
+
+        :class:`~textparser.GrammarError` is raised by the iterator
+        when the error is found, after all elements before it have
+        been yielded.
+
+        """
+
+        root = self._root
+
+        while type(root).match == Forward.match:
+            root = root.pattern
+
+        if type(root).match not in (Repeated.match, DelimitedList.match):
+            raise Error(
+                'The grammar root must be a Repeated or DelimitedList '
+                'pattern, not {}.'.format(type(root)))
+
+        return self._iter_parse(root, _create_tokens(tokens, token_tree))
+
+    def _iter_parse(self, root, tokens):
+        pattern, shape = root._shape or (root._pattern, None)
+
+        if type(root).match == DelimitedList.match:
+            delim = root._delim
+            minimum = 1
+        else:
+            delim = None
+            minimum = root._minimum
+
+        if isinstance(tokens._tokens, _TokenStream):
+            match = _stack_match
+        else:
+            match = _match_recursive
+
+        count = 0
+
+        while True:
+            tokens.save()
+
+            if delim is not None and count > 0:
+                if match(delim, tokens) is MISMATCH:
+                    tokens.restore()
+                    break
+
+            mo = match(pattern, tokens)
+
+            if mo is MISMATCH:
+                if delim is None:
+                    tokens.mark_max_restore()
+                else:
+                    tokens.restore()
+
+                break
+
+            tokens.drop()
+            count += 1
+
+            if self._resolve:
+                mo = _resolve_deferred(mo)
+
+            if shape is None:
+                yield mo
+            else:
+                matched = []
+                _add_shaped(matched, mo, shape)
+
+                for element in matched:
+                    yield element
+
+        if count < minimum:
+            _parse_result(tokens, MISMATCH)
+        else:
+            _parse_result(tokens, [])
+
+    def _parse_result(self, tokens, parsed):
+        parsed = _parse_result(tokens, parsed)
+
+        if self._resolve:
+            parsed = _resolve_deferred(parsed)
+
+        return parsed
+
+    def recognize(self, tokens):
+        """Check if given tokens `tokens` match the grammar, without
+        creating a parse tree. Returns ``True`` on match, and raises the
+        same :class:`~textparser.GrammarError` as
+        :func:`~textparser.Grammar.parse()` on failure. `tokens` is
+        the same as in :func:`~textparser.Grammar.parse()`.
+
+        The grammar is compiled into Python code the first time it is
+        called, just as by :func:`~textparser.Grammar.compile()`.
+        :class:`~textparser.Action` functions are not called.
+
+        """
+
+        if self._recognize is None:
+            self._recognize = _compile(
+                _GrammarCompiler(self._root, 'True', tree=False))
+
+        tokens = _create_tokens(tokens, False)
+        _parse_result(tokens, self._recognize(tokens, tokens._tokens))
+
+        return True
+
+    def compile(self):
+        """Returns a :class:`~textparser.CompiledGrammar` of this grammar.
+
+        """
+
+        return CompiledGrammar(self._grammar)
+
+    def optimize(self):
+        """Returns an optimized grammar of the same type as this grammar,
+        which creates the same parse trees and errors. The patterns of
+        this grammar are not modified.
+
+        :class:`~textparser.Forward` patterns are removed, flattened
+        and suppressed sequences in sequences are inlined, and strings
+        of the same token kind are merged. Choices with a single
+        alternative, and choices that can be replaced by a
+        :class:`~textparser.ChoiceDict`, are replaced if the error
+        offsets stay the same. Patterns that are not built-in, or
+        override the built-in match method, are left as is.
+
+        """
+
+        return type(self)(_optimize(self._grammar))
+
+
+def _match_recursive(pattern, tokens):
+    tokens._pos, mo = pattern.match_pos(tokens, tokens._pos)
+
+    return mo
+
+
+def _create_tokens(tokens, token_tree):
+    if isinstance(tokens, TokenArray):
+        if token_tree:
+            return _ArrayTokens(tokens)
+        else:
+            return _StringArrayTokens(tokens)
+    elif token_tree:
+        return _Tokens(tokens)
+    else:
+        return _StringTokens(tokens)
+
+
+def _parse_result(tokens, parsed):
+    """Returns the parse tree `parsed`, or raises a
+    :class:`~textparser.GrammarError` if the parser did not match all
+    tokens.
+
+    """
+
+    if parsed is not MISMATCH and tokens.peek_max().kind == '__EOF__':
+        return parsed
+    else:
+        raise GrammarError(
+            tokens.peek_max().offset,
+            tokens.expected(max(tokens._pos, tokens._max_pos),
+                            parsed is not MISMATCH))
+
+
+def _indent(lines):
+    return ['    ' + line for line in lines]
+
+
+def _mark_max_lines():
+    return [
+        'if pos >= max_pos:',
+        '    max_pos = mark(pos, max_pos)'
+    ]
+
+
+class _GrammarCompiler(object):
+    """Generates Python source code of a parse function for the pattern
+    graph `root`, with one function per pattern. Token kinds are
+    compared inline, and the token position and the max position are
+    variables in the parse function instead of state in the tokens
+    object.
+
+    `value` is a format string of an expression returning the value of
+    the token at given position.
+
+    No parse tree is created if `tree` is ``False``, and the parse
+    function returns ``True`` on match instead.
+
+    Patterns that are not built-in, or override the built-in match
+    method, are matched by calling their match method.
+
+    """
+
+    def __init__(self, root, value, tree=True):
+        self._value = value
+        self._tree = tree
+        self._function_names = {}
+        self._pending = []
+        self._functions = []
+        self._tables = []
+        self._constants = {
+            'MISMATCH': MISMATCH,
+            'EOF_ID': _EOF_ID
+        }
+        self._handlers = {
+            _String.match: self._string,
+            Sequence.match: self._sequence,
+            Choice.match: self._choice,
+            ChoiceDict.match: self._choice_dict,
+            Repeated.match: self._repeated,
+            RepeatedDict.match: self._repeated_dict,
+            DelimitedList.match: self._delimited_list,
+            Optional.match: self._optional,
+            Any.match: self._any,
+            AnyUntil.match: self._any_until,
+            And.match: self._and,
+            Not.match: self._not,
+            NoMatch.match: self._no_match,
+            Expression.match: self._expression,
+            Tag.match: self._tag,
+            Recover.match: self._recover,
+            Flatten.match: self._flatten,
+            Suppress.match: self._suppress,
+            Action.match: self._action
+        }
+        self._root_name = self._function_name(root)
+
+        while self._pending:
+            pattern, name = self._pending.pop()
+            self._define_function(pattern, name)
+
+    @property
+    def constants(self):
+        return self._constants
+
+    def _add_constant(self, prefix, value):
+        name = '{}{}'.format(prefix, len(self._constants))
+        self._constants[name] = value
+
+        return name
+
+    def _resolve(self, pattern):
+        while type(pattern).match == Forward.match:
+            pattern = pattern.pattern
+
+            if pattern is None:
+                raise Error('Forward pattern without a pattern.')
+
+        return pattern
+
+    def _is(self, pattern, cls):
+        return type(pattern).match == cls.match
+
+    def _function_name(self, pattern):
+        pattern = self._resolve(pattern)
+        key = id(pattern)
+
+        if key not in self._function_names:
+            name = 'r{}'.format(len(self._function_names))
+            self._function_names[key] = name
+            self._pending.append((pattern, name))
+
+        return self._function_names[key]
+
+    def _define_function(self, pattern, name):
+        handler = self._handlers.get(type(pattern).match, self._fallback)
+        lines = [
+            'def {}():'.format(name),
+            '    nonlocal pos, max_pos'
+        ]
+        lines += _indent(handler(pattern, name))
+        self._functions.append(lines)
+
+    def _match(self, pattern, var, mismatch):
+        """Returns lines matching `pattern`, storing its value in `var` if
+        not ``None``, and executing `mismatch` lines on mismatch.
+
+        """
+
+        pattern = self._resolve(pattern)
+
+        if self._is(pattern, _String):
+            lines = ['if kinds[pos] != {}:'.format(pattern.kind_id)]
+            mismatch = self._fail_lines(pattern) + mismatch
+        elif self._is(pattern, Any):
+            lines = ['if kinds[pos] == EOF_ID:']
+        else:
+            name = self._function_name(pattern)
+
+            if var is None:
+                var = 'v'
+
+            return [
+                '{} = {}()'.format(var, name),
+                'if {} is MISMATCH:'.format(var)
+            ] + _indent(mismatch)
+
+        lines += _indent(mismatch)
+
+        if var is not None:
+            lines.append('{} = {}'.format(var, self._value.format('pos')))
+
+        lines.append('pos += 1')
+
+        return lines
+
+    def _try(self, pattern, success):
+        """Returns lines matching `pattern`, executing lines returned by
+        `success` on match. `success` is called with the matched value
+        expression.
+
+        """
+
+        pattern = self._resolve(pattern)
+
+        if self._is(pattern, _String):
+            lines = ['if kinds[pos] == {}:'.format(pattern.kind_id)]
+        elif self._is(pattern, Any):
+            lines = ['if kinds[pos] != EOF_ID:']
+        else:
+            return [
+                'v = {}()'.format(self._function_name(pattern)),
+                'if v is not MISMATCH:'
+            ] + _indent(success('v'))
+
+        return lines + _indent(
+            ['pos += 1'] + success(self._value.format('pos - 1')))
+
+    def _fail_lines(self, pattern):
+        """Returns lines recording the kind of given pattern as tried at the
+        current position if it is a string pattern.
+
+        """
+
+        pattern = self._resolve(pattern)
+
+        if self._is(pattern, _String):
+            return ['fail(pos, {})'.format(pattern.kind_id)]
+        else:
+            return []
+
+    def _string(self, pattern, _name):
+        return self._match(pattern, 'v', ['return MISMATCH']) + ['return v']
+
+    def _result(self, value):
+        """Returns given value expression if a parse tree is created, and
+        ``'True'`` otherwise.
+
+        """
+
+        if self._tree:
+            return value
+        else:
+            return 'True'
+
+    def _add_lines(self, shape):
+        """Returns lines adding the value in `v` to the list `matched`, as
+        given shape says.
+
+        """
+
+        if shape is None:
+            return ['matched.append(v)']
+        elif shape == _FLATTEN:
+            return [
+                'if type(v) is list:',
+                '    matched.extend(v)',
+                'else:',
+                '    matched.append(v)'
+            ]
+        else:
+            return []
+
+    def _match_shaped(self, pattern, shape, mismatch):
+        if shape == _SUPPRESS or not self._tree:
+            var = None
+        else:
+            var = 'v'
+
+        return self._match(pattern, var, mismatch)
+
+    def _sequence(self, pattern, name):
+        if pattern._shapes is not None:
+            return self._sequence_shaped(pattern, name)
+
+        lines = []
+        values = []
+
+        for i, inner in enumerate(pattern.patterns):
+            var = 'v{}'.format(i)
+            lines += self._match(inner, var, ['return MISMATCH'])
+            values.append(var)
+
+        value = '[{}]'.format(', '.join(values))
+        lines.append('return ' + self._result(value))
+
+        return lines
+
+    def _sequence_shaped(self, pattern, _name):
+        lines = ['matched = []']
+
+        for inner, shape in pattern._shapes:
+            lines += self._match_shaped(inner, shape, ['return MISMATCH'])
+
+            if self._tree:
+                lines += self._add_lines(shape)
+
+        lines.append('return ' + self._result('matched'))
+
+        return lines
+
+    def _prefix_key(self, alternative, index):
+        """Returns a key of the pattern at given index in given alternative,
+        equal for patterns matching the same way, or ``None`` if the
+        alternative is not a sequence with an unshaped pattern at given
+        index.
+
+        """
+
+        alternative = self._resolve(alternative)
+
+        if not self._is(alternative, Sequence):
+            return None
+
+        if index >= len(alternative.patterns):
+            return None
+
+        if (alternative._shapes is not None
+            and alternative._shapes[index][1] is not None):
+            return None
+
+        inner = self._resolve(alternative.patterns[index])
+
+        if self._is(inner, _String):
+            return ('kind', inner.kind_id)
+        else:
+            return ('pattern', id(inner))
+
+    def _choice_groups(self, pattern, name):
+        """Returns the alternatives of given choice in groups of consecutive
+        sequences starting with the same patterns, as a list of (group,
+        prefix length, function name) tuples. Alternatives not sharing a
+        prefix with the next alternative are in groups of their own,
+        with prefix length zero and no function name.
+
+        """
+
+        alternatives = pattern._patterns
+        groups = []
+
+        if len(set([id(alternative)
+                    for alternative in alternatives])) < len(alternatives):
+            return [([alternative], 0, None) for alternative in alternatives]
+
+        i = 0
+
+        while i < len(alternatives):
+            key = self._prefix_key(alternatives[i], 0)
+            j = i + 1
+
+            if key is not None:
+                while (j < len(alternatives)
+                       and self._prefix_key(alternatives[j], 0) == key):
+                    j += 1
+
+            group = alternatives[i:j]
+
+            if len(group) == 1:
+                groups.append((group, 0, None))
+            else:
+                length = 1
+
+                while True:
+                    key = self._prefix_key(group[0], length)
+
+                    if key is None:
+                        break
+
+                    if any([self._prefix_key(alternative, length) != key
+                            for alternative in group[1:]]):
+                        break
+
+                    length += 1
+
+                groups.append((group,
+                               length,
+                               '{}g{}'.format(name, len(groups))))
+
+            i = j
+
+        return groups
+
+    def _remainder(self, alternative, length, values):
+        """Returns lines matching the patterns after the first `length`
+        patterns, whose values are in `values`, of given sequence,
+        breaking on mismatch.
+
+        """
+
+        alternative = self._resolve(alternative)
+
+        if alternative._shapes is None:
+            lines = []
+            values = list(values)
+
+            for i, inner in enumerate(alternative.patterns[length:]):
+                var = 'v{}'.format(i)
+                lines += self._match(inner, var, ['break'])
+                values.append(var)
+
+            value = '[{}]'.format(', '.join(values))
+        else:
+            lines = ['matched = [{}]'.format(', '.join(values))]
+
+            for inner, shape in alternative._shapes[length:]:
+                lines += self._match_shaped(inner, shape, ['break'])
+
+                if self._tree:
+                    lines += self._add_lines(shape)
+
+            value = 'matched'
+
+        return lines + ['return ' + self._result(value)]
+
+    def _define_choice_group(self, group, length, name):
+        """Defines a function matching given group of alternatives one at a
+        time, as the choice would, but matching their common prefix of
+        `length` patterns only once.
+
+        The failure positions of all alternatives but the last are
+        marked, as the choice marks them. If the prefix does not match
+        all alternatives fail at the same position.
+
+        """
+
+        lines = [
+            'def {}():'.format(name),
+            '    nonlocal pos, max_pos'
+        ]
+        body = []
+        values = []
+
+        for i, inner in enumerate(self._resolve(group[0]).patterns[:length]):
+            var = 'p{}'.format(i)
+            body += self._match(inner,
+                                var,
+                                _mark_max_lines() + ['return MISMATCH'])
+            values.append(var)
+
+        body.append('end = pos')
+
+        for i, alternative in enumerate(group):
+            body.append('while True:')
+            body += _indent(self._remainder(alternative, length, values))
+
+            if i < len(group) - 1:
+                body += _mark_max_lines()
+                body.append('pos = end')
+
+        body.append('return MISMATCH')
+        lines += _indent(body)
+        self._functions.append(lines)
+
+    def _choice(self, pattern, name):
+        groups = self._choice_groups(pattern, name)
+
+        if pattern._dispatch is not None:
+            return self._choice_dispatch(pattern, name, groups)
+
+        lines = ['start = pos']
+
+        for group, length, function_name in groups:
+            lines += _mark_max_lines()
+            lines.append('pos = start')
+
+            if function_name is None:
+                lines += self._try(group[0], lambda value: ['return ' + value])
+                lines += self._fail_lines(group[0])
+            else:
+                self._define_choice_group(group, length, function_name)
+                lines += [
+                    'v = {}()'.format(function_name),
+                    'if v is not MISMATCH:',
+                    '    return v'
+                ]
+
+        lines += [
+            'pos = start',
+            'return MISMATCH'
+        ]
+
+        return lines
+
+    def _grouped_alternatives(self, alternatives, groups):
+        """Returns given (alternative, is_last, skipped) entries of a
+        dispatch table as (function name, is_last, skipped) entries,
+        with the alternatives of each group replaced by the group
+        function. Returns ``None`` if only some alternatives of a group
+        are in the entries.
+
+        """
+
+        group_of = {}
+
+        for group, _length, function_name in groups:
+            if function_name is not None:
+                for alternative in group:
+                    group_of[id(alternative)] = (group, function_name)
+
+        alternatives = list(alternatives)
+        grouped = []
+        i = 0
+
+        while i < len(alternatives):
+            alternative, is_last, skipped = alternatives[i]
+
+            if alternative is None:
+                grouped.append((None, is_last, skipped))
+                i += 1
+                continue
+
+            if id(alternative) not in group_of:
+                grouped.append((self._function_name(alternative),
+                                is_last,
+                                skipped))
+                i += 1
+                continue
+
+            group, function_name = group_of[id(alternative)]
+            members = alternatives[i:i + len(group)]
+
+            if (len(members) < len(group)
+                or any([member is not expected
+                        for (member, _, _), expected in zip(members,
+                                                            group)])):
+                return None
+
+            grouped.append((function_name, members[-1][1], skipped))
+            i += len(group)
+
+        return grouped
+
+    def _alternatives_tuple(self, alternatives):
+        return '({})'.format(''.join([
+            '({}, {}, {}), '.format(
+                function_name,
+                is_last,
+                None if skipped is None else self._add_constant('S', skipped))
+            for function_name, is_last, skipped in alternatives
+        ]))
+
+    def _choice_dispatch(self, pattern, name, groups):
+        table, default = pattern._dispatch
+        entries = list(table.items()) + [(None, default)]
+        grouped = [self._grouped_alternatives(alternatives, groups)
+                   for _, alternatives in entries]
+
+        if any([alternatives is None for alternatives in grouped]):
+            groups = [(group, 0, None) for group, _, _ in groups]
+            grouped = [self._grouped_alternatives(alternatives, groups)
+                       for _, alternatives in entries]
+
+        for group, length, function_name in groups:
+            if function_name is not None:
+                self._define_choice_group(group, length, function_name)
+
+        self._tables.append('T{} = {{{}}}'.format(
+            name,
+            ', '.join(['{}: {}'.format(kind_id,
+                                       self._alternatives_tuple(alternatives))
+                       for (kind_id, _), alternatives in zip(entries[:-1],
+                                                             grouped[:-1])])))
+        self._tables.append('D{} = {}'.format(
+            name,
+            self._alternatives_tuple(grouped[-1])))
+        lines = [
+            'start = pos',
+            'alternatives = T{0}.get(kinds[pos], D{0})'.format(name)
+        ]
+        lines += _mark_max_lines()
+        lines += [
+            'for function, is_last, skipped in alternatives:',
+            '    if skipped is not None:',
+            '        fail(pos, skipped)',
+            '        if function is None:',
+            '            break'
+        ]
+        lines += _indent(_indent(_mark_max_lines()))
+        lines += [
+            '    v = function()',
+            '    if v is not MISMATCH:',
+            '        return v',
+            '    if not is_last:'
+        ]
+        lines += _indent(_indent(_mark_max_lines() + ['pos = start']))
+        lines += [
+            'pos = start',
+            'return MISMATCH'
+        ]
+
+        return lines
+
+    def _choice_dict(self, pattern, name):
+        kind_ids = set()
+        functions = {}
+
+        for kind, inner in pattern.patterns_map.items():
+            inner = self._resolve(inner)
+
+            if self._is(inner, _String):
+                kind_ids.add(_kind_id(kind))
+            else:
+                functions[_kind_id(kind)] = self._function_name(inner)
+
+        lines = ['kind_id = kinds[pos]']
+
+        if kind_ids:
+            lines += [
+                'if kind_id in {}:'.format(
+                    self._add_constant('S', frozenset(kind_ids))),
+                '    pos += 1',
+                '    return ' + self._value.format('pos - 1')
+            ]
+
+        if functions:
+            table = 'T' + name
+            self._tables.append('{} = {{{}}}'.format(
+                table,
+                ', '.join(['{}: {}'.format(kind_id, function)
+                           for kind_id, function in functions.items()])))
+            lines += [
+                'function = {}.get(kind_id)'.format(table),
+                'if function is not None:',
+                '    return function()'
+            ]
+
+        lines += [
+            'fail(pos, {})'.format(self._add_constant('S',
+                                                      pattern._kind_ids)),
+            'return MISMATCH'
+        ]
+
+        return lines
+
+    def _repeated_lines(self, pattern, add_lines, empty, shape=None):
+        """Returns lines of a repetition. The number of matches is counted
+        separately from the size of the container if `shape` is not
+        ``None``.
+
+        """
+
+        inner = pattern._pattern
+        count = 'len(matched)'
+
+        if shape is not None:
+            inner, shape = shape
+
+        if not self._tree:
+            add_lines = ['matched += 1']
+            empty = '0'
+            count = 'matched'
+            shape = None
+        elif shape is not None and pattern._minimum > 0:
+            add_lines = add_lines + ['count += 1']
+            count = 'count'
+
+        lines = [
+            'matched = ' + empty,
+            'start = pos',
+            'while True:'
+        ]
+
+        if count == 'count':
+            lines.insert(0, 'count = 0')
+
+        mismatch = _mark_max_lines() + [
+            'pos = start',
+            'break'
+        ]
+        lines += _indent(self._match_shaped(inner, shape, mismatch)
+                         + add_lines
+                         + ['start = pos'])
+
+        if pattern._minimum > 0:
+            lines.append('if {} < {}:'.format(count, pattern._minimum))
+            lines.append('    return MISMATCH')
+
+        lines.append('return ' + self._result('matched'))
+
+        return lines
+
+    def _values_expression(self, start, stop, step=1):
+        """Returns the value expression of a list of the values of the tokens
+        from `start` to `stop`.
+
+        """
+
+        if step == 1:
+            positions = 'range({}, {})'.format(start, stop)
+        else:
+            positions = 'range({}, {}, {})'.format(start, stop, step)
+
+        return self._result('[{} for i in {}]'.format(self._value.format('i'),
+                                                      positions))
+
+    def _repeated(self, pattern, _name):
+        if pattern._kind_id is not None:
+            return self._repeated_kind(pattern)
+
+        if pattern._shape is None:
+            add_lines = ['matched.append(v)']
+        else:
+            add_lines = self._add_lines(pattern._shape[1])
+
+        return self._repeated_lines(pattern, add_lines, '[]', pattern._shape)
+
+    def _repeated_kind(self, pattern):
+        lines = [
+            'start = pos',
+            'while kinds[pos] == {}:'.format(pattern._kind_id),
+            '    pos += 1',
+            'fail(pos, {})'.format(pattern._kind_id)
+        ]
+        lines += _mark_max_lines()
+
+        if pattern._minimum > 0:
+            lines.append('if pos - start < {}:'.format(pattern._minimum))
+            lines.append('    return MISMATCH')
+
+        lines.append('return ' + self._values_expression('start', 'pos'))
+
+        return lines
+
+    def _repeated_dict(self, pattern, name):
+        # The number of unique keys can only be counted by creating
+        # the matches.
+        if not self._tree and pattern._minimum > 1:
+            return self._fallback(pattern, name)
+
+        add_lines = [
+            'key = {}(v)'.format(self._add_constant('KEY', pattern._key)),
+            'try:',
+            '    matched[key].append(v)',
+            'except KeyError:',
+            '    matched[key] = [v]'
+        ]
+
+        return self._repeated_lines(pattern, add_lines, '{}')
+
+    def _delimited_list(self, pattern, _name):
+        if pattern._kind_ids is not None:
+            return self._delimited_list_kinds(pattern)
+
+        inner, shape = pattern._shape or (pattern._pattern, None)
+
+        if self._tree:
+            add_lines = self._add_lines(shape)
+        else:
+            add_lines = []
+
+        lines = self._match_shaped(inner, shape, ['return MISMATCH'])
+
+        if shape is None or not self._tree:
+            lines.append('matched = ' + self._result('[v]'))
+        else:
+            lines += ['matched = []'] + add_lines
+
+        lines += [
+            'start = pos',
+            'while True:'
+        ]
+        lines += _indent(self._match(pattern._delim, None, ['break'])
+                         + self._match_shaped(inner, shape, ['break'])
+                         + add_lines
+                         + ['start = pos'])
+        lines += [
+            'pos = start',
+            'return matched'
+        ]
+
+        return lines
+
+    def _delimited_list_kinds(self, pattern):
+        kind_id, delim_kind_id = pattern._kind_ids
+
+        return [
+            'if kinds[pos] != {}:'.format(kind_id),
+            '    fail(pos, {})'.format(kind_id),
+            '    return MISMATCH',
+            'start = pos',
+            'pos += 1',
+            'while kinds[pos] == {} and kinds[pos + 1] == {}:'.format(
+                delim_kind_id,
+                kind_id),
+            '    pos += 2',
+            'if kinds[pos] == {}:'.format(delim_kind_id),
+            '    fail(pos + 1, {})'.format(kind_id),
+            'else:',
+            '    fail(pos, {})'.format(delim_kind_id),
+            'return ' + self._values_expression('start', 'pos', 2)
+        ]
+
+    def _optional(self, pattern, _name):
+        if pattern._default is _NO_DEFAULT:
+            default = '[]'
+            value = '[v]'
+        else:
+            default = self._add_constant('DEFAULT', pattern._default)
+            value = 'v'
+
+        mismatch = _mark_max_lines() + [
+            'pos = start',
+            'return ' + self._result(default)
+        ]
+
+        return (['start = pos']
+                + self._match(pattern._pattern, 'v', mismatch)
+                + ['return ' + self._result(value)])
+
+    def _any(self, pattern, _name):
+        return self._match(pattern, 'v', ['return MISMATCH']) + ['return v']
+
+    def _any_until(self, pattern, _name):
+        if self._tree:
+            value = self._value.format('pos')
+            add_lines = ['matched.append({})'.format(value)]
+        else:
+            add_lines = []
+
+        lines = []
+
+        if pattern._kind_id is not None:
+            # Fall back to the loop below if not found.
+            lines += [
+                'try:',
+                '    end = kinds.index({}, pos)'.format(pattern._kind_id),
+                'except ValueError:',
+                '    end = None',
+                'if end is not None:',
+                '    matched = ' + self._values_expression('pos', 'end'),
+                '    pos = end',
+                '    return matched'
+            ]
+
+        lines += [
+            'matched = ' + self._result('[]'),
+            'while True:'
+        ]
+        lines += _indent(['start = pos']
+                         + self._try(pattern._pattern, lambda _: ['break'])
+                         + ['pos = start']
+                         + add_lines
+                         + ['pos += 1'])
+        lines += [
+            'pos = start',
+            'return matched'
+        ]
+
+        return lines
+
+    def _lookahead(self, pattern, success):
+        """Same as :meth:`_try()`, but the kinds tried by `pattern` are not
+        recorded.
+
+        """
+
+        pattern = self._resolve(pattern)
 
-    def __init__(self):
-        self._pattern = None
+        if self._is(pattern, _String) or self._is(pattern, Any):
+            return self._try(pattern, success)
 
-    @property
-    def pattern(self):
-        return self._pattern
+        return [
+            'failed = tokens.save_failed()',
+            'v = {}()'.format(self._function_name(pattern)),
+            'tokens.restore_failed(failed)',
+            'if v is not MISMATCH:'
+        ] + _indent(success('v'))
+
+    def _and(self, pattern, _name):
+        return (['start = pos']
+                + self._lookahead(pattern._pattern,
+                                  lambda _: ['pos = start',
+                                             'return ' + self._result('[]')])
+                + ['pos = start', 'return MISMATCH'])
+
+    def _not(self, pattern, _name):
+        return (['start = pos']
+                + self._lookahead(pattern._pattern,
+                                  lambda _: ['pos = start', 'return MISMATCH'])
+                + ['pos = start', 'return ' + self._result('[]')])
+
+    def _no_match(self, _pattern, _name):
+        return ['return MISMATCH']
+
+    def _expression(self, pattern, _name):
+        prefix = self._add_constant('PREFIX', pattern._prefix)
+        infix = self._add_constant('INFIX', pattern._infix)
+        postfix = self._add_constant('POSTFIX', pattern._postfix)
+        reduce_ = self._add_constant('REDUCE', _reduce_expression)
+        follow = self._add_constant('FOLLOW', pattern._follow)
+        value = self._value.format('pos')
+        mismatch = []
+
+        # Prefix operators may precede any operand.
+        if pattern._prefix:
+            mismatch += [
+                'if pos == operand_start:',
+                '    fail(pos, {})'.format(prefix)
+            ]
+
+        mismatch += [
+            'if depth is None:',
+            '    return MISMATCH'
+        ]
+        mismatch += _mark_max_lines()
+        mismatch += [
+            'del operators[depth:]',
+            'pos = start - 1',
+            'break'
+        ]
+        lines = [
+            'operands = []',
+            'operators = []',
+            'depth = None',
+            'while True:',
+            '    start = pos',
+            '    while kinds[pos] in {}:'.format(prefix),
+            '        operators.append(({}[kinds[pos]], {}, 1))'.format(prefix,
+                                                                      value),
+            '        pos += 1'
+        ]
 
-    def __ilshift__(self, other):
-        self._pattern = _wrap_string(other)
+        if pattern._prefix:
+            lines.append('    operand_start = pos')
+
+        lines += _indent(self._match(pattern._operand, 'v', mismatch))
+        lines += [
+            '    operands.append(v)',
+            '    while kinds[pos] in {}:'.format(postfix),
+            '        {}(operands, operators, {}[kinds[pos]])'.format(reduce_,
+                                                                   postfix),
+            '        operands[-1] = [operands[-1], {}]'.format(value),
+            '        pos += 1',
+            '    if kinds[pos] not in {}:'.format(infix),
+            '        fail(pos, {})'.format(follow),
+            '        break',
+            '    precedence, minimum = {}[kinds[pos]]'.format(infix),
+            '    if operators and precedence < operators[-1][0]:',
+            '        {}(operands, operators, precedence)'.format(reduce_),
+            '    depth = len(operators)',
+            '    operators.append((minimum, {}, 2))'.format(value),
+            '    pos += 1',
+            '{}(operands, operators, 0)'.format(reduce_),
+            'return operands[0]'
+        ]
 
-        return self
+        return lines
 
-    def match(self, tokens):
-        return self._pattern.match(tokens)
+    def _tag(self, pattern, _name):
+        return (self._match(pattern._pattern, 'v', ['return MISMATCH'])
+                + ['return ' + self._result('({}, v)'.format(
+                    self._add_constant('NAME', pattern._name)))])
 
+    def _recover(self, pattern, _name):
+        # Compiled code never recovers, see Grammar.parse_recover().
+        return (self._match(pattern._pattern, 'v', ['return MISMATCH'])
+                + ['return v'])
 
-class Grammar(object):
-    """Creates a tree of given tokens using the grammar `grammar`.
+    def _flatten(self, pattern, _name):
+        return (self._match(pattern._pattern, 'v', ['return MISMATCH'])
+                + ['return v'])
+
+    def _suppress(self, pattern, _name):
+        return (self._match(pattern._pattern, None, ['return MISMATCH'])
+                + ['return ' + self._result('[]')])
+
+    def _action(self, pattern, _name):
+        if self._tree:
+            value = '{}._apply(v)'.format(self._add_constant('A', pattern))
+        else:
+            value = 'True'
+
+        return (self._match(pattern._pattern, 'v', ['return MISMATCH'])
+                + ['return ' + value])
+
+    def _fallback(self, pattern, _name):
+        return [
+            'tokens._max_pos = max_pos',
+            'pos, v = {}.match_pos(tokens, pos)'.format(
+                self._add_constant('P', pattern)),
+            'max_pos = tokens._max_pos',
+            'return v'
+        ]
+
+    def source(self):
+        """Returns the parse function source code. The function takes a
+        tokens object and the sequence of tokens as arguments, and
+        returns the matched value. The token position and the max
+        position are stored in the tokens object before returning.
+
+        """
+
+        lines = [
+            'def parse(tokens, values):',
+            '    kinds = tokens._kinds',
+            '    value = getattr(values, "value", None)',
+            '    fail = tokens.fail',
+            '    mark = tokens.expect_max',
+            '    pos = 0',
+            '    max_pos = -1'
+        ]
+
+        for function in self._functions:
+            lines.append('')
+            lines += _indent(function)
+
+        lines.append('')
+        lines += _indent(self._tables)
+        lines += _indent([
+            'v = {}()'.format(self._root_name),
+            'tokens._pos = pos',
+            'tokens._max_pos = max_pos',
+            'return v'
+        ])
+
+        return '\n'.join(lines) + '\n'
+
+
+def _compile(compiler):
+    """Returns the parse function generated by given compiler.
+
+    """
+
+    namespace = dict(compiler.constants)
+    code = compile(compiler.source(), '<textparser grammar>', 'exec')
+    exec(code, namespace)
+
+    return namespace['parse']
+
+
+class CompiledGrammar(Grammar):
+    """Same as :class:`~textparser.Grammar`, but the grammar is compiled
+    into specialized Python code with one function per pattern, which
+    parses faster than matching the patterns one by one. The parse
+    trees and errors are the same.
+
+    Patterns that are not built-in, or override the built-in match
+    method, are supported, but are matched as usual. Packrat parsing,
+    lazy tokens and `recursive` set to ``False`` use the patterns, not
+    the compiled code.
+
+    Create it with :func:`~textparser.Grammar.compile()`. Requires
+    Python 3.
 
     """
 
+    VALUES = {
+        'string': 'values[{}].value',
+        'token': 'values[{}]',
+        'array': 'value({})'
+    }
+
     def __init__(self, grammar):
-        if isinstance(grammar, str):
-            grammar = _wrap_string(grammar)
+        super(CompiledGrammar, self).__init__(grammar)
+        self._parse_functions = {}
+
+    def __getstate__(self):
+        state = super(CompiledGrammar, self).__getstate__()
+        state['_parse_functions'] = {}
+
+        return state
+
+    def source(self, token_tree=False, array=False):
+        """Returns the generated Python source code used to parse a list
+        of tokens, or a :class:`~textparser.TokenArray` if `array` is
+        ``True``.
 
-        self._root = grammar
+        """
+
+        return self._compiler(self._values_kind(token_tree, array)).source()
 
-    def parse(self, tokens, token_tree=False):
+    def _values_kind(self, token_tree, array):
         if token_tree:
-            tokens = _Tokens(tokens)
+            return 'token'
+        elif array:
+            return 'array'
         else:
-            tokens = _StringTokens(tokens)
+            return 'string'
 
-        parsed = self._root.match(tokens)
+    def _compiler(self, values_kind):
+        return _GrammarCompiler(self._root, self.VALUES[values_kind])
 
-        if parsed is not MISMATCH and tokens.peek_max().kind == '__EOF__':
-            return parsed
-        else:
-            raise GrammarError(tokens.peek_max().offset)
+    def _parse_function(self, values_kind):
+        function = self._parse_functions.get(values_kind)
+
+        if function is None:
+            function = _compile(self._compiler(values_kind))
+            self._parse_functions[values_kind] = function
+
+        return function
+
+    def parse(self,
+              tokens,
+              token_tree=False,
+              packrat=False,
+              recursive=True):
+        if packrat or not recursive or not hasattr(tokens, '__getitem__'):
+            return super(CompiledGrammar, self).parse(tokens,
+                                                      token_tree,
+                                                      packrat,
+                                                      recursive)
+
+        tokens = _create_tokens(tokens, token_tree)
+        values_kind = self._values_kind(token_tree,
+                                        isinstance(tokens, _ArrayTokens))
+        parse = self._parse_function(values_kind)
+
+        return self._parse_result(tokens, parse(tokens, tokens._tokens))
 
 
 def choice(*patterns):
@@ -704,44 +5115,495 @@ def markup_line(text, offset, marker='>>!<<'):
 
     .. code-block:: python
 
-       >>> markup_line('0\\n1234\\n56', 3)
-       1>>!<<234
+       >>> markup_line('0\\n1234\\n56', 3)
+       1>>!<<234
+
+    """
+
+    begin = text.rfind('\n', 0, offset)
+    begin += 1
+
+    end = text.find('\n', offset)
+
+    if end == -1:
+        end = len(text)
+
+    return text[begin:offset] + marker + text[offset:end]
+
+
+def line(text, offset):
+    return text.count('\n', 0, offset) + 1
+
+
+def column(text, offset):
+    line_start = text.rfind('\n', 0, offset)
+
+    return offset - line_start
+
+
+class LineIndex(object):
+    """The line start offsets of given text `text`, for lookups of the
+    line and column of many offsets into it. Each lookup is a binary
+    search, instead of a scan of the text before the offset as by
+    :func:`~textparser.markup_line()`. The offsets are found the
+    first time they are needed.
+
+    .. code-block:: python
+
+       >>> index = LineIndex('0\\n1234\\n56')
+       >>> index.line(3), index.column(3)
+       (2, 2)
+       >>> index.locations([0, 3, 8])
+       [(1, 1), (2, 2), (3, 2)]
+
+    """
+
+    def __init__(self, text):
+        self._text = text
+        self._starts = None
+
+    @property
+    def text(self):
+        """The indexed text.
+
+        """
+
+        return self._text
+
+    @property
+    def starts(self):
+        """An array of the start offsets of all lines in the text.
+
+        """
+
+        if self._starts is None:
+            starts = _offsets_array()
+            starts.append(0)
+            starts.extend(mo.end() for mo in re.finditer('\n', self._text))
+            self._starts = starts
+
+        return self._starts
+
+    def _line(self, offset):
+        """Returns the line number of given offset, and the offset its line
+        starts at.
+
+        """
+
+        starts = self.starts
+        line = bisect_right(starts, max(offset, 0))
+
+        return line, starts[line - 1]
+
+    def line(self, offset):
+        """Returns the line number of given offset, starting at 1.
+
+        """
+
+        return self._line(offset)[0]
+
+    def column(self, offset):
+        """Returns the column of given offset, starting at 1.
+
+        """
+
+        line, line_start = self._line(offset)
+
+        return offset - line_start + 1
+
+    def markup_line(self, offset, marker='>>!<<'):
+        """Same as :func:`~textparser.markup_line()` for the indexed text.
+
+        """
+
+        line, begin = self._line(offset)
+
+        if line < len(self.starts):
+            end = self.starts[line] - 1
+        else:
+            end = len(self._text)
+
+        return self._text[begin:offset] + marker + self._text[offset:end]
+
+    def locations(self, offsets):
+        """Returns a list of the line and column two-tuples of given
+        offsets.
+
+        """
+
+        locations = []
+
+        for offset in offsets:
+            line, line_start = self._line(offset)
+            locations.append((line, offset - line_start + 1))
+
+        return locations
+
+
+def tokenize_init(spec):
+    """Initialize a tokenizer. Should only be called by the
+    :func:`~textparser.Parser.tokenize` method in the parser.
+
+    """
+
+    tokens = [Token('__SOF__', '__SOF__', 0)]
+    re_token = '|'.join([
+        '(?P<{}>{})'.format(name, regex) for name, regex in spec
+    ])
+
+    return tokens, re_token
+
+
+def _seekable(fin):
+    try:
+        return fin.seekable()
+    except AttributeError:
+        return False
+
+
+def _iter_sof_eof(tokens, text, match_sof):
+    """Lazy version of the start and end of file handling in
+    :func:`~textparser.Parser.parse()`.
+
+    """
+
+    kind = None
+    tokens = iter(tokens)
+
+    for token in tokens:
+        kind = token.kind
+
+        if kind != '__SOF__' or match_sof:
+            yield token
+
+        break
+
+    for token in tokens:
+        kind = token.kind
+        yield token
+
+    if kind != '__EOF__':
+        yield Token('__EOF__', '__EOF__', len(text))
+
+
+_READ_SIZE = 65536
+
+
+class Tokenizer(object):
+    """A compiled tokenizer created from given token specifications
+    `specs` and keywords `keywords`. See
+    :func:`~textparser.Parser.token_specs()` and
+    :func:`~textparser.Parser.keywords()` for details.
+
+    The regular expression and all lookup tables are built once when
+    the tokenizer is created. A tokenizer has no mutable state and may
+    be shared by any number of parsers and threads.
+
+    """
+
+    def __init__(self, specs, keywords=None):
+        names = {}
+        unpacked_specs = []
+
+        for spec in specs:
+            if len(spec) == 2:
+                unpacked_specs.append(spec)
+            else:
+                unpacked_specs.append((spec[0], spec[2]))
+                names[spec[0]] = spec[1]
+
+        if keywords is None:
+            keywords = set()
+
+        _, re_token = tokenize_init(unpacked_specs)
+        self._names = names
+        self._keywords = set(keywords)
+        self._re_token = re.compile(re_token, re.DOTALL)
+        self._create_tables()
+
+    def __getstate__(self):
+        # The tables use kind ids, which are not the same in all
+        # processes.
+        return (self._names, self._keywords, self._re_token)
+
+    def __setstate__(self, state):
+        self._names, self._keywords, self._re_token = state
+        self._create_tables()
+
+    def _create_tables(self):
+        self._kinds = self._create_kinds_table()
+        self._kind_ids = [
+            kind if kind is None or kind is MISMATCH else _kind_id(kind)
+            for kind in self._kinds
+        ]
+        self._keyword_ids = {
+            keyword: _kind_id(self._names.get(keyword, keyword))
+            for keyword in self._keywords
+        }
+
+    def _create_kinds_table(self):
+        """Returns a table of token kinds indexed by regular expression
+        group index. ``None`` is used for skipped tokens and
+        :data:`~textparser.MISMATCH` for mismatching tokens.
+
+        """
+
+        kinds = [None] * (self._re_token.groups + 1)
+
+        for kind, index in self._re_token.groupindex.items():
+            if kind == 'SKIP':
+                kinds[index] = None
+            elif kind == 'MISMATCH':
+                kinds[index] = MISMATCH
+            else:
+                kinds[index] = self._names.get(kind, kind)
+
+        return kinds
+
+    @property
+    def names(self):
+        """A dictionary of token kinds to user friendly names.
+
+        """
+
+        return self._names
+
+    @property
+    def keywords(self):
+        """A set of keywords.
+
+        """
+
+        return self._keywords
+
+    @property
+    def re_token(self):
+        """The compiled regular expression.
+
+        """
+
+        return self._re_token
+
+    @property
+    def kinds(self):
+        """A list of token kinds indexed by regular expression group
+        index.
+
+        """
+
+        return self._kinds
+
+    def tokenize(self, text):
+        """Tokenize given string `text`, and return a list of tokens,
+        starting with a ``__SOF__`` token. Raises
+        :class:`~textparser.TokenizeError` on failure.
+
+        """
+
+        names = self._names
+        keywords = self._keywords
+        kinds = self._kinds
+        tokens = [Token('__SOF__', '__SOF__', 0)]
+        append = tokens.append
+
+        for mo in self._re_token.finditer(text):
+            kind = kinds[mo.lastindex]
+
+            if kind is None:
+                continue
+            elif kind is MISMATCH:
+                raise TokenizeError(text, mo.start())
+
+            value = mo.group()
+
+            if value in keywords:
+                kind = names.get(value, value)
+
+            append(Token(kind, value, mo.start()))
+
+        return tokens
+
+    def tokenize_array(self, text):
+        """Same as :func:`~textparser.Tokenizer.tokenize()`, but returns a
+        :class:`~textparser.TokenArray`, which uses a lot less memory
+        than a list of tokens.
+
+        """
+
+        kind_ids = self._kind_ids
+        keyword_ids = self._keyword_ids
+        tokens = TokenArray(text)
+        kinds = tokens.kinds
+        starts = tokens.starts
+        ends = tokens.ends
+        tokens.add(_SOF_ID, 0, 0)
+
+        for mo in self._re_token.finditer(text):
+            kind_id = kind_ids[mo.lastindex]
+
+            if kind_id is None:
+                continue
+            elif kind_id is MISMATCH:
+                raise TokenizeError(text, mo.start())
+
+            start, end = mo.span()
+
+            if keyword_ids:
+                kind_id = keyword_ids.get(mo.group(), kind_id)
+
+            kinds.append(kind_id)
+            starts.append(start)
+            ends.append(end)
+
+        return tokens
+
+    def _tokenize_ids(self, text, match_sof):
+        """Same as :func:`~textparser.Tokenizer.tokenize()`, but returns a
+        :class:`_TokenList` ending with an ``__EOF__`` token, and only
+        starting with the ``__SOF__`` token if `match_sof` is
+        ``True``.
+
+        """
+
+        names = self._names
+        keywords = self._keywords
+        keyword_ids = self._keyword_ids
+        kinds = self._kinds
+        kind_ids = self._kind_ids
+        tokens = []
+        ids = []
+        append = tokens.append
+        append_id = ids.append
+
+        if match_sof:
+            append(Token('__SOF__', '__SOF__', 0))
+            append_id(_SOF_ID)
+
+        for mo in self._re_token.finditer(text):
+            index = mo.lastindex
+            kind = kinds[index]
+
+            if kind is None:
+                continue
+            elif kind is MISMATCH:
+                raise TokenizeError(text, mo.start())
+
+            value = mo.group()
+
+            if value in keywords:
+                kind = names.get(value, value)
+                append_id(keyword_ids[value])
+            else:
+                append_id(kind_ids[index])
+
+            append(Token(kind, value, mo.start()))
+
+        append(Token('__EOF__', '__EOF__', len(text)))
+        append_id(_EOF_ID)
+
+        return _TokenList(tokens, ids)
+
+    def iter_tokenize(self, text):
+        """Same as :func:`~textparser.Tokenizer.tokenize()`, but returns
+        an iterator that tokenizes the text as the tokens are
+        consumed. :class:`~textparser.TokenizeError` is raised by the
+        iterator when the invalid token is reached.
+
+        """
+
+        names = self._names
+        keywords = self._keywords
+        kinds = self._kinds
+
+        yield Token('__SOF__', '__SOF__', 0)
+
+        for mo in self._re_token.finditer(text):
+            kind = kinds[mo.lastindex]
+
+            if kind is None:
+                continue
+            elif kind is MISMATCH:
+                raise TokenizeError(text, mo.start())
+
+            value = mo.group()
+
+            if value in keywords:
+                kind = names.get(value, value)
+
+            yield Token(kind, value, mo.start())
+
+    def _iter_tokenize_chunks(self, chunks, lookahead=_READ_SIZE):
+        """Same as :func:`~textparser.Tokenizer.iter_tokenize()`, but
+        tokenizes the text in given iterable of strings `chunks`,
+        ending with an ``__EOF__`` token. Only the text of tokens not
+        yet matched is kept.
+
+        A token is matched when at least `lookahead` characters from
+        its start are read, or all text. Mismatches are only raised at
+        the end of the text, as more text may complete the token. The
+        text of raised errors is the unmatched text only.
+
+        """
+
+        names = self._names
+        keywords = self._keywords
+        kinds = self._kinds
+        search = self._re_token.search
+        chunks = iter(chunks)
+        buf = ''
+        base = 0
+        pos = 0
+        more = True
+
+        yield Token('__SOF__', '__SOF__', 0)
+
+        while True:
+            chunk = next(chunks, None) if more else None
+
+            if chunk is None:
+                more = False
+            else:
+                buf = buf[pos:] + chunk
+                base += pos
+                pos = 0
 
-    """
+            limit = len(buf) - lookahead
 
-    begin = text.rfind('\n', 0, offset)
-    begin += 1
+            while True:
+                mo = search(buf, pos)
 
-    end = text.find('\n', offset)
+                if mo is None:
+                    break
 
-    if end == -1:
-        end = len(text)
+                start, end = mo.span()
 
-    return text[begin:offset] + marker + text[offset:end]
+                if more and (start > limit or end == len(buf)):
+                    break
 
+                kind = kinds[mo.lastindex]
 
-def line(text, offset):
-    return text[:offset].count('\n') + 1
+                if kind is MISMATCH:
+                    if more:
+                        break
 
+                    raise TokenizeError(buf, base + start)
 
-def column(text, offset):
-    line_start = text.rfind('\n', 0, offset)
+                pos = max(end, start + 1)
 
-    return offset - line_start
+                if kind is None:
+                    continue
 
+                value = mo.group()
 
-def tokenize_init(spec):
-    """Initialize a tokenizer. Should only be called by the
-    :func:`~textparser.Parser.tokenize` method in the parser.
+                if value in keywords:
+                    kind = names.get(value, value)
 
-    """
+                yield Token(kind, value, base + start)
 
-    tokens = [Token('__SOF__', '__SOF__', 0)]
-    re_token = '|'.join([
-        '(?P<{}>{})'.format(name, regex) for name, regex in spec
-    ])
+            if not more:
+                break
 
-    return tokens, re_token
+        yield Token('__EOF__', '__EOF__', base + len(buf))
 
 
 class Parser(object):
@@ -764,18 +5626,122 @@ class Parser(object):
 
     """
 
-    def _unpack_token_specs(self):
-        names = {}
-        specs = []
+    cache_tokenizer = True
+    """The tokenizer created from
+    :func:`~textparser.Parser.token_specs()` and
+    :func:`~textparser.Parser.keywords()` is built once per parser
+    class if ``True``, and on every call to
+    :func:`~textparser.Parser.tokenizer()` if ``False``. Set it to
+    ``False`` in a subclass or an instance if the token
+    specifications depend on instance state.
 
-        for spec in self.token_specs():
-            if len(spec) == 2:
-                specs.append(spec)
-            else:
-                specs.append((spec[0], spec[2]))
-                names[spec[0]] = spec[1]
+    """
+
+    cache_grammar = True
+    """The grammar returned by :func:`~textparser.Parser.grammar()` is
+    built once per parser class if ``True``, and on every call to
+    :func:`~textparser.Parser.parse()` if ``False``. Set it to
+    ``False`` in a subclass or an instance if the grammar depends on
+    instance state.
+
+    """
+
+    compile_grammar = False
+    """The grammar is compiled into Python code with
+    :func:`~textparser.Grammar.compile()` if ``True``, which makes
+    parsing faster, but creating the grammar slower.
+
+    """
+
+    optimize_grammar = False
+    """The grammar is optimized with
+    :func:`~textparser.Grammar.optimize()` if ``True``, before it is
+    compiled.
+
+    """
+
+    async_executor = None
+    """The :class:`concurrent.futures.Executor` parsing the texts of
+    :func:`~textparser.Parser.parse_async()` and
+    :func:`~textparser.Parser.aiter_parse()`, or ``None`` for the
+    default executor of the event loop. Use a process pool to not
+    block the event loop at all, as threads parsing texts hold the
+    global interpreter lock most of the time.
+
+    """
+
+    async_limit = 4
+    """The maximum number of texts parsed at the same time by
+    :func:`~textparser.Parser.parse_async()` and
+    :func:`~textparser.Parser.aiter_parse()` of a parser in an event
+    loop. Further texts wait for their turn, in order.
+
+    """
+
+    def __getstate__(self):
+        """Returns the state of the parser to pickle, including the cached
+        tokenizer and grammar of its class, if created. They are used
+        by the unpickled parser if its class has none, so processes
+        receiving a parser do not have to create them.
+
+        """
+
+        cls = type(self)
+        caches = {
+            name: cls.__dict__[name]
+            for name in ['_tokenizer', '_grammar']
+            if name in cls.__dict__
+        }
+
+        state = dict(self.__dict__)
+
+        # Only used in the process parsing asynchronously.
+        state.pop('_async_limiters', None)
+        state.pop('async_executor', None)
+
+        return (state, caches)
+
+    def __setstate__(self, state):
+        state, caches = state
+        self.__dict__.update(state)
+        cls = type(self)
+
+        for name, value in caches.items():
+            if name not in cls.__dict__:
+                setattr(cls, name, value)
+
+    @classmethod
+    def clear_cache(cls):
+        """Remove the cached tokenizer and grammar of this parser class,
+        forcing them to be rebuilt the next time they are needed.
+
+        """
+
+        for name in ['_tokenizer', '_grammar']:
+            if name in cls.__dict__:
+                delattr(cls, name)
+
+    def tokenizer(self):
+        """Returns the compiled :class:`~textparser.Tokenizer` of this
+        parser class. It is created from
+        :func:`~textparser.Parser.token_specs()` and
+        :func:`~textparser.Parser.keywords()` the first time it is
+        needed, and then shared by all instances of the class, unless
+        :attr:`~textparser.Parser.cache_tokenizer` is ``False``.
+
+        """
+
+        if not self.cache_tokenizer:
+            return Tokenizer(self.token_specs(), self.keywords())
+
+        cls = type(self)
+        tokenizer = cls.__dict__.get('_tokenizer')
+
+        if tokenizer is None:
+            tokenizer = Tokenizer(self.token_specs(), self.keywords())
+            cls._tokenizer = tokenizer
 
-        return names, specs
+        return tokenizer
 
     def keywords(self):
         """A set of keywords in the text.
@@ -820,29 +5786,23 @@ class Parser(object):
 
         """
 
-        names, specs = self._unpack_token_specs()
-        keywords = self.keywords()
-        tokens, re_token = tokenize_init(specs)
+        return self.tokenizer().tokenize(text)
 
-        for mo in re.finditer(re_token, text, re.DOTALL):
-            kind = mo.lastgroup
+    def iter_tokenize(self, text):
+        """Same as :func:`~textparser.Parser.tokenize()`, but returns an
+        iterator of tokens. Used by :func:`~textparser.Parser.parse()`
+        when `lazy` is ``True``.
 
-            if kind == 'SKIP':
-                pass
-            elif kind != 'MISMATCH':
-                value = mo.group(kind)
-
-                if value in keywords:
-                    kind = value
+        The default implementation tokenizes the text while the tokens
+        are consumed, unless :func:`~textparser.Parser.tokenize()` is
+        overridden, in which case its tokens are returned.
 
-                if kind in names:
-                    kind = names[kind]
+        """
 
-                tokens.append(Token(kind, value, mo.start()))
-            else:
-                raise TokenizeError(text, mo.start())
+        if type(self).tokenize is not Parser.tokenize:
+            return iter(self.tokenize(text))
 
-        return tokens
+        return self.tokenizer().iter_tokenize(text)
 
     def grammar(self):
         """The text grammar is used to create a parse tree out of a list of
@@ -854,12 +5814,66 @@ class Parser(object):
 
         raise NotImplementedError('No grammar defined.')
 
-    def parse(self, text, token_tree=False, match_sof=False):
+    def compiled_grammar(self):
+        """Returns the :class:`~textparser.Grammar` created from
+        :func:`~textparser.Parser.grammar()`. It is created the first
+        time it is needed, and then shared by all instances of the
+        class, unless :attr:`~textparser.Parser.cache_grammar` is
+        ``False``.
+
+        """
+
+        if not self.cache_grammar:
+            return self._create_grammar()
+
+        cls = type(self)
+        grammar = cls.__dict__.get('_grammar')
+
+        if grammar is None:
+            grammar = self._create_grammar()
+            cls._grammar = grammar
+
+        return grammar
+
+    def _create_grammar(self):
+        grammar = self.grammar()
+
+        if not isinstance(grammar, Grammar):
+            grammar = Grammar(grammar)
+
+        if self.optimize_grammar:
+            grammar = grammar.optimize()
+
+        if self.compile_grammar:
+            grammar = grammar.compile()
+
+        return grammar
+
+    def parse(self,
+              text,
+              token_tree=False,
+              match_sof=False,
+              lazy=False,
+              compact=False,
+              packrat=False,
+              recursive=True):
         """Parse given string `text` and return the parse tree. Raises
         :class:`~textparser.ParseError` on failure.
 
         Returns a parse tree of tokens if `token_tree` is ``True``.
 
+        The text is tokenized while parsing if `lazy` is ``True``,
+        instead of creating a list of all tokens before parsing
+        starts. Only tokens the parser may backtrack to are kept in
+        memory. The parse tree and errors are the same in both modes.
+
+        Tokens are stored in a :class:`~textparser.TokenArray` instead
+        of a list if `compact` is ``True``, unless `lazy` is ``True``
+        or :func:`~textparser.Parser.tokenize()` is overridden.
+
+        See :func:`~textparser.Grammar.parse()` for `packrat` and
+        `recursive`.
+
         .. code-block:: python
 
            >>> MyParser().parse('Hello, World!')
@@ -875,18 +5889,551 @@ class Parser(object):
         """
 
         try:
-            tokens = self.tokenize(text)
+            tokens = self._create_tokens(text, match_sof, lazy, compact)
+
+            return self.compiled_grammar().parse(tokens,
+                                                 token_tree,
+                                                 packrat,
+                                                 recursive)
+        except (TokenizeError, GrammarError) as e:
+            raise self._parse_error(text, e)
+
+    def parse_recover(self,
+                      text,
+                      token_tree=False,
+                      match_sof=False,
+                      lazy=False,
+                      compact=False):
+        """Same as :func:`~textparser.Parser.parse()`, but reports all
+        syntax errors the grammar can recover from in one parse. Returns
+        a two-tuple of the parse tree and a list of
+        :class:`~textparser.ParseError`, empty if there are no
+        errors. Errors are recovered from by
+        :class:`~textparser.Recover` patterns in the grammar, see
+        :func:`~textparser.Grammar.parse_recover()`.
+
+        Tokenization errors are not recovered from, and raise
+        :class:`~textparser.ParseError` as in
+        :func:`~textparser.Parser.parse()`.
+
+        .. code-block:: python
+
+           >>> class MyParser(Parser):
+           ...    ...
+           ...    def grammar(self):
+           ...        return ZeroOrMore(Recover(statement, sync=';'))
+           >>> tree, errors = MyParser().parse_recover(text)
+
+        """
+
+        try:
+            tokens = self._create_tokens(text, match_sof, lazy, compact)
+            tree, errors = self.compiled_grammar().parse_recover(tokens,
+                                                                 token_tree)
+        except (TokenizeError, GrammarError) as e:
+            raise self._parse_error(text, e)
+
+        # An index is slower than a scan of the text for one error.
+        if len(errors) > 1:
+            line_index = LineIndex(text)
+        else:
+            line_index = None
+
+        return tree, [ParseError(text,
+                                 error.offset,
+                                 line_index,
+                                 error.expected)
+                      for error in errors]
+
+    def parse_many(self,
+                   texts,
+                   executor=None,
+                   chunksize=1,
+                   return_exceptions=True):
+        """Parse each string in `texts` with
+        :func:`~textparser.Parser.parse()`, and return a list of the
+        parse trees in the same order as `texts`.
+
+        The texts are parsed by `executor`, a
+        :class:`concurrent.futures.Executor` owned by the caller, in
+        chunks of `chunksize` texts if given, and in the calling
+        thread otherwise. The tokenizer and grammar are created before
+        parsing starts. The parser is pickled once per call, and each
+        process pool worker unpickles it once, and then reuses it for
+        all texts it parses, also in later calls with the same
+        executor.
+
+        The :class:`~textparser.ParseError` of a text is put in the
+        list in place of its parse tree if `return_exceptions` is
+        ``True``, and raised otherwise.
+
+        .. code-block:: python
+
+           >>> from concurrent.futures import ProcessPoolExecutor
+           >>> with ProcessPoolExecutor() as executor:
+           ...     trees = MyParser().parse_many(texts, executor, 100)
+
+        """
+
+        if executor is None:
+            return [_parse_many_item(self, return_exceptions, text)
+                    for text in texts]
+
+        if type(self).tokenize is Parser.tokenize and self.cache_tokenizer:
+            self.tokenizer()
+
+        if self.cache_grammar:
+            self.compiled_grammar()
+
+        texts = list(texts)
+        chunks = [texts[i:i + chunksize]
+                  for i in range(0, len(texts), chunksize)]
+        parse = partial(_parse_many_chunk,
+                        _ShippedParser(self),
+                        return_exceptions)
+        trees = []
+
+        for chunk_trees in executor.map(parse, chunks):
+            trees.extend(chunk_trees)
+
+        return trees
+
+    def parse_async(self, text, token_tree=False, match_sof=False):
+        """Same as :func:`~textparser.Parser.parse()`, but returns an
+        awaitable, which parses the text in
+        :attr:`~textparser.Parser.async_executor` when awaited, so the
+        event loop is not blocked while parsing. At most
+        :attr:`~textparser.Parser.async_limit` texts are parsed at the
+        same time.
+
+        .. code-block:: python
+
+           >>> tree = await MyParser().parse_async('Hello, World!')
+
+        """
+
+        return _Awaitable(partial(self._submit_async,
+                                  partial(self.parse,
+                                          text,
+                                          token_tree=token_tree,
+                                          match_sof=match_sof)))
+
+    def aiter_parse(self, texts, token_tree=False, match_sof=False):
+        """Returns an asynchronous iterator of the parse trees of given
+        iterable or asynchronous iterable of strings `texts`, in the
+        same order as `texts`. The texts are parsed as by
+        :func:`~textparser.Parser.parse_async()`. Texts are read ahead
+        while waiting for parse trees, but never more than
+        :attr:`~textparser.Parser.async_limit`, so a fast producer of
+        texts waits for the parser.
+
+        :class:`~textparser.ParseError` is raised by the iterator when
+        the parse tree of a text that cannot be parsed is next.
+
+        .. code-block:: python
+
+           >>> async for tree in MyParser().aiter_parse(texts):
+           ...     print(tree)
+
+        """
+
+        return _AsyncParseIterator(self, texts, token_tree, match_sof)
+
+    def _submit_async(self, function, loop):
+        limiters = self.__dict__.get('_async_limiters')
+
+        if limiters is None:
+            limiters = weakref.WeakKeyDictionary()
+            self._async_limiters = limiters
 
-            if len(tokens) == 0 or tokens[-1].kind != '__EOF__':
-                tokens.append(Token('__EOF__', '__EOF__', len(text)))
+        limiter = limiters.get(loop)
 
-            if not match_sof:
-                if len(tokens) > 0 and tokens[0].kind == '__SOF__':
-                    del tokens[0]
+        if limiter is None:
+            limiter = _AsyncLimiter(loop)
+            limiters[loop] = limiter
 
-            return Grammar(self.grammar()).parse(tokens, token_tree)
+        return limiter.submit(function, self.async_executor, self.async_limit)
+
+    def iter_parse(self, text, token_tree=False, match_sof=False):
+        """Same as :func:`~textparser.Parser.parse()`, but returns an
+        iterator of the elements of the top-level repetition of the
+        grammar. `text` is a string or a file object. The text is
+        tokenized while parsing, and each element is yielded as soon
+        as it is matched. Tokens before it are discarded, so the memory
+        usage does not grow with the number of elements. See
+        :func:`~textparser.Grammar.iter_parse()` for details.
+
+        A seekable file object is read in chunks while parsing, and
+        the whole text only on error, for the error message. Other file
+        objects, or all if :func:`~textparser.Parser.tokenize()` or
+        :func:`~textparser.Parser.iter_tokenize()` is overridden, are
+        read at once.
+
+        :class:`~textparser.ParseError` is raised by the iterator when
+        the error is found.
+
+        .. code-block:: python
+
+           >>> for record in RecordsParser().iter_parse(fin):
+           ...     print(record)
+
+        """
+
+        if hasattr(text, 'read'):
+            if (type(self).tokenize is Parser.tokenize
+                and type(self).iter_tokenize is Parser.iter_tokenize
+                and _seekable(text)):
+                return self._iter_parse_file(text, token_tree, match_sof)
+
+            text = text.read()
+
+        tokens = self._create_tokens(text, match_sof, True, False)
+        elements = self.compiled_grammar().iter_parse(tokens, token_tree)
+
+        return self._iter_parse(text, elements)
+
+    def _iter_parse(self, text, elements):
+        try:
+            for element in elements:
+                yield element
+        except (TokenizeError, GrammarError) as e:
+            raise self._parse_error(text, e)
+
+    def _iter_parse_file(self, fin, token_tree, match_sof):
+        """Parses the file `fin` in chunks. The whole text is only read
+        on error, for the error message.
+
+        """
+
+        start = fin.tell()
+        chunks = iter(partial(fin.read, _READ_SIZE), '')
+        tokens = self.tokenizer()._iter_tokenize_chunks(chunks)
+        tokens = _iter_sof_eof(tokens, None, match_sof)
+        elements = self.compiled_grammar().iter_parse(tokens, token_tree)
+
+        try:
+            for element in elements:
+                yield element
+        except (TokenizeError, GrammarError) as e:
+            fin.seek(start)
+
+            raise self._parse_error(fin.read(), e)
+
+    def validate(self, text, match_sof=False):
+        """Check if given string `text` is syntactically valid, without
+        creating a parse tree. Returns ``True`` if valid, and raises the
+        same :class:`~textparser.ParseError` as
+        :func:`~textparser.Parser.parse()` otherwise.
+
+        .. code-block:: python
+
+           >>> MyParser().validate('Hello, World!')
+           True
+
+        """
+
+        try:
+            tokens = self._create_tokens(text, match_sof, False, True)
+
+            return self.compiled_grammar().recognize(tokens)
         except (TokenizeError, GrammarError) as e:
-            raise ParseError(text, e.offset)
+            raise self._parse_error(text, e)
+
+    def _parse_error(self, text, error):
+        """Returns a parse error of given tokenize or grammar error
+        `error`.
+
+        """
+
+        if isinstance(error, GrammarError):
+            return ParseError(text, error.offset, expected=error.expected)
+        else:
+            return ParseError(text, error.offset)
+
+    def _create_tokens(self, text, match_sof, lazy, compact):
+        if lazy:
+            return _iter_sof_eof(self.iter_tokenize(text), text, match_sof)
+
+        if type(self).tokenize is Parser.tokenize:
+            if compact:
+                tokens = self.tokenizer().tokenize_array(text)
+            else:
+                return self.tokenizer()._tokenize_ids(text, match_sof)
+        else:
+            tokens = self.tokenize(text)
+
+        if len(tokens) == 0 or tokens[-1].kind != '__EOF__':
+            tokens.append(Token('__EOF__', '__EOF__', len(text)))
+
+        if not match_sof:
+            if len(tokens) > 0 and tokens[0].kind == '__SOF__':
+                del tokens[0]
+
+        return tokens
+
+
+# Parsers unpickled by process pool workers of
+# Parser.parse_many(), by their pickled data.
+_SHIPPED_PARSERS = OrderedDict()
+_SHIPPED_PARSERS_SIZE = 8
+_SHIPPED_PARSERS_LOCK = threading.Lock()
+
+
+class _ShippedParser(object):
+    """A parser given to the workers of
+    :func:`~textparser.Parser.parse_many()`. It is pickled once, and
+    unpickled once by each worker process, which then finds the
+    parser by its pickled data.
+
+    """
+
+    def __init__(self, parser):
+        self.parser = parser
+        self._data = None
+
+    def __reduce__(self):
+        if self._data is None:
+            self._data = pickle.dumps(self.parser, pickle.HIGHEST_PROTOCOL)
+
+        return (_load_shipped_parser, (self._data, ))
+
+
+def _load_shipped_parser(data):
+    with _SHIPPED_PARSERS_LOCK:
+        shipped = _SHIPPED_PARSERS.pop(data, None)
+
+        if shipped is None:
+            shipped = _ShippedParser(pickle.loads(data))
+
+            if len(_SHIPPED_PARSERS) == _SHIPPED_PARSERS_SIZE:
+                _SHIPPED_PARSERS.popitem(last=False)
+
+        _SHIPPED_PARSERS[data] = shipped
+
+    return shipped
+
+
+def _parse_many_chunk(shipped, return_exceptions, texts):
+    return [_parse_many_item(shipped.parser, return_exceptions, text)
+            for text in texts]
+
+
+def _parse_many_item(parser, return_exceptions, text):
+    try:
+        return parser.parse(text)
+    except ParseError as e:
+        if return_exceptions:
+            return e
+        else:
+            raise
+
+
+def _running_loop():
+    import asyncio
+
+    try:
+        return asyncio.get_running_loop()
+    except AttributeError:
+        # Python 3.6 returns the running loop when called from a
+        # coroutine.
+        return asyncio.get_event_loop()
+
+
+class _Awaitable(object):
+    """Calls `function` with the running event loop when awaited, and
+    then awaits the future it returns.
+
+    """
+
+    def __init__(self, function):
+        self._function = function
+
+    def __await__(self):
+        return self._function(_running_loop()).__await__()
+
+
+class _AsyncLimiter(object):
+    """Calls functions in executors from the event loop `loop`, at most
+    a given number at a time. Other functions wait in a queue.
+
+    """
+
+    def __init__(self, loop):
+        self._loop = loop
+        self._queue = deque()
+        self._running = 0
+        self._limit = 1
+
+    def submit(self, function, executor, limit):
+        """Returns a future of the value returned by `function`, called
+        in `executor` when less than `limit` functions are running.
+
+        """
+
+        future = self._loop.create_future()
+        self._queue.append((function, executor, future))
+        self._limit = limit
+        self._start()
+
+        return future
+
+    def _start(self):
+        while self._queue and self._running < self._limit:
+            function, executor, future = self._queue.popleft()
+
+            if future.cancelled():
+                continue
+
+            self._running += 1
+            running = self._loop.run_in_executor(executor, function)
+            running.add_done_callback(partial(self._done, future))
+
+    def _done(self, future, running):
+        self._running -= 1
+
+        if not future.cancelled():
+            if running.cancelled():
+                future.cancel()
+            elif running.exception() is not None:
+                future.set_exception(running.exception())
+            else:
+                future.set_result(running.result())
+
+        self._start()
+
+
+class _AsyncParseIterator(object):
+    """The asynchronous iterator returned by
+    :func:`~textparser.Parser.aiter_parse()`. Parse futures of read
+    texts are kept in order in `pending`.
+
+    """
+
+    def __init__(self, parser, texts, token_tree, match_sof):
+        self._parser = parser
+        self._token_tree = token_tree
+        self._match_sof = match_sof
+
+        if hasattr(texts, '__anext__') or hasattr(texts, '__aiter__'):
+            self._texts = texts.__aiter__()
+            self._is_async = True
+        else:
+            self._texts = iter(texts)
+            self._is_async = False
+
+        self._loop = None
+        self._pending = deque()
+        self._reading = False
+        self._exhausted = False
+        self._error = None
+        self._waiter = None
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        return _Awaitable(self._next)
+
+    def _next(self, loop):
+        self._loop = loop
+        waiter = loop.create_future()
+        self._waiter = waiter
+        self._read()
+
+        return waiter
+
+    def _read(self):
+        """Read and submit texts until the limit is reached or all texts
+        are read, and then deliver the next parse tree if available.
+
+        """
+
+        while (not self._exhausted
+               and not self._reading
+               and len(self._pending) < self._parser.async_limit):
+            if self._is_async:
+                try:
+                    reading = self._texts.__anext__()
+                except StopAsyncIteration:
+                    self._exhausted = True
+                    break
+
+                self._reading = True
+                reading = _ensure_future(reading, self._loop)
+                reading.add_done_callback(self._read_done)
+            else:
+                try:
+                    text = next(self._texts)
+                except StopIteration:
+                    self._exhausted = True
+                    break
+
+                self._submit(text)
+
+        self._deliver()
+
+    def _read_done(self, reading):
+        self._reading = False
+
+        if reading.cancelled():
+            self._exhausted = True
+        elif isinstance(reading.exception(), StopAsyncIteration):
+            self._exhausted = True
+        elif reading.exception() is not None:
+            self._exhausted = True
+            self._error = reading.exception()
+        else:
+            self._submit(reading.result())
+
+        self._read()
+
+    def _submit(self, text):
+        future = self._parser._submit_async(
+            partial(self._parser.parse,
+                    text,
+                    token_tree=self._token_tree,
+                    match_sof=self._match_sof),
+            self._loop)
+        future.add_done_callback(lambda _: self._deliver())
+        self._pending.append(future)
+
+    def _deliver(self):
+        waiter = self._waiter
+
+        if waiter is None or waiter.done():
+            return
+
+        if self._pending:
+            future = self._pending[0]
+
+            if not future.done():
+                return
+
+            self._pending.popleft()
+            self._waiter = None
+
+            if future.cancelled():
+                waiter.cancel()
+            elif future.exception() is not None:
+                waiter.set_exception(future.exception())
+            else:
+                waiter.set_result(future.result())
+
+            # Read ahead while the parse tree is used.
+            self._read()
+        elif self._exhausted and not self._reading:
+            self._waiter = None
+
+            if self._error is not None:
+                waiter.set_exception(self._error)
+            else:
+                waiter.set_exception(StopAsyncIteration())
+
+
+def _ensure_future(awaitable, loop):
+    import asyncio
+
+    return asyncio.ensure_future(awaitable, loop=loop)
 
 
 def replace_blocks(string, start='{', end='}'):